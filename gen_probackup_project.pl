@@ -152,6 +152,7 @@ sub build_pgprobackup
 		'merge.c',
 		'parsexlog.c',
 		'pg_probackup.c',
+		'pglz_reentrant.c',
 		'restore.c',
 		'show.c',
 		'util.c',
@@ -10,25 +10,222 @@
 
 #include "pg_probackup.h"
 
+#include <dirent.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <sys/stat.h>
 #include <unistd.h>
 
+#include "utils/thread.h"
+
+/* Subdirectory of WAL directory to prefetch WAL segments into */
+#define PREFETCH_DIR		"pbk_prefetch"
+#define PREFETCH_LOCK_FILE	"prefetch.pid"
+/* Number of 100 ms waits for running prefetch before the directory removal */
+#define PREFETCH_LOCK_RETRIES	50
+
+/* An argument for a thread function of batch archive-push */
+typedef struct
+{
+	parray	   *segments;		/* names of WAL segments to push ahead */
+	int			thread_num;
+	int			nthreads;
+	const char *pg_wal_dir;
+	bool		overwrite;
+	bool		wal_index;
+	int			compress_threads;	/* zstd threads per pushed segment */
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} archive_push_arg;
+
+/* Segments of a timeline to be indexed by index-wal */
+typedef struct
+{
+	TimeLineID	tli;
+	XLogSegNo	first_segno;
+	XLogSegNo	last_segno;
+} index_wal_job;
+
+/* An argument for a thread function of index-wal */
+typedef struct
+{
+	parray	   *jobs;			/* index_wal_job to process */
+	int			thread_num;
+	int			nthreads;
+	int			nindexed;		/* number of indexed segments */
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} index_wal_arg;
+
+/* Number of segments indexed by a job of index-wal */
+#define INDEX_WAL_JOB_SIZE	64
+
+static int
+compare_segment_names(const void *a, const void *b)
+{
+	return strcmp(*(char * const *) a, *(char * const *) b);
+}
+
+/*
+ * Look for WAL segments which are ready to be archived after wal_file_name
+ * in pg_wal_dir/archive_status. Returns up to "limit" names of segments
+ * in the order they will be requested by the server.
+ */
+static parray *
+get_ready_segments(const char *pg_wal_dir, const char *wal_file_name,
+				   int limit)
+{
+	char		status_dir[MAXPGPATH];
+	DIR		   *dir;
+	struct dirent *de;
+	parray	   *segments = parray_new();
+
+	join_path_components(status_dir, pg_wal_dir, "archive_status");
+
+	dir = opendir(status_dir);
+	if (dir == NULL)
+	{
+		elog(WARNING, "Cannot open directory \"%s\": %s", status_dir,
+			 strerror(errno));
+		return segments;
+	}
+
+	while (errno = 0, (de = readdir(dir)) != NULL)
+	{
+		char		segment[MAXFNAMELEN];
+		size_t		len = strlen(de->d_name);
+
+		/* Only complete WAL segments are pushed ahead of time */
+		if (len != XLOG_FNAME_LEN + strlen(".ready") ||
+			strcmp(de->d_name + XLOG_FNAME_LEN, ".ready") != 0)
+			continue;
+
+		StrNCpy(segment, de->d_name, XLOG_FNAME_LEN + 1);
+		if (!IsXLogFileName(segment) || strcmp(segment, wal_file_name) <= 0)
+			continue;
+
+		parray_append(segments, pgut_strdup(segment));
+	}
+
+	if (errno)
+		elog(WARNING, "Cannot read directory \"%s\": %s", status_dir,
+			 strerror(errno));
+	closedir(dir);
+
+	parray_qsort(segments, compare_segment_names);
+
+	/* Keep only the first "limit" segments */
+	while (parray_num(segments) > limit)
+		free(parray_remove(segments, parray_num(segments) - 1));
+
+	return segments;
+}
+
+/*
+ * Push WAL segment from pg_wal_dir into the archive.
+ *
+ * With wal_index the previous segment, which is complete in the archive now,
+ * and the pushed one, if the next segment is already archived, are added
+ * to the WAL index. zstd compresses the segment in compress_threads threads.
+ */
+static void
+push_segment(const char *pg_wal_dir, const char *wal_file_name,
+			 bool overwrite, bool wal_index, int compress_threads)
+{
+	char		from_path[MAXPGPATH];
+	char		to_path[MAXPGPATH];
+	bool		is_compress = false;
+
+	join_path_components(from_path, pg_wal_dir, wal_file_name);
+	join_path_components(to_path, arclog_path, wal_file_name);
+
+	if (wal_compress_suffix(instance_config.compress_alg) != NULL)
+		is_compress = IsXLogFileName(wal_file_name);
+
+	push_wal_file(from_path, to_path, is_compress, overwrite,
+				  compress_threads);
+
+	if (wal_index && IsXLogFileName(wal_file_name))
+	{
+		TimeLineID	tli;
+		XLogSegNo	segno;
+
+		GetXLogFromFileName(wal_file_name, &tli, &segno,
+							instance_config.xlog_seg_size);
+		index_wal(arclog_path, tli, instance_config.xlog_seg_size,
+				  segno > 0 ? segno - 1 : segno, segno);
+	}
+}
+
+/*
+ * Push every nthreads-th segment ahead starting from thread_num.
+ */
+static void *
+archive_push_thread(void *arg)
+{
+	archive_push_arg *arguments = (archive_push_arg *) arg;
+	int			i;
+
+	for (i = arguments->thread_num; i < parray_num(arguments->segments);
+		 i += arguments->nthreads)
+	{
+		const char *segment = (const char *) parray_get(arguments->segments, i);
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during archive-push");
+
+		elog(VERBOSE, "Thread [%d]: Pushing WAL segment \"%s\"",
+			 arguments->thread_num, segment);
+		push_segment(arguments->pg_wal_dir, segment, arguments->overwrite,
+					 arguments->wal_index, arguments->compress_threads);
+	}
+
+	/* All segments of the thread are pushed */
+	arguments->ret = 0;
+
+	return NULL;
+}
+
 /*
  * pg_probackup specific archive command for archive backups
  * set archive_command = 'pg_probackup archive-push -B /home/anastasia/backup
  * --wal-file-path %p --wal-file-name %f', to move backups into arclog_path.
  * Where archlog_path is $BACKUP_PATH/wal/system_id.
  * Currently it just copies wal files to the new location.
+ *
+ * If batch_size is greater than 1, up to batch_size - 1 following segments
+ * which are ready to be archived are pushed too, in num_threads threads,
+ * after the requested segment is pushed. Failure to push them is reported
+ * by WARNING only. Their .ready files are left alone: the server will call
+ * archive_command for them as usual, and push_wal_file() will find them
+ * already archived.
+ *
+ * If wal_index is true, pushed segments are added to the WAL index.
  * TODO: Planned options: list the arclog content,
  * compute and validate checksums.
  */
 int
-do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
+do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite,
+				int batch_size, bool wal_index)
 {
 	char		backup_wal_file_path[MAXPGPATH];
 	char		absolute_wal_file_path[MAXPGPATH];
+	char		pg_wal_dir[MAXPGPATH];
 	char		current_dir[MAXPGPATH];
 	uint64		system_id;
-	bool		is_compress = false;
+	parray	   *segments;
+	pthread_t  *threads;
+	archive_push_arg *threads_args;
+	int			nthreads;
+	int			i;
 
 	if (wal_file_name == NULL && wal_file_path == NULL)
 		elog(ERROR, "required parameters are not specified: --wal-file-name %%f --wal-file-path %%p");
@@ -65,28 +262,531 @@ do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
 	if (instance_config.compress_alg == PGLZ_COMPRESS)
 		elog(ERROR, "pglz compression is not supported");
 
-#ifdef HAVE_LIBZ
-	if (instance_config.compress_alg == ZLIB_COMPRESS)
-		is_compress = IsXLogFileName(wal_file_name);
-#endif
+	strncpy(pg_wal_dir, absolute_wal_file_path, MAXPGPATH);
+	get_parent_directory(pg_wal_dir);
+
+	/*
+	 * The requested segment is pushed first, its failure is fatal. It is
+	 * pushed alone, so zstd may use all the threads.
+	 */
+	push_segment(pg_wal_dir, wal_file_name, overwrite, wal_index,
+				 num_threads);
+
+	/* Only complete segments are looked ahead for */
+	if (batch_size > 1 && IsXLogFileName(wal_file_name))
+		segments = get_ready_segments(pg_wal_dir, wal_file_name,
+									  batch_size - 1);
+	else
+		segments = parray_new();
+
+	if (parray_num(segments) > 0)
+	{
+		elog(INFO, "Pushing %lu WAL segments ahead",
+			 (unsigned long) parray_num(segments));
+
+		nthreads = Min(num_threads, parray_num(segments));
+		threads = (pthread_t *) palloc(sizeof(pthread_t) * nthreads);
+		threads_args = (archive_push_arg *) palloc(sizeof(archive_push_arg) *
+												   nthreads);
+
+		for (i = 0; i < nthreads; i++)
+		{
+			archive_push_arg *arg = &(threads_args[i]);
+
+			arg->segments = segments;
+			arg->thread_num = i;
+			arg->nthreads = nthreads;
+			arg->pg_wal_dir = pg_wal_dir;
+			arg->overwrite = overwrite;
+			arg->wal_index = wal_index;
+			/* Share the threads between pushed segments and zstd */
+			arg->compress_threads = Max(num_threads / nthreads, 1);
+			/* By default there are some error */
+			arg->ret = 1;
+
+			pthread_create(&threads[i], NULL, archive_push_thread, arg);
+		}
+
+		for (i = 0; i < nthreads; i++)
+		{
+			pthread_join(threads[i], NULL);
+
+			/*
+			 * Failure to push segments ahead is not fatal, the server will
+			 * request them later.
+			 */
+			if (threads_args[i].ret == 1)
+				elog(WARNING, "Thread [%d]: Cannot push WAL segments ahead", i);
+		}
+
+		pfree(threads);
+		pfree(threads_args);
+	}
+
+	parray_walk(segments, free);
+	parray_free(segments);
 
-	push_wal_file(absolute_wal_file_path, backup_wal_file_path, is_compress,
-				  overwrite);
 	elog(INFO, "pg_probackup archive-push completed successfully");
 
 	return 0;
 }
 
+/*
+ * Index every nthreads-th job starting from thread_num.
+ */
+static void *
+index_wal_thread(void *arg)
+{
+	index_wal_arg *arguments = (index_wal_arg *) arg;
+	int			i;
+
+	for (i = arguments->thread_num; i < parray_num(arguments->jobs);
+		 i += arguments->nthreads)
+	{
+		index_wal_job *job = (index_wal_job *) parray_get(arguments->jobs, i);
+
+		arguments->nindexed += index_wal(arclog_path, job->tli,
+										 instance_config.xlog_seg_size,
+										 job->first_segno, job->last_segno);
+	}
+
+	/* All jobs of the thread are done */
+	arguments->ret = 0;
+
+	return NULL;
+}
+
+/*
+ * Add archived WAL segments of the instance, which are not indexed yet, to
+ * WAL indexes of their timelines. Segments are split into jobs of
+ * INDEX_WAL_JOB_SIZE segments which are processed in num_threads threads.
+ */
+int
+do_index_wal(void)
+{
+	DIR		   *dir;
+	struct dirent *de;
+	parray	   *timelines = parray_new();
+	parray	   *jobs = parray_new();
+	pthread_t  *threads;
+	index_wal_arg *threads_args;
+	int			nthreads;
+	int			nindexed = 0;
+	bool		index_isok = true;
+	int			i;
+
+	/* Find the first and the last archived segment of every timeline */
+	dir = opendir(arclog_path);
+	if (dir == NULL)
+		elog(ERROR, "Cannot open directory \"%s\": %s", arclog_path,
+			 strerror(errno));
+
+	while (errno = 0, (de = readdir(dir)) != NULL)
+	{
+		index_wal_job *timeline = NULL;
+		TimeLineID	tli;
+		XLogSegNo	segno;
+
+		if (!IsXLogFileName(de->d_name) &&
+			!IsCompressedXLogFileName(de->d_name))
+			continue;
+
+		GetXLogFromFileName(de->d_name, &tli, &segno,
+							instance_config.xlog_seg_size);
+
+		for (i = 0; i < parray_num(timelines); i++)
+		{
+			timeline = (index_wal_job *) parray_get(timelines, i);
+			if (timeline->tli == tli)
+				break;
+			timeline = NULL;
+		}
+
+		if (timeline == NULL)
+		{
+			timeline = pgut_new(index_wal_job);
+			timeline->tli = tli;
+			timeline->first_segno = segno;
+			timeline->last_segno = segno;
+			parray_append(timelines, timeline);
+		}
+		else
+		{
+			timeline->first_segno = Min(timeline->first_segno, segno);
+			timeline->last_segno = Max(timeline->last_segno, segno);
+		}
+	}
+
+	if (errno)
+		elog(ERROR, "Cannot read directory \"%s\": %s", arclog_path,
+			 strerror(errno));
+	closedir(dir);
+
+	for (i = 0; i < parray_num(timelines); i++)
+	{
+		index_wal_job *timeline = (index_wal_job *) parray_get(timelines, i);
+		XLogSegNo	segno;
+
+		for (segno = timeline->first_segno; segno <= timeline->last_segno;
+			 segno += INDEX_WAL_JOB_SIZE)
+		{
+			index_wal_job *job = pgut_new(index_wal_job);
+
+			job->tli = timeline->tli;
+			job->first_segno = segno;
+			job->last_segno = Min(segno + INDEX_WAL_JOB_SIZE - 1,
+								  timeline->last_segno);
+			parray_append(jobs, job);
+		}
+	}
+
+	elog(INFO, "Indexing WAL segments of %lu timelines",
+		 (unsigned long) parray_num(timelines));
+
+	nthreads = Max(Min(num_threads, parray_num(jobs)), 1);
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * nthreads);
+	threads_args = (index_wal_arg *) palloc(sizeof(index_wal_arg) * nthreads);
+
+	for (i = 0; i < nthreads; i++)
+	{
+		index_wal_arg *arg = &(threads_args[i]);
+
+		arg->jobs = jobs;
+		arg->thread_num = i;
+		arg->nthreads = nthreads;
+		arg->nindexed = 0;
+		/* By default there are some error */
+		arg->ret = 1;
+
+		pthread_create(&threads[i], NULL, index_wal_thread, arg);
+	}
+
+	for (i = 0; i < nthreads; i++)
+	{
+		pthread_join(threads[i], NULL);
+		if (threads_args[i].ret == 1)
+			index_isok = false;
+		nindexed += threads_args[i].nindexed;
+	}
+
+	pfree(threads);
+	pfree(threads_args);
+	parray_walk(jobs, pfree);
+	parray_free(jobs);
+	parray_walk(timelines, pfree);
+	parray_free(timelines);
+
+	if (!index_isok)
+		elog(ERROR, "WAL indexing failed");
+
+	elog(INFO, "%d WAL segments are indexed", nindexed);
+
+	return 0;
+}
+
+#ifndef WIN32
+/*
+ * Take the lock of the prefetch directory. Returns false if the directory is
+ * locked by another running archive-get.
+ */
+static bool
+prefetch_lock(const char *lock_path)
+{
+	int			fd;
+	char		buf[64];
+	int			len;
+
+	for (;;)
+	{
+		FILE	   *fp;
+		long		pid = 0;
+
+		fd = open(lock_path, O_RDWR | O_CREAT | O_EXCL, S_IRUSR | S_IWUSR);
+		if (fd >= 0)
+			break;
+		if (errno != EEXIST)
+		{
+			elog(WARNING, "Cannot create lock file \"%s\": %s",
+				 lock_path, strerror(errno));
+			return false;
+		}
+
+		/* Check if the owner of the lock is still alive */
+		fp = fopen(lock_path, "r");
+		if (fp != NULL)
+		{
+			if (fscanf(fp, "%ld", &pid) != 1)
+				pid = 0;
+			fclose(fp);
+		}
+		if (pid > 0 && (kill((pid_t) pid, 0) == 0 || errno != ESRCH))
+			return false;
+
+		/* The lock is stale */
+		if (unlink(lock_path) != 0 && errno != ENOENT)
+		{
+			elog(WARNING, "Cannot remove stale lock file \"%s\": %s",
+				 lock_path, strerror(errno));
+			return false;
+		}
+	}
+
+	len = snprintf(buf, sizeof(buf), "%ld\n", (long) getpid());
+	if (write(fd, buf, len) != len)
+	{
+		elog(WARNING, "Cannot write lock file \"%s\": %s",
+			 lock_path, strerror(errno));
+		close(fd);
+		unlink(lock_path);
+		return false;
+	}
+	close(fd);
+
+	return true;
+}
+
+/*
+ * Fetch up to "depth" WAL segments following wal_file_name on the same
+ * timeline into prefetch_dir.
+ *
+ * The prefetch directory holds only the segments of this window: other
+ * segments, which are already replayed or belong to another timeline, and
+ * leftovers of interrupted fetches are removed.
+ */
+static void
+prefetch_segments(const char *prefetch_dir, const char *wal_file_name,
+				  int depth)
+{
+	char		lock_path[MAXPGPATH];
+	TimeLineID	tli;
+	XLogSegNo	segno;
+	char	  (*window)[MAXFNAMELEN];
+	DIR		   *dir;
+	struct dirent *de;
+	int			i;
+
+	dir_create_dir(prefetch_dir, DIR_PERMISSION);
+
+	join_path_components(lock_path, prefetch_dir, PREFETCH_LOCK_FILE);
+	if (!prefetch_lock(lock_path))
+	{
+		elog(LOG, "WAL prefetch is already running");
+		return;
+	}
+
+	GetXLogFromFileName(wal_file_name, &tli, &segno,
+						instance_config.xlog_seg_size);
+
+	window = palloc(sizeof(*window) * depth);
+	for (i = 0; i < depth; i++)
+		GetXLogFileName(window[i], tli, segno + i + 1,
+						instance_config.xlog_seg_size);
+
+	/* Evict files outside of the window */
+	dir = opendir(prefetch_dir);
+	if (dir == NULL)
+		elog(ERROR, "Cannot open directory \"%s\": %s", prefetch_dir,
+			 strerror(errno));
+
+	while ((de = readdir(dir)) != NULL)
+	{
+		char		path[MAXPGPATH];
+		bool		keep = false;
+
+		if (strcmp(de->d_name, ".") == 0 || strcmp(de->d_name, "..") == 0 ||
+			strcmp(de->d_name, PREFETCH_LOCK_FILE) == 0)
+			continue;
+
+		for (i = 0; i < depth && !keep; i++)
+			keep = strcmp(de->d_name, window[i]) == 0;
+		if (keep)
+			continue;
+
+		join_path_components(path, prefetch_dir, de->d_name);
+		elog(VERBOSE, "Evicting \"%s\" from WAL prefetch directory", path);
+		if (unlink(path) != 0 && errno != ENOENT)
+			elog(WARNING, "Cannot remove file \"%s\": %s", path,
+				 strerror(errno));
+	}
+	closedir(dir);
+
+	/* Fetch the window in the order the segments will be requested */
+	for (i = 0; i < depth; i++)
+	{
+		char		from_path[MAXPGPATH];
+		char		to_path[MAXPGPATH];
+		char		compressed_path[MAXPGPATH];
+
+		if (interrupted)
+			break;
+
+		join_path_components(to_path, prefetch_dir, window[i]);
+		if (fileExists(to_path))
+			continue;
+
+		/* Stop at the first segment which is not archived yet */
+		join_path_components(from_path, arclog_path, window[i]);
+		if (!fileExists(from_path) &&
+			find_compressed_wal_file(from_path, compressed_path) == NONE_COMPRESS)
+			break;
+
+		elog(LOG, "Prefetching WAL segment \"%s\"", window[i]);
+		get_wal_file(from_path, to_path);
+	}
+
+	pfree(window);
+	unlink(lock_path);
+}
+
+/*
+ * Start prefetch of WAL segments following wal_file_name in background
+ * process, so that the server does not wait for it.
+ */
+static void
+start_prefetch(const char *prefetch_dir, const char *wal_file_name,
+			   int depth)
+{
+	pid_t		pid;
+
+	fflush(stdout);
+	fflush(stderr);
+
+	pid = fork();
+	if (pid < 0)
+	{
+		elog(WARNING, "Cannot start WAL prefetch: %s", strerror(errno));
+		return;
+	}
+	if (pid > 0)
+		/* Parent returns to the server at once */
+		return;
+
+	/* Detach from the session of the server */
+	setsid();
+	prefetch_segments(prefetch_dir, wal_file_name, depth);
+	exit(0);
+}
+
+/*
+ * Move prefetched WAL segment into to_path. Returns false if the segment
+ * was not prefetched.
+ */
+static bool
+get_prefetched_segment(const char *prefetch_dir, const char *wal_file_name,
+					   const char *to_path)
+{
+	char		prefetched_path[MAXPGPATH];
+
+	join_path_components(prefetched_path, prefetch_dir, wal_file_name);
+	if (!fileExists(prefetched_path))
+		return false;
+
+	if (rename(prefetched_path, to_path) != 0)
+	{
+		elog(WARNING, "Cannot rename WAL file \"%s\" to \"%s\": %s",
+			 prefetched_path, to_path, strerror(errno));
+		return false;
+	}
+
+	elog(INFO, "pg_probackup archive-get took prefetched WAL segment \"%s\"",
+		 prefetched_path);
+	return true;
+}
+
+/*
+ * Remove prefetched WAL segments which will not be requested, it is called
+ * when wal_file_name is not prefetched. If the requested segment is not
+ * archived, the end of the archive is reached and recovery is going to end
+ * or switch the timeline, so the whole prefetch directory is removed.
+ * Otherwise only segments of other timelines are removed, which are left
+ * after a timeline switch.
+ */
+static void
+clean_prefetch_dir(const char *prefetch_dir, const char *wal_file_name,
+				   bool end_of_archive)
+{
+	char		lock_path[MAXPGPATH];
+	DIR		   *dir;
+	struct dirent *de;
+	int			i;
+
+	dir = opendir(prefetch_dir);
+	if (dir == NULL)
+	{
+		if (errno != ENOENT)
+			elog(WARNING, "Cannot open directory \"%s\": %s", prefetch_dir,
+				 strerror(errno));
+		return;
+	}
+
+	/*
+	 * Do not remove segments from under running prefetch. At the end of the
+	 * archive it has nothing to fetch and finishes soon, so wait for it a
+	 * bit, there will be no more calls to clean the directory.
+	 */
+	join_path_components(lock_path, prefetch_dir, PREFETCH_LOCK_FILE);
+	for (i = 0; !prefetch_lock(lock_path); i++)
+	{
+		if (!end_of_archive || i >= PREFETCH_LOCK_RETRIES)
+		{
+			closedir(dir);
+			elog(LOG, "WAL prefetch is running, prefetch directory is not cleaned");
+			return;
+		}
+		pg_usleep(100000L);		/* 100 ms */
+	}
+
+	while ((de = readdir(dir)) != NULL)
+	{
+		char		path[MAXPGPATH];
+
+		if (strcmp(de->d_name, ".") == 0 || strcmp(de->d_name, "..") == 0 ||
+			strcmp(de->d_name, PREFETCH_LOCK_FILE) == 0)
+			continue;
+
+		/* Timeline is the first 8 characters of segment name */
+		if (!end_of_archive && strncmp(de->d_name, wal_file_name, 8) == 0)
+			continue;
+
+		join_path_components(path, prefetch_dir, de->d_name);
+		elog(VERBOSE, "Evicting \"%s\" from WAL prefetch directory", path);
+		if (unlink(path) != 0 && errno != ENOENT)
+			elog(WARNING, "Cannot remove file \"%s\": %s", path,
+				 strerror(errno));
+	}
+	closedir(dir);
+
+	unlink(lock_path);
+
+	if (end_of_archive)
+	{
+		elog(LOG, "Removing WAL prefetch directory \"%s\"", prefetch_dir);
+		if (rmdir(prefetch_dir) != 0 && errno != ENOENT)
+			elog(WARNING, "Cannot remove directory \"%s\": %s", prefetch_dir,
+				 strerror(errno));
+	}
+}
+#endif
+
 /*
  * pg_probackup specific restore command.
  * Move files from arclog_path to pgdata/wal_file_path.
+ *
+ * If prefetch_depth is greater than 0, the next prefetch_depth segments are
+ * fetched into PREFETCH_DIR subdirectory of the WAL directory in background,
+ * and next calls only move them into place. The directory is removed when
+ * the requested segment is not archived, so that prefetched segments do not
+ * stay in the WAL directory after recovery ends.
  */
 int
-do_archive_get(char *wal_file_path, char *wal_file_name)
+do_archive_get(char *wal_file_path, char *wal_file_name, int prefetch_depth)
 {
 	char		backup_wal_file_path[MAXPGPATH];
 	char		absolute_wal_file_path[MAXPGPATH];
 	char		current_dir[MAXPGPATH];
+	char		prefetch_dir[MAXPGPATH];
+	bool		use_prefetch = false;
+	bool		prefetched = false;
 
 	if (wal_file_name == NULL && wal_file_path == NULL)
 		elog(ERROR, "required parameters are not specified: --wal-file-name %%f --wal-file-path %%p");
@@ -103,10 +803,47 @@ do_archive_get(char *wal_file_path, char *wal_file_name)
 	join_path_components(absolute_wal_file_path, current_dir, wal_file_path);
 	join_path_components(backup_wal_file_path, arclog_path, wal_file_name);
 
-	elog(INFO, "pg_probackup archive-get from %s to %s",
-		 backup_wal_file_path, absolute_wal_file_path);
-	get_wal_file(backup_wal_file_path, absolute_wal_file_path);
+#ifndef WIN32
+	/* Only complete segments are prefetched */
+	if (prefetch_depth > 0 && IsXLogFileName(wal_file_name))
+	{
+		use_prefetch = true;
+		strncpy(prefetch_dir, absolute_wal_file_path, MAXPGPATH);
+		get_parent_directory(prefetch_dir);
+		join_path_components(prefetch_dir, prefetch_dir, PREFETCH_DIR);
+	}
+#endif
+
+#ifndef WIN32
+	if (use_prefetch)
+	{
+		prefetched = get_prefetched_segment(prefetch_dir, wal_file_name,
+											absolute_wal_file_path);
+		if (!prefetched)
+		{
+			char		compressed_path[MAXPGPATH];
+			bool		end_of_archive;
+
+			end_of_archive = !fileExists(backup_wal_file_path) &&
+				find_compressed_wal_file(backup_wal_file_path,
+										 compressed_path) == NONE_COMPRESS;
+			clean_prefetch_dir(prefetch_dir, wal_file_name, end_of_archive);
+		}
+	}
+#endif
+
+	if (!prefetched)
+	{
+		elog(INFO, "pg_probackup archive-get from %s to %s",
+			 backup_wal_file_path, absolute_wal_file_path);
+		get_wal_file(backup_wal_file_path, absolute_wal_file_path);
+	}
 	elog(INFO, "pg_probackup archive-get completed successfully");
 
+#ifndef WIN32
+	if (use_prefetch)
+		start_prefetch(prefetch_dir, wal_file_name, prefetch_depth);
+#endif
+
 	return 0;
 }
@@ -48,9 +48,6 @@ const char *progname = "pg_probackup";
 /* list of files contained in backup */
 static parray *backup_files_list = NULL;
 
-/* We need critical section for datapagemap_add() in case of using threads */
-static pthread_mutex_t backup_pagemap_mutex = PTHREAD_MUTEX_INITIALIZER;
-
 /*
  * We need to wait end of WAL streaming before execute pg_stop_backup().
  */
@@ -478,7 +475,7 @@ do_backup_instance(void)
 	bool		backup_isok = true;
 
 	pgBackup   *prev_backup = NULL;
-	parray	   *prev_backup_filelist = NULL;
+	FileList   *prev_backup_filelist = NULL;
 	parray	   *backup_list = NULL;
 
 	pgFile	   *pg_control = NULL;
@@ -537,7 +534,7 @@ do_backup_instance(void)
 		pgBackupGetPath(prev_backup, prev_backup_filelist_path,
 						lengthof(prev_backup_filelist_path), DATABASE_FILE_LIST);
 		/* Files of previous backup needed by DELTA backup */
-		prev_backup_filelist = dir_read_file_list(NULL, prev_backup_filelist_path);
+		prev_backup_filelist = file_list_open(prev_backup_filelist_path);
 
 		/* If lsn is not NULL, only pages with higher lsn will be copied. */
 		prev_backup_start_lsn = prev_backup->start_lsn;
@@ -722,9 +719,6 @@ do_backup_instance(void)
 
 	/* Sort by size for load balancing */
 	parray_qsort(backup_files_list, pgFileCompareSize);
-	/* Sort the array for binary search */
-	if (prev_backup_filelist)
-		parray_qsort(prev_backup_filelist, pgFileComparePath);
 
 	/* init thread args with own file lists */
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
@@ -741,10 +735,20 @@ do_backup_instance(void)
 		arg->prev_start_lsn = prev_backup_start_lsn;
 		arg->backup_conn = NULL;
 		arg->cancel_conn = NULL;
+		arg->pglz_state = NULL;
 		/* By default there are some error */
 		arg->ret = 1;
 	}
 
+	/*
+	 * Start compression workers, they compress pages read by the threads
+	 * below.
+	 */
+	if (num_compress_threads > 0 &&
+		current.compress_alg != NONE_COMPRESS &&
+		current.compress_alg != NOT_DEFINED_COMPRESS)
+		compress_pool_start(num_compress_threads);
+
 	/* Run threads */
 	elog(INFO, "Start transfering data files");
 	for (i = 0; i < num_threads; i++)
@@ -765,7 +769,10 @@ do_backup_instance(void)
 		pthread_join(threads[i], NULL);
 		if (threads_args[i].ret == 1)
 			backup_isok = false;
+		if (threads_args[i].pglz_state)
+			free(threads_args[i].pglz_state);
 	}
+	compress_pool_stop();
 	if (backup_isok)
 		elog(INFO, "Data files are transfered");
 	else
@@ -786,10 +793,7 @@ do_backup_instance(void)
 
 	/* clean previous backup file list */
 	if (prev_backup_filelist)
-	{
-		parray_walk(prev_backup_filelist, pgFileFree);
-		parray_free(prev_backup_filelist);
-	}
+		file_list_close(prev_backup_filelist);
 
 	/* In case of backup from replica >= 9.6 we must fix minRecPoint,
 	 * First we must find pg_control in backup_files_list.
@@ -1561,10 +1565,7 @@ wait_wal_lsn(XLogRecPtr lsn, bool is_start_lsn, bool wait_prev_segment)
 	bool		file_exists = false;
 	uint32		try_count = 0,
 				timeout;
-
-#ifdef HAVE_LIBZ
-	char		gz_wal_segment_path[MAXPGPATH];
-#endif
+	char		compressed_wal_segment_path[MAXPGPATH];
 
 	tli = get_current_timeline(false);
 
@@ -1607,11 +1608,6 @@ wait_wal_lsn(XLogRecPtr lsn, bool is_start_lsn, bool wait_prev_segment)
 		elog(LOG, "Looking for LSN %X/%X in segment: %s",
 			 (uint32) (lsn >> 32), (uint32) lsn, wal_segment);
 
-#ifdef HAVE_LIBZ
-	snprintf(gz_wal_segment_path, sizeof(gz_wal_segment_path), "%s.gz",
-			 wal_segment_path);
-#endif
-
 	/* Wait until target LSN is archived or streamed */
 	while (true)
 	{
@@ -1622,11 +1618,11 @@ wait_wal_lsn(XLogRecPtr lsn, bool is_start_lsn, bool wait_prev_segment)
 			/* Try to find compressed WAL file */
 			if (!file_exists)
 			{
-#ifdef HAVE_LIBZ
-				file_exists = fileExists(gz_wal_segment_path);
+				file_exists = find_compressed_wal_file(wal_segment_path,
+								compressed_wal_segment_path) != NONE_COMPRESS;
 				if (file_exists)
-					elog(LOG, "Found compressed WAL segment: %s", wal_segment_path);
-#endif
+					elog(LOG, "Found compressed WAL segment: %s",
+						 compressed_wal_segment_path);
 			}
 			else
 				elog(LOG, "Found WAL segment: %s", wal_segment_path);
@@ -2279,20 +2275,17 @@ backup_files(void *arg)
 
 		if (S_ISREG(buf.st_mode))
 		{
-			pgFile	  **prev_file = NULL;
+			int			prev_file = -1;
 
 			/* Check that file exist in previous backup */
 			if (current.backup_mode != BACKUP_MODE_FULL)
 			{
 				char	   *relative;
-				pgFile		key;
 
 				relative = GetRelativePath(file->path, arguments->from_root);
-				key.path = relative;
 
-				prev_file = (pgFile **) parray_bsearch(arguments->prev_filelist,
-													   &key, pgFileComparePath);
-				if (prev_file)
+				prev_file = file_list_find(arguments->prev_filelist, relative);
+				if (prev_file >= 0)
 					/* File exists in previous backup */
 					file->exists_in_prev = true;
 			}
@@ -2326,12 +2319,13 @@ backup_files(void *arg)
 				bool		skip = false;
 
 				/* If non-data file has not changed since last backup... */
-				if (prev_file && file->exists_in_prev &&
+				if (prev_file >= 0 && file->exists_in_prev &&
 					buf.st_mtime < current.parent_backup)
 				{
 					calc_file_checksum(file);
 					/* ...and checksum is the same... */
-					if (EQ_TRADITIONAL_CRC32(file->crc, (*prev_file)->crc))
+					if (EQ_TRADITIONAL_CRC32(file->crc,
+							file_list_get_crc(arguments->prev_filelist, prev_file)))
 						skip = true; /* ...skip copying file. */
 				}
 				if (skip ||
@@ -2500,22 +2494,22 @@ set_cfs_datafiles(parray *files, const char *root, char *relative, size_t i)
 }
 
 /*
- * Find pgfile by given rnode in the backup_files_list
- * and add given blkno to its pagemap.
+ * Find pgfile by given rnode and segment number in the backup_files_list
+ * and add blocks of the given pagemap to its pagemap.
+ *
+ * WAL reader threads collect pagemaps of segments on their own, so it is
+ * called once per segment and thread after the threads are finished and
+ * no locking is needed.
  */
 void
-process_block_change(ForkNumber forknum, RelFileNode rnode, BlockNumber blkno)
+process_block_changes(ForkNumber forknum, RelFileNode rnode,
+					  BlockNumber segno, datapagemap_t *pagemap)
 {
 	char	   *path;
 	char	   *rel_path;
-	BlockNumber blkno_inseg;
-	int			segno;
 	pgFile	  **file_item;
 	pgFile		f;
 
-	segno = blkno / RELSEG_SIZE;
-	blkno_inseg = blkno % RELSEG_SIZE;
-
 	rel_path = relpathperm(rnode, forknum);
 	if (segno > 0)
 		path = psprintf("%s/%s.%u", instance_config.pgdata, rel_path, segno);
@@ -2537,14 +2531,20 @@ process_block_change(ForkNumber forknum, RelFileNode rnode, BlockNumber blkno)
 	 */
 	if (file_item)
 	{
-		/* We need critical section only we use more than one threads */
-		if (num_threads > 1)
-			pthread_lock(&backup_pagemap_mutex);
+		datapagemap_t *file_pagemap = &(*file_item)->pagemap;
+		int			i;
 
-		datapagemap_add(&(*file_item)->pagemap, blkno_inseg);
+		if (pagemap->bitmapsize > file_pagemap->bitmapsize)
+		{
+			file_pagemap->bitmap = pg_realloc(file_pagemap->bitmap,
+											  pagemap->bitmapsize);
+			memset(file_pagemap->bitmap + file_pagemap->bitmapsize, 0,
+				   pagemap->bitmapsize - file_pagemap->bitmapsize);
+			file_pagemap->bitmapsize = pagemap->bitmapsize;
+		}
 
-		if (num_threads > 1)
-			pthread_mutex_unlock(&backup_pagemap_mutex);
+		for (i = 0; i < pagemap->bitmapsize; i++)
+			file_pagemap->bitmap[i] |= pagemap->bitmap[i];
 	}
 
 	pg_free(path);
@@ -19,6 +19,8 @@
 
 static const char *backupModes[] = {"", "PAGE", "PTRACK", "DELTA", "FULL"};
 static pgBackup *readBackupControlFile(const char *path);
+static bool write_backup_control_file(const char *conf_path, pgBackup *backup,
+									  int elevel);
 
 static bool exit_hook_registered = false;
 static parray *lock_files = NULL;
@@ -82,6 +84,30 @@ write_backup_status(pgBackup *backup, BackupStatus status)
 	pgBackupFree(tmp);
 }
 
+/*
+ * Save the backup status into control file "conf_path". Unlike
+ * write_backup_status() the path does not depend on the current instance, so
+ * backups of several instances can be updated in one pass, and backup in
+ * memory is not changed. Failures are reported as WARNING, the caller decides
+ * what to do, which allows to call it from a thread holding a mutex.
+ */
+bool
+write_backup_status_file(const char *conf_path, BackupStatus status)
+{
+	pgBackup   *tmp;
+	bool		result;
+
+	tmp = readBackupControlFile(conf_path);
+	if (tmp == NULL)
+		return false;
+
+	tmp->status = status;
+	result = write_backup_control_file(conf_path, tmp, WARNING);
+
+	pgBackupFree(tmp);
+	return result;
+}
+
 /*
  * Create exclusive lockfile in the backup's directory.
  */
@@ -569,22 +595,41 @@ pgBackupWriteControl(FILE *out, pgBackup *backup)
 void
 write_backup(pgBackup *backup)
 {
-	FILE   *fp = NULL;
 	char	conf_path[MAXPGPATH];
 
 	pgBackupGetPath(backup, conf_path, lengthof(conf_path), BACKUP_CONTROL_FILE);
+	write_backup_control_file(conf_path, backup, ERROR);
+}
+
+/*
+ * Save the backup content into control file "conf_path".
+ * Failures are reported with "elevel", returns false if elevel allows it.
+ */
+static bool
+write_backup_control_file(const char *conf_path, pgBackup *backup, int elevel)
+{
+	FILE   *fp = NULL;
+
 	fp = fopen(conf_path, "wt");
 	if (fp == NULL)
-		elog(ERROR, "Cannot open configuration file \"%s\": %s", conf_path,
+	{
+		elog(elevel, "Cannot open configuration file \"%s\": %s", conf_path,
 			 strerror(errno));
+		return false;
+	}
 
 	pgBackupWriteControl(fp, backup);
 
 	if (fflush(fp) != 0 ||
 		fsync(fileno(fp)) != 0 ||
 		fclose(fp))
-		elog(ERROR, "Cannot write configuration file \"%s\": %s",
+	{
+		elog(elevel, "Cannot write configuration file \"%s\": %s",
 			 conf_path, strerror(errno));
+		return false;
+	}
+
+	return true;
 }
 
 /*
@@ -598,12 +643,12 @@ write_backup_filelist(pgBackup *backup, parray *files, const char *root)
 
 	pgBackupGetPath(backup, path, lengthof(path), DATABASE_FILE_LIST);
 
-	fp = fopen(path, "wt");
+	fp = fopen(path, PG_BINARY_W);
 	if (fp == NULL)
 		elog(ERROR, "Cannot open file list \"%s\": %s", path,
 			strerror(errno));
 
-	print_file_list(fp, files, root);
+	print_file_list_binary(fp, files, root);
 
 	if (fflush(fp) != 0 ||
 		fsync(fileno(fp)) != 0 ||
@@ -825,6 +870,10 @@ parse_compress_alg(const char *arg)
 		return ZLIB_COMPRESS;
 	else if (pg_strncasecmp("pglz", arg, len) == 0)
 		return PGLZ_COMPRESS;
+	else if (pg_strncasecmp("zstd", arg, len) == 0)
+		return ZSTD_COMPRESS;
+	else if (pg_strncasecmp("lz4", arg, len) == 0)
+		return LZ4_COMPRESS;
 	else if (pg_strncasecmp("none", arg, len) == 0)
 		return NONE_COMPRESS;
 	else
@@ -845,6 +894,10 @@ deparse_compress_alg(int alg)
 			return "zlib";
 		case PGLZ_COMPRESS:
 			return "pglz";
+		case ZSTD_COMPRESS:
+			return "zstd";
+		case LZ4_COMPRESS:
+			return "lz4";
 	}
 
 	return NULL;
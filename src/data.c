@@ -14,6 +14,7 @@
 #include "storage/checksum_impl.h"
 #include <common/pg_lzcompress.h>
 
+#include <fcntl.h>
 #include <unistd.h>
 
 #include <sys/stat.h>
@@ -21,6 +22,14 @@
 #ifdef HAVE_LIBZ
 #include <zlib.h>
 #endif
+#ifdef HAVE_LIBZSTD
+#include <zstd.h>
+#endif
+#ifdef HAVE_LIBLZ4
+#include <lz4.h>
+#include <lz4hc.h>
+#include <lz4frame.h>
+#endif
 
 /* Union to ease operations on relation pages */
 typedef union DataPage
@@ -56,13 +65,89 @@ zlib_decompress(void *dst, size_t dst_size, void const *src, size_t src_size)
 }
 #endif
 
+#ifdef HAVE_LIBZSTD
+/* Implementation of zstd compression method */
+static int32
+zstd_compress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			  int level, const char **errormsg)
+{
+	size_t		rc = ZSTD_compress(dst, dst_size, src, src_size, level);
+
+	if (ZSTD_isError(rc))
+	{
+		if (errormsg)
+			*errormsg = ZSTD_getErrorName(rc);
+		return -1;
+	}
+	return rc;
+}
+
+/* Implementation of zstd compression method */
+static int32
+zstd_decompress(void *dst, size_t dst_size, void const *src, size_t src_size,
+				const char **errormsg)
+{
+	size_t		rc = ZSTD_decompress(dst, dst_size, src, src_size);
+
+	if (ZSTD_isError(rc))
+	{
+		if (errormsg)
+			*errormsg = ZSTD_getErrorName(rc);
+		return -1;
+	}
+	return rc;
+}
+#endif
+
+#ifdef HAVE_LIBLZ4
+/* Implementation of lz4 compression method */
+static int32
+lz4_compress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			 int level, const char **errormsg)
+{
+	int			rc;
+
+	/* Level 1 and lower is the fast mode, higher levels use lz4hc */
+	if (level <= 1)
+		rc = LZ4_compress_default(src, dst, src_size, dst_size);
+	else
+		rc = LZ4_compress_HC(src, dst, src_size, dst_size, level);
+
+	if (rc <= 0)
+	{
+		if (errormsg)
+			*errormsg = "LZ4 compression failed";
+		return -1;
+	}
+	return rc;
+}
+
+/* Implementation of lz4 compression method */
+static int32
+lz4_decompress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			   const char **errormsg)
+{
+	int			rc = LZ4_decompress_safe(src, dst, src_size, dst_size);
+
+	if (rc < 0)
+	{
+		if (errormsg)
+			*errormsg = "LZ4 data is corrupted";
+		return -1;
+	}
+	return rc;
+}
+#endif
+
 /*
  * Compresses source into dest using algorithm. Returns the number of bytes
  * written in the destination buffer, or -1 if compression fails.
+ * pglz_state is used only by pglz.
  */
 static int32
 do_compress(void* dst, size_t dst_size, void const* src, size_t src_size,
-			CompressAlg alg, int level, const char **errormsg)
+			CompressAlg alg, int level, PGLZ_State *pglz_state,
+			const char **errormsg)
 {
 	switch (alg)
 	{
@@ -78,9 +163,22 @@ do_compress(void* dst, size_t dst_size, void const* src, size_t src_size,
 					*errormsg = zError(ret);
 				return ret;
 			}
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return zstd_compress(dst, dst_size, src, src_size, level,
+								 errormsg);
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return lz4_compress(dst, dst_size, src, src_size, level,
+								errormsg);
 #endif
 		case PGLZ_COMPRESS:
-			return pglz_compress(src, src_size, dst, PGLZ_strategy_always);
+			return pglz_compress_reentrant(src, src_size, dst,
+										   PGLZ_strategy_always, pglz_state);
+		default:
+			break;
 	}
 
 	return -1;
@@ -110,9 +208,21 @@ do_decompress(void* dst, size_t dst_size, void const* src, size_t src_size,
 					*errormsg = zError(ret);
 				return ret;
 			}
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return zstd_decompress(dst, dst_size, src, src_size, errormsg);
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return lz4_decompress(dst, dst_size, src, src_size, errormsg);
 #endif
 		case PGLZ_COMPRESS:
 			return pglz_decompress(src, src_size, dst, dst_size);
+		default:
+			if (errormsg)
+				*errormsg = "This build does not support the compression algorithm";
+			break;
 	}
 
 	return -1;
@@ -180,6 +290,16 @@ typedef struct BackupPageHeader
 #define PageIsTruncated -2
 #define SkipCurrentPage -3
 
+/* Number of blocks read at once by backup_data_file() */
+#define BACKUP_BATCH_BLOCKS 64
+
+/* Iterator over runs of consecutive blocks set in datapagemap_t */
+typedef struct datapagemap_range_iterator
+{
+	datapagemap_t *map;
+	BlockNumber	nextblkno;		/* block to start the next search from */
+} datapagemap_range_iterator_t;
+
 /* Verify page's header */
 static bool
 parse_page(Page page, XLogRecPtr *lsn)
@@ -426,19 +546,27 @@ prepare_page(backup_files_arg *arguments,
 	return 0;
 }
 
-static void
-compress_and_backup_page(pgFile *file, BlockNumber blknum,
-						FILE *in, FILE *out, pg_crc32 *crc,
-						int page_state, Page page,
-						CompressAlg calg, int clevel)
+/*
+ * Compress the page and put it with BackupPageHeader into write_buffer,
+ * which must have room for BLCKSZ + sizeof(BackupPageHeader) bytes.
+ * Returns number of bytes put into write_buffer.
+ *
+ * The file is used only for messages, so the function may be called by
+ * compression workers concurrently with the reader of the file.
+ * pglz_state is the scratch space of the calling thread, it is required for
+ * pglz compression only.
+ */
+static size_t
+compress_page(pgFile *file, BlockNumber blknum, char *write_buffer,
+			  int page_state, Page page, CompressAlg calg, int clevel,
+			  PGLZ_State *pglz_state)
 {
 	BackupPageHeader header;
 	size_t		write_buffer_size = sizeof(header);
-	char		write_buffer[BLCKSZ+sizeof(header)];
 	char		compressed_page[BLCKSZ*2]; /* compressed page may require more space than uncompressed */
 
 	if(page_state == SkipCurrentPage)
-		return;
+		return 0;
 
 	header.block = blknum;
 	header.compressed_size = page_state;
@@ -458,15 +586,12 @@ compress_and_backup_page(pgFile *file, BlockNumber blknum,
 		/* The page was not truncated, so we need to compress it */
 		header.compressed_size = do_compress(compressed_page, sizeof(compressed_page),
 											 page, BLCKSZ, calg, clevel,
-											 &errormsg);
+											 pglz_state, &errormsg);
 		/* Something went wrong and errormsg was assigned, throw a warning */
 		if (header.compressed_size < 0 && errormsg != NULL)
 			elog(WARNING, "An error occured during compressing block %u of file \"%s\": %s",
 				 blknum, file->path, errormsg);
 
-		file->compress_alg = calg;
-		file->read_size += BLCKSZ;
-
 		/* The page was successfully compressed. */
 		if (header.compressed_size > 0 && header.compressed_size < BLCKSZ)
 		{
@@ -488,6 +613,29 @@ compress_and_backup_page(pgFile *file, BlockNumber blknum,
 	/* elog(VERBOSE, "backup blkno %u, compressed_size %d write_buffer_size %ld",
 				  blknum, header.compressed_size, write_buffer_size); */
 
+	return write_buffer_size;
+}
+
+static void
+compress_and_backup_page(pgFile *file, BlockNumber blknum,
+						FILE *in, FILE *out, pg_crc32 *crc,
+						int page_state, Page page,
+						CompressAlg calg, int clevel, PGLZ_State *pglz_state)
+{
+	char		write_buffer[BLCKSZ+sizeof(BackupPageHeader)];
+	size_t		write_buffer_size;
+
+	write_buffer_size = compress_page(file, blknum, write_buffer, page_state,
+									  page, calg, clevel, pglz_state);
+	if (write_buffer_size == 0)
+		return;
+
+	if (page_state != PageIsTruncated)
+	{
+		file->compress_alg = calg;
+		file->read_size += BLCKSZ;
+	}
+
 	/* Update CRC */
 	COMP_FILE_CRC32(true, *crc, write_buffer, write_buffer_size);
 
@@ -506,157 +654,765 @@ compress_and_backup_page(pgFile *file, BlockNumber blknum,
 }
 
 /*
- * Backup data file in the from_root directory to the to_root directory with
- * same relative path. If prev_backup_start_lsn is not NULL, only pages with
- * higher lsn will be copied.
- * Not just copy file, but read it block by block (use bitmap in case of
- * incremental backup), validate checksum, optionally compress and write to
- * backup with special header.
+ * Read up to "count" blocks starting from "blknum" into "buf".
+ * Returns number of bytes read, which is less than requested if the file
+ * was truncated concurrently.
  */
-bool
-backup_data_file(backup_files_arg* arguments,
-				 const char *to_path, pgFile *file,
-				 XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
-				 CompressAlg calg, int clevel)
+static size_t
+read_blocks_from_file(pgFile *file, FILE *in, BlockNumber blknum,
+					  BlockNumber count, char *buf)
 {
-	FILE		*in;
-	FILE		*out;
-	BlockNumber	blknum = 0;
-	BlockNumber	nblocks = 0;
-	int			n_blocks_skipped = 0;
-	int			n_blocks_read = 0;
-	int			page_state;
-	char		curr_page[BLCKSZ];
+	off_t		offset = (off_t) blknum * BLCKSZ;
+	size_t		len = (size_t) count * BLCKSZ;
+	size_t		read_len = 0;
 
-	/*
-	 * Skip unchanged file only if it exists in previous backup.
-	 * This way we can correctly handle null-sized files which are
-	 * not tracked by pagemap and thus always marked as unchanged.
-	 */
-	if ((backup_mode == BACKUP_MODE_DIFF_PAGE ||
-		backup_mode == BACKUP_MODE_DIFF_PTRACK) &&
-		file->pagemap.bitmapsize == PageBitmapIsEmpty &&
-		file->exists_in_prev && !file->pagemap_isabsent)
+#ifndef WIN32
+	while (read_len < len)
 	{
-		/*
-		 * There are no changed blocks since last backup. We want make
-		 * incremental backup, so we should exit.
-		 */
-		elog(VERBOSE, "Skipping the unchanged file: %s", file->path);
-		return false;
+		ssize_t		rc = pread(fileno(in), buf + read_len, len - read_len,
+							   offset + read_len);
+
+		if (rc < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			elog(ERROR, "File: %s, could not read block %u: %s",
+				 file->path, blknum, strerror(errno));
+		}
+		/* End of file */
+		if (rc == 0)
+			break;
+		read_len += rc;
 	}
+#else
+	if (fseek(in, offset, SEEK_SET) != 0)
+		elog(ERROR, "File: %s, could not seek to block %u: %s",
+			 file->path, blknum, strerror(errno));
+	read_len = fread(buf, 1, len, in);
+#endif
 
-	/* reset size summary */
-	file->read_size = 0;
-	file->write_size = 0;
-	INIT_FILE_CRC32(true, file->crc);
+	return read_len;
+}
 
-	/* open backup mode file for read */
-	in = fopen(file->path, PG_BINARY_R);
-	if (in == NULL)
+/*
+ * Check the page read by read_blocks_from_file() the same way as
+ * read_page_from_file() does, but quietly: the caller rereads invalid pages
+ * with prepare_page(), which complains and retries.
+ */
+static bool
+batch_page_is_valid(pgFile *file, BlockNumber blknum, Page page,
+					XLogRecPtr *page_lsn)
+{
+	if (!parse_page(page, page_lsn))
 	{
-		FIN_FILE_CRC32(true, file->crc);
+		int			i;
 
-		/*
-		 * If file is not found, this is not en error.
-		 * It could have been deleted by concurrent postgres transaction.
-		 */
-		if (errno == ENOENT)
-		{
-			elog(LOG, "File \"%s\" is not found", file->path);
-			file->write_size = FILE_NOT_FOUND;
-			return false;
-		}
+		/* Zeroed page is valid */
+		for (i = 0; i < BLCKSZ && page[i] == 0; i++);
 
-		elog(ERROR, "cannot open file \"%s\": %s",
-			 file->path, strerror(errno));
+		return i == BLCKSZ;
 	}
 
-	if (file->size % BLCKSZ != 0)
+	if (current.checksum_version &&
+		pg_checksum_page(page, file->segno * RELSEG_SIZE + blknum) !=
+		((PageHeader) page)->pd_checksum)
+		return false;
+
+	return true;
+}
+
+/*
+ * Find next run of consecutive blocks set in the pagemap, starting the search
+ * from iter->nextblkno. The run is limited to max_count blocks.
+ * Returns false if there are no more blocks set.
+ */
+static bool
+datapagemap_next_range(datapagemap_range_iterator_t *iter,
+					   BlockNumber *start, BlockNumber *count,
+					   BlockNumber max_count)
+{
+	datapagemap_t *map = iter->map;
+	BlockNumber	blkno = iter->nextblkno;
+	BlockNumber	maxblkno = (BlockNumber) map->bitmapsize * 8;
+
+#define BLOCK_IS_SET(blk) ((map->bitmap[(blk) / 8] & (1 << ((blk) % 8))) != 0)
+
+	/* Find the first set bit, skipping empty bytes at once */
+	while (blkno < maxblkno)
 	{
-		fclose(in);
-		elog(ERROR, "File: %s, invalid file size %zu", file->path, file->size);
+		if (blkno % 8 == 0 && map->bitmap[blkno / 8] == 0)
+			blkno += 8;
+		else if (BLOCK_IS_SET(blkno))
+			break;
+		else
+			blkno++;
 	}
 
-	/*
-	 * Compute expected number of blocks in the file.
-	 * NOTE This is a normal situation, if the file size has changed
-	 * since the moment we computed it.
-	 */
-	nblocks = file->size/BLCKSZ;
+	if (blkno >= maxblkno)
+	{
+		iter->nextblkno = maxblkno;
+		return false;
+	}
 
-	/* open backup file for write  */
-	out = fopen(to_path, PG_BINARY_W);
-	if (out == NULL)
+	*start = blkno;
+	*count = 0;
+	while (blkno < maxblkno && *count < max_count && BLOCK_IS_SET(blkno))
 	{
-		int errno_tmp = errno;
-		fclose(in);
-		elog(ERROR, "cannot open backup file \"%s\": %s",
-			 to_path, strerror(errno_tmp));
+		blkno++;
+		(*count)++;
 	}
 
-	/*
-	 * Read each page, verify checksum and write it to backup.
-	 * If page map is empty or file is not present in previous backup
-	 * backup all pages of the relation.
-	 *
-	 * We will enter here if backup_mode is FULL or DELTA.
-	 */
-	if (file->pagemap.bitmapsize == PageBitmapIsEmpty ||
-		file->pagemap_isabsent || !file->exists_in_prev)
+#undef BLOCK_IS_SET
+
+	iter->nextblkno = blkno;
+	return true;
+}
+
+/*
+ * Read "count" blocks starting from "start" by one large read and check them.
+ * Pages which fail the check are reread by prepare_page(). The page states
+ * are put into page_states, the same as prepare_page() returns.
+ *
+ * Returns number of processed blocks, which is less than "count" if the file
+ * turned out to be truncated: the last processed page is PageIsTruncated.
+ */
+static BlockNumber
+read_block_range(backup_files_arg *arguments, pgFile *file, FILE *in,
+				 XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
+				 BlockNumber start, BlockNumber count, BlockNumber nblocks,
+				 int *n_blocks_skipped, char *pages, int *page_states)
+{
+	BlockNumber	nread;
+	BlockNumber	i;
+
+	/* check for interrupt */
+	if (interrupted)
+		elog(ERROR, "Interrupted during backup");
+
+	nread = read_blocks_from_file(file, in, start, count, pages) / BLCKSZ;
+
+	for (i = 0; i < count; i++)
 	{
-		for (blknum = 0; blknum < nblocks; blknum++)
+		Page		page = pages + i * BLCKSZ;
+		XLogRecPtr	page_lsn = 0;
+
+		page_states[i] = 0;
+
+		if (i < nread &&
+			batch_page_is_valid(file, start + i, page, &page_lsn))
 		{
-			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
-									  blknum, nblocks, in, &n_blocks_skipped,
-									  backup_mode, curr_page);
-			compress_and_backup_page(file, blknum, in, out, &(file->crc),
-									  page_state, curr_page, calg, clevel);
-			n_blocks_read++;
-			if (page_state == PageIsTruncated)
-				break;
+			/* Nullified pages must be copied by DELTA backup, just to be safe */
+			if (backup_mode == BACKUP_MODE_DIFF_DELTA &&
+				file->exists_in_prev &&
+				page_lsn &&
+				page_lsn < prev_backup_start_lsn)
+			{
+				elog(VERBOSE, "Skipping blknum: %u in file: %s",
+					 start + i, file->path);
+				(*n_blocks_skipped)++;
+				page_states[i] = SkipCurrentPage;
+			}
 		}
-		if (backup_mode == BACKUP_MODE_DIFF_DELTA)
-			file->n_blocks = n_blocks_read;
+		else
+			/* Invalid, partly read or truncated page, reread it */
+			page_states[i] = prepare_page(arguments, file, prev_backup_start_lsn,
+										  start + i, nblocks, in,
+										  n_blocks_skipped, backup_mode, page);
+
+		if (page_states[i] == PageIsTruncated)
+			return i + 1;
 	}
-	/*
-	 * If page map is not empty we scan only changed blocks.
-	 *
-	 * We will enter here if backup_mode is PAGE or PTRACK.
-	 */
-	else
+
+	return count;
+}
+
+/*
+ * Write compressed pages of the block range into the backup file.
+ */
+static void
+write_block_range(pgFile *file, FILE *in, FILE *out, BlockNumber start,
+				  BlockNumber count, const int *page_states,
+				  const char *buf, size_t len, CompressAlg calg)
+{
+	BlockNumber	i;
+
+	for (i = 0; i < count; i++)
 	{
-		datapagemap_iterator_t *iter;
-		iter = datapagemap_iterate(&file->pagemap);
-		while (datapagemap_next(iter, &blknum))
+		if (page_states[i] != SkipCurrentPage &&
+			page_states[i] != PageIsTruncated)
 		{
-			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
-									  blknum, nblocks, in, &n_blocks_skipped,
-									  backup_mode, curr_page);
-			compress_and_backup_page(file, blknum, in, out, &(file->crc),
-									  page_state, curr_page, calg, clevel);
-			n_blocks_read++;
-			if (page_state == PageIsTruncated)
-				break;
+			file->compress_alg = calg;
+			file->read_size += BLCKSZ;
 		}
-
-		pg_free(file->pagemap.bitmap);
-		pg_free(iter);
 	}
 
-	/* update file permission */
-	if (chmod(to_path, FILE_PERMISSION) == -1)
+	if (len == 0)
+		return;
+
+	/* Update CRC */
+	COMP_FILE_CRC32(true, file->crc, buf, len);
+
+	if (fwrite(buf, 1, len, out) != len)
 	{
-		int errno_tmp = errno;
+		int			errno_tmp = errno;
+
 		fclose(in);
 		fclose(out);
-		elog(ERROR, "cannot change mode of \"%s\": %s", file->path,
-			 strerror(errno_tmp));
+		elog(ERROR, "File: %s, cannot write backup at block %u: %s",
+			 file->path, start, strerror(errno_tmp));
 	}
+	file->write_size += len;
+}
 
-	if (fflush(out) != 0 ||
-		fsync(fileno(out)) != 0 ||
-		fclose(out))
+#ifndef WIN32
+/*
+ * Pool of compression workers.
+ *
+ * Reader threads (backup_files()) read and check batches of pages and put
+ * them into the bounded queue, compression workers compress them, and
+ * readers write the results in order. This way compression of a large
+ * relation is spread over num_compress_threads workers instead of being
+ * done by the only thread which copies the relation.
+ */
+typedef struct CompressJob
+{
+	/* Filled by reader */
+	pgFile	   *file;			/* used only for messages */
+	BlockNumber	start;
+	BlockNumber	count;
+	int			page_states[BACKUP_BATCH_BLOCKS];
+	char	   *pages;			/* BLCKSZ * BACKUP_BATCH_BLOCKS */
+	CompressAlg	calg;
+	int			clevel;
+
+	/* Filled by compression worker */
+	char	   *output;
+	size_t		output_len;
+	bool		done;
+
+	struct CompressJob *next;	/* next job in the queue */
+} CompressJob;
+
+/* Number of batches of a file a reader can have in the pool at once */
+#define COMPRESS_PIPELINE_DEPTH 4
+
+static pthread_t *compress_workers = NULL;
+static int	n_compress_workers = 0;
+
+static pthread_mutex_t compress_queue_mutex = PTHREAD_MUTEX_INITIALIZER;
+/* Signaled when a job is queued or the pool is stopped */
+static pthread_cond_t compress_queue_cond = PTHREAD_COND_INITIALIZER;
+/* Signaled when a job is taken from the queue */
+static pthread_cond_t compress_space_cond = PTHREAD_COND_INITIALIZER;
+/* Signaled when a job is done */
+static pthread_cond_t compress_done_cond = PTHREAD_COND_INITIALIZER;
+
+static CompressJob *compress_queue_head = NULL;
+static CompressJob *compress_queue_tail = NULL;
+static int	compress_queue_len = 0;
+static bool	compress_pool_stopping = false;
+
+static void *
+compress_worker(void *arg)
+{
+	PGLZ_State *pglz_state = NULL;
+
+	for (;;)
+	{
+		CompressJob *job;
+		BlockNumber	i;
+
+		pthread_lock(&compress_queue_mutex);
+		while (compress_queue_head == NULL && !compress_pool_stopping)
+			pthread_cond_wait(&compress_queue_cond, &compress_queue_mutex);
+
+		job = compress_queue_head;
+		if (job == NULL)
+		{
+			/* The pool is stopped and the queue is empty */
+			pthread_mutex_unlock(&compress_queue_mutex);
+			break;
+		}
+
+		compress_queue_head = job->next;
+		if (compress_queue_head == NULL)
+			compress_queue_tail = NULL;
+		compress_queue_len--;
+		pthread_cond_signal(&compress_space_cond);
+		pthread_mutex_unlock(&compress_queue_mutex);
+
+		if (job->calg == PGLZ_COMPRESS && pglz_state == NULL)
+			pglz_state = pglz_state_alloc();
+
+		job->output_len = 0;
+		for (i = 0; i < job->count; i++)
+			job->output_len += compress_page(job->file, job->start + i,
+											 job->output + job->output_len,
+											 job->page_states[i],
+											 job->pages + i * BLCKSZ,
+											 job->calg, job->clevel,
+											 pglz_state);
+
+		pthread_lock(&compress_queue_mutex);
+		job->done = true;
+		pthread_cond_broadcast(&compress_done_cond);
+		pthread_mutex_unlock(&compress_queue_mutex);
+	}
+
+	if (pglz_state)
+		free(pglz_state);
+
+	return NULL;
+}
+
+/*
+ * Start nworkers compression workers.
+ */
+void
+compress_pool_start(int nworkers)
+{
+	int			i;
+
+	compress_pool_stopping = false;
+	compress_workers = (pthread_t *) palloc(sizeof(pthread_t) * nworkers);
+	for (i = 0; i < nworkers; i++)
+	{
+		elog(VERBOSE, "Start compression thread num: %i", i);
+		pthread_create(&compress_workers[i], NULL, compress_worker, NULL);
+	}
+	n_compress_workers = nworkers;
+}
+
+/*
+ * Stop compression workers after they finish queued jobs.
+ */
+void
+compress_pool_stop(void)
+{
+	int			i;
+
+	if (n_compress_workers == 0)
+		return;
+
+	pthread_lock(&compress_queue_mutex);
+	compress_pool_stopping = true;
+	pthread_cond_broadcast(&compress_queue_cond);
+	pthread_mutex_unlock(&compress_queue_mutex);
+
+	for (i = 0; i < n_compress_workers; i++)
+		pthread_join(compress_workers[i], NULL);
+
+	pfree(compress_workers);
+	compress_workers = NULL;
+	n_compress_workers = 0;
+}
+
+/*
+ * Put the job into the queue, wait if the queue is full.
+ */
+static void
+compress_job_submit(CompressJob *job)
+{
+	job->done = false;
+	job->next = NULL;
+
+	pthread_lock(&compress_queue_mutex);
+	while (compress_queue_len >= n_compress_workers * 2)
+		pthread_cond_wait(&compress_space_cond, &compress_queue_mutex);
+
+	if (compress_queue_tail)
+		compress_queue_tail->next = job;
+	else
+		compress_queue_head = job;
+	compress_queue_tail = job;
+	compress_queue_len++;
+
+	pthread_cond_signal(&compress_queue_cond);
+	pthread_mutex_unlock(&compress_queue_mutex);
+}
+
+static void
+compress_job_wait(CompressJob *job)
+{
+	pthread_lock(&compress_queue_mutex);
+	while (!job->done)
+		pthread_cond_wait(&compress_done_cond, &compress_queue_mutex);
+	pthread_mutex_unlock(&compress_queue_mutex);
+}
+#else
+void
+compress_pool_start(int nworkers)
+{
+	/* Not supported on Windows, pages are compressed by readers */
+}
+
+void
+compress_pool_stop(void)
+{
+}
+#endif
+
+/*
+ * Backup blocks of the data file in batches of up to BACKUP_BATCH_BLOCKS
+ * consecutive blocks. If pagemap is NULL all blocks are copied, otherwise
+ * only runs of blocks set in the pagemap. Every batch is read by one large
+ * read, checked, compressed into one buffer and written by one write.
+ * If compression workers are running, batches are compressed by them while
+ * the reader continues reading.
+ *
+ * Returns number of processed blocks.
+ */
+static int
+backup_data_file_batched(backup_files_arg *arguments, pgFile *file,
+						 FILE *in, FILE *out,
+						 XLogRecPtr prev_backup_start_lsn,
+						 BackupMode backup_mode, BlockNumber nblocks,
+						 datapagemap_t *pagemap,
+						 int *n_blocks_skipped, CompressAlg calg, int clevel)
+{
+	char	   *read_buf = NULL;
+	char	   *write_buf = NULL;
+	int			page_states[BACKUP_BATCH_BLOCKS];
+	int			n_blocks_read = 0;
+	bool		truncated = false;
+	datapagemap_range_iterator_t iter;
+	BlockNumber	blknum = 0;
+#ifndef WIN32
+	/*
+	 * Jobs are not on the stack: if the reader fails with ERROR, workers may
+	 * still finish its queued jobs.
+	 */
+	CompressJob *jobs = NULL;
+	int			first_job = 0;	/* oldest job in the pool */
+	int			n_jobs = 0;		/* number of jobs in the pool */
+	int			n_allocated = 0;
+	bool		use_pool = n_compress_workers > 0 &&
+		calg != NONE_COMPRESS && calg != NOT_DEFINED_COMPRESS;
+#else
+	bool		use_pool = false;
+#endif
+
+	if (!use_pool)
+	{
+		read_buf = pgut_malloc(BLCKSZ * BACKUP_BATCH_BLOCKS);
+		write_buf = pgut_malloc((BLCKSZ + sizeof(BackupPageHeader)) *
+								BACKUP_BATCH_BLOCKS);
+	}
+#ifndef WIN32
+	else
+		jobs = pgut_malloc(sizeof(CompressJob) * COMPRESS_PIPELINE_DEPTH);
+#endif
+
+	if (pagemap == NULL)
+	{
+#if defined(HAVE_POSIX_FADVISE) && defined(POSIX_FADV_SEQUENTIAL)
+		/* This is only a hint, ignore errors */
+		(void) posix_fadvise(fileno(in), 0, 0, POSIX_FADV_SEQUENTIAL);
+#endif
+	}
+	else
+	{
+		iter.map = pagemap;
+		iter.nextblkno = 0;
+	}
+
+	while (!truncated)
+	{
+		BlockNumber	start;
+		BlockNumber	count;
+
+		/* Get the next batch */
+		if (pagemap == NULL)
+		{
+			if (blknum >= nblocks)
+				break;
+			start = blknum;
+			count = Min(nblocks - blknum, BACKUP_BATCH_BLOCKS);
+			blknum += count;
+		}
+		else if (!datapagemap_next_range(&iter, &start, &count,
+										 BACKUP_BATCH_BLOCKS))
+			break;
+
+#ifndef WIN32
+		if (use_pool)
+		{
+			CompressJob *job;
+
+			/* Pipeline is full, write the oldest batch */
+			if (n_jobs == COMPRESS_PIPELINE_DEPTH)
+			{
+				job = &jobs[first_job];
+				compress_job_wait(job);
+				write_block_range(file, in, out, job->start, job->count,
+								  job->page_states, job->output,
+								  job->output_len, calg);
+				first_job = (first_job + 1) % COMPRESS_PIPELINE_DEPTH;
+				n_jobs--;
+			}
+
+			job = &jobs[(first_job + n_jobs) % COMPRESS_PIPELINE_DEPTH];
+			if ((first_job + n_jobs) % COMPRESS_PIPELINE_DEPTH >= n_allocated)
+			{
+				job->pages = pgut_malloc(BLCKSZ * BACKUP_BATCH_BLOCKS);
+				job->output = pgut_malloc((BLCKSZ + sizeof(BackupPageHeader)) *
+										  BACKUP_BATCH_BLOCKS);
+				n_allocated++;
+			}
+
+			job->count = read_block_range(arguments, file, in,
+										  prev_backup_start_lsn, backup_mode,
+										  start, count, nblocks,
+										  n_blocks_skipped, job->pages,
+										  job->page_states);
+			job->file = file;
+			job->start = start;
+			job->calg = calg;
+			job->clevel = clevel;
+			n_blocks_read += job->count;
+			truncated = job->count < count ||
+				job->page_states[job->count - 1] == PageIsTruncated;
+
+			compress_job_submit(job);
+			n_jobs++;
+			continue;
+		}
+#endif
+		{
+			BlockNumber	processed;
+			BlockNumber	i;
+			size_t		write_len = 0;
+
+			processed = read_block_range(arguments, file, in,
+										 prev_backup_start_lsn, backup_mode,
+										 start, count, nblocks,
+										 n_blocks_skipped, read_buf,
+										 page_states);
+			for (i = 0; i < processed; i++)
+				write_len += compress_page(file, start + i, write_buf + write_len,
+										   page_states[i], read_buf + i * BLCKSZ,
+										   calg, clevel, arguments->pglz_state);
+			write_block_range(file, in, out, start, processed, page_states,
+							  write_buf, write_len, calg);
+
+			n_blocks_read += processed;
+			truncated = processed < count ||
+				page_states[processed - 1] == PageIsTruncated;
+		}
+	}
+
+#ifndef WIN32
+	/* Write remaining batches in order */
+	while (n_jobs > 0)
+	{
+		CompressJob *job = &jobs[first_job];
+
+		compress_job_wait(job);
+		write_block_range(file, in, out, job->start, job->count,
+						  job->page_states, job->output, job->output_len,
+						  calg);
+		first_job = (first_job + 1) % COMPRESS_PIPELINE_DEPTH;
+		n_jobs--;
+	}
+
+	while (n_allocated > 0)
+	{
+		n_allocated--;
+		free(jobs[n_allocated].pages);
+		free(jobs[n_allocated].output);
+	}
+	if (jobs)
+		free(jobs);
+#endif
+
+	if (read_buf)
+		free(read_buf);
+	if (write_buf)
+		free(write_buf);
+
+	return n_blocks_read;
+}
+
+/*
+ * Backup data file in the from_root directory to the to_root directory with
+ * same relative path. If prev_backup_start_lsn is not NULL, only pages with
+ * higher lsn will be copied.
+ * Not just copy file, but read it block by block (use bitmap in case of
+ * incremental backup), validate checksum, optionally compress and write to
+ * backup with special header.
+ */
+bool
+backup_data_file(backup_files_arg* arguments,
+				 const char *to_path, pgFile *file,
+				 XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
+				 CompressAlg calg, int clevel)
+{
+	FILE		*in;
+	FILE		*out;
+	BlockNumber	blknum = 0;
+	BlockNumber	nblocks = 0;
+	int			n_blocks_skipped = 0;
+	int			n_blocks_read = 0;
+	int			page_state;
+	char		curr_page[BLCKSZ];
+
+	/*
+	 * Skip unchanged file only if it exists in previous backup.
+	 * This way we can correctly handle null-sized files which are
+	 * not tracked by pagemap and thus always marked as unchanged.
+	 */
+	if ((backup_mode == BACKUP_MODE_DIFF_PAGE ||
+		backup_mode == BACKUP_MODE_DIFF_PTRACK) &&
+		file->pagemap.bitmapsize == PageBitmapIsEmpty &&
+		file->exists_in_prev && !file->pagemap_isabsent)
+	{
+		/*
+		 * There are no changed blocks since last backup. We want make
+		 * incremental backup, so we should exit.
+		 */
+		elog(VERBOSE, "Skipping the unchanged file: %s", file->path);
+		return false;
+	}
+
+	/* Scratch space for pglz is allocated once per thread */
+	if (calg == PGLZ_COMPRESS && arguments->pglz_state == NULL)
+		arguments->pglz_state = pglz_state_alloc();
+
+	/* reset size summary */
+	file->read_size = 0;
+	file->write_size = 0;
+	INIT_FILE_CRC32(true, file->crc);
+
+	/* open backup mode file for read */
+	in = fopen(file->path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		FIN_FILE_CRC32(true, file->crc);
+
+		/*
+		 * If file is not found, this is not en error.
+		 * It could have been deleted by concurrent postgres transaction.
+		 */
+		if (errno == ENOENT)
+		{
+			elog(LOG, "File \"%s\" is not found", file->path);
+			file->write_size = FILE_NOT_FOUND;
+			return false;
+		}
+
+		elog(ERROR, "cannot open file \"%s\": %s",
+			 file->path, strerror(errno));
+	}
+
+	if (file->size % BLCKSZ != 0)
+	{
+		fclose(in);
+		elog(ERROR, "File: %s, invalid file size %zu", file->path, file->size);
+	}
+
+	/*
+	 * Compute expected number of blocks in the file.
+	 * NOTE This is a normal situation, if the file size has changed
+	 * since the moment we computed it.
+	 */
+	nblocks = file->size/BLCKSZ;
+
+	/* open backup file for write  */
+	out = fopen(to_path, PG_BINARY_W);
+	if (out == NULL)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		elog(ERROR, "cannot open backup file \"%s\": %s",
+			 to_path, strerror(errno_tmp));
+	}
+
+	/*
+	 * Read each page, verify checksum and write it to backup.
+	 * If page map is empty or file is not present in previous backup
+	 * backup all pages of the relation.
+	 *
+	 * We will enter here if backup_mode is FULL or DELTA.
+	 */
+	if (file->pagemap.bitmapsize == PageBitmapIsEmpty ||
+		file->pagemap_isabsent || !file->exists_in_prev)
+	{
+		/* PTRACK backup fetches pages via SQL, so read them one by one */
+		if (backup_mode != BACKUP_MODE_DIFF_PTRACK)
+			n_blocks_read = backup_data_file_batched(arguments, file, in, out,
+													 prev_backup_start_lsn,
+													 backup_mode, nblocks, NULL,
+													 &n_blocks_skipped,
+													 calg, clevel);
+		else
+		{
+			for (blknum = 0; blknum < nblocks; blknum++)
+			{
+				page_state = prepare_page(arguments, file, prev_backup_start_lsn,
+										  blknum, nblocks, in, &n_blocks_skipped,
+										  backup_mode, curr_page);
+				compress_and_backup_page(file, blknum, in, out, &(file->crc),
+										 page_state, curr_page, calg, clevel,
+										 arguments->pglz_state);
+				n_blocks_read++;
+				if (page_state == PageIsTruncated)
+					break;
+			}
+		}
+		if (backup_mode == BACKUP_MODE_DIFF_DELTA)
+			file->n_blocks = n_blocks_read;
+	}
+	/*
+	 * If page map is not empty we scan only changed blocks.
+	 *
+	 * We will enter here if backup_mode is PAGE or PTRACK.
+	 */
+	else if (backup_mode != BACKUP_MODE_DIFF_PTRACK)
+	{
+		/* Read runs of changed blocks at once */
+		n_blocks_read = backup_data_file_batched(arguments, file, in, out,
+												 prev_backup_start_lsn,
+												 backup_mode, nblocks,
+												 &file->pagemap,
+												 &n_blocks_skipped,
+												 calg, clevel);
+		pg_free(file->pagemap.bitmap);
+	}
+	else
+	{
+		/* PTRACK backup fetches pages via SQL, so get them one by one */
+		datapagemap_iterator_t *iter;
+		iter = datapagemap_iterate(&file->pagemap);
+		while (datapagemap_next(iter, &blknum))
+		{
+			page_state = prepare_page(arguments, file, prev_backup_start_lsn,
+									  blknum, nblocks, in, &n_blocks_skipped,
+									  backup_mode, curr_page);
+			compress_and_backup_page(file, blknum, in, out, &(file->crc),
+									  page_state, curr_page, calg, clevel,
+									  arguments->pglz_state);
+			n_blocks_read++;
+			if (page_state == PageIsTruncated)
+				break;
+		}
+
+		pg_free(file->pagemap.bitmap);
+		pg_free(iter);
+	}
+
+	/* update file permission */
+	if (chmod(to_path, FILE_PERMISSION) == -1)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		fclose(out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", file->path,
+			 strerror(errno_tmp));
+	}
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
 		elog(ERROR, "cannot write backup file \"%s\": %s",
 			 to_path, strerror(errno));
 	fclose(in);
@@ -871,48 +1627,553 @@ restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
 		fseek(out, 0, SEEK_END);
 		file_size = ftell(out);
 
-		if (file_size > file->n_blocks * BLCKSZ)
+		if (file_size > file->n_blocks * BLCKSZ)
+		{
+			truncate_from = file->n_blocks;
+			need_truncate = true;
+		}
+	}
+
+	if (need_truncate)
+	{
+		off_t		write_pos;
+
+		write_pos = (write_header) ? truncate_from * (BLCKSZ + sizeof(header)) :
+									 truncate_from * BLCKSZ;
+
+		/*
+		 * Truncate file to this length.
+		 */
+		if (ftruncate(fileno(out), write_pos) != 0)
+			elog(ERROR, "cannot truncate \"%s\": %s",
+				 file->path, strerror(errno));
+		elog(VERBOSE, "Delta truncate file %s to block %u",
+			 file->path, truncate_from);
+	}
+
+	/* update file permission */
+	if (chmod(to_path, file->mode) == -1)
+	{
+		int errno_tmp = errno;
+
+		if (in)
+			fclose(in);
+		fclose(out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno_tmp));
+	}
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
+	if (in)
+		fclose(in);
+}
+
+/*
+ * Location of the newest copy of a block in the backups of a chain.
+ */
+typedef struct
+{
+	int			backup;			/* index of backup in the chain, -1 if the
+								 * block is not stored in any backup */
+	long		offset;			/* offset of the page in the backup file */
+	int32		compressed_size;
+} ChainBlock;
+
+/*
+ * Set number of blocks of the file restored from a chain. New blocks are
+ * holes, which are filled with zeroes on restore.
+ */
+static void
+chain_blocks_resize(ChainBlock **blocks, BlockNumber *nblocks,
+					BlockNumber *allocated, BlockNumber new_nblocks)
+{
+	BlockNumber	blknum;
+
+	if (new_nblocks > *allocated)
+	{
+		*allocated = Max(new_nblocks, *allocated * 2);
+		*blocks = (ChainBlock *) pgut_realloc(*blocks,
+											  sizeof(ChainBlock) * (*allocated));
+	}
+
+	for (blknum = *nblocks; blknum < new_nblocks; blknum++)
+		(*blocks)[blknum].backup = -1;
+	*nblocks = new_nblocks;
+}
+
+/*
+ * Read page headers of the data file from the backup with index "backup" in
+ * a chain and record the location of its blocks in "blocks". Truncations are
+ * applied in the same way restore_data_file() applies them to the restored
+ * file. Returns the backup file opened to read pages later, or NULL if only
+ * the size of the file is known from DELTA backup.
+ */
+static FILE *
+chain_blocks_scan(pgFile *file, int backup, bool allow_truncate,
+				  ChainBlock **blocks, BlockNumber *nblocks,
+				  BlockNumber *allocated)
+{
+	FILE	   *in = NULL;
+	BackupPageHeader header;
+	BlockNumber	blknum = 0,
+				truncate_from = 0;
+	bool		need_truncate = false;
+
+	if (file->write_size != BYTES_INVALID)
+	{
+		in = fopen(file->path, PG_BINARY_R);
+		if (in == NULL)
+			elog(ERROR, "cannot open backup file \"%s\": %s", file->path,
+				 strerror(errno));
+
+		while (true)
+		{
+			size_t		read_len;
+
+			if (file->n_blocks != BLOCKNUM_INVALID &&
+				(blknum + 1) > file->n_blocks)
+			{
+				truncate_from = blknum;
+				need_truncate = true;
+				break;
+			}
+
+			/* read BackupPageHeader */
+			read_len = fread(&header, 1, sizeof(header), in);
+			if (read_len != sizeof(header))
+			{
+				int errno_tmp = errno;
+				if (read_len == 0 && feof(in))
+					break;		/* EOF found */
+				else if (read_len != 0 && feof(in))
+					elog(ERROR,
+						 "odd size page found at block %u of \"%s\"",
+						 blknum, file->path);
+				else
+					elog(ERROR, "cannot read header of block %u of \"%s\": %s",
+						 blknum, file->path, strerror(errno_tmp));
+			}
+
+			if (header.block < blknum)
+				elog(ERROR, "backup is broken at file->path %s block %u",
+					 file->path, blknum);
+
+			blknum = header.block;
+
+			if (header.compressed_size == PageIsTruncated)
+			{
+				truncate_from = blknum;
+				need_truncate = true;
+				break;
+			}
+
+			Assert(header.compressed_size <= BLCKSZ);
+
+			if (blknum >= *nblocks)
+				chain_blocks_resize(blocks, nblocks, allocated, blknum + 1);
+			(*blocks)[blknum].backup = backup;
+			(*blocks)[blknum].offset = ftell(in);
+			(*blocks)[blknum].compressed_size = header.compressed_size;
+
+			/* Skip the page, it is read later unless newer backup has it */
+			if (fseek(in, MAXALIGN(header.compressed_size), SEEK_CUR) < 0)
+				elog(ERROR, "cannot seek block %u of \"%s\": %s",
+					 blknum, file->path, strerror(errno));
+		}
+	}
+
+	/* See restore_data_file() about truncation by DELTA backup */
+	if (allow_truncate && file->n_blocks != BLOCKNUM_INVALID &&
+		!need_truncate && *nblocks > file->n_blocks)
+	{
+		truncate_from = file->n_blocks;
+		need_truncate = true;
+	}
+
+	if (need_truncate)
+		chain_blocks_resize(blocks, nblocks, allocated, truncate_from);
+
+	return in;
+}
+
+/*
+ * Read the page of the block found by chain_blocks_scan() into "buf", which
+ * must have room for BLCKSZ bytes.
+ */
+static void
+chain_block_read(ChainBlock *block, BlockNumber blknum, pgFile *file,
+				 FILE *in, char *buf)
+{
+	size_t		read_len;
+
+	if (fseek(in, block->offset, SEEK_SET) < 0)
+		elog(ERROR, "cannot seek block %u of \"%s\": %s",
+			 blknum, file->path, strerror(errno));
+
+	read_len = fread(buf, 1, MAXALIGN(block->compressed_size), in);
+	if (read_len != MAXALIGN(block->compressed_size))
+		elog(ERROR, "cannot read block %u of \"%s\" read %zu of %d",
+			 blknum, file->path, read_len, block->compressed_size);
+}
+
+/*
+ * Decompress the page read by chain_block_read() into "page" if necessary.
+ * Returns the uncompressed page.
+ */
+static char *
+chain_block_decompress(ChainBlock *block, BlockNumber blknum, pgFile *file,
+					   uint32 backup_version, char *buf, char *page)
+{
+	int32		uncompressed_size;
+	const char *errormsg = NULL;
+
+	/* See restore_data_file() */
+	if (block->compressed_size == BLCKSZ &&
+		!page_may_be_compressed(buf, file->compress_alg, backup_version))
+		return buf;
+
+	uncompressed_size = do_decompress(page, BLCKSZ, buf,
+									  block->compressed_size,
+									  file->compress_alg, &errormsg);
+	if (uncompressed_size < 0 && errormsg != NULL)
+		elog(WARNING, "An error occured during decompressing block %u of file \"%s\": %s",
+			 blknum, file->path, errormsg);
+
+	if (uncompressed_size != BLCKSZ)
+		elog(ERROR, "page of file \"%s\" uncompressed to %d bytes. != BLCKSZ",
+			 file->path, uncompressed_size);
+
+	return page;
+}
+
+/*
+ * Restore data file from the chain of backups. files[i] is the entry of the
+ * file in i-th backup of the chain or NULL, backups are ordered from FULL
+ * backup to the destination one.
+ *
+ * restore_data_file() called for every backup of the chain rewrites the same
+ * blocks again and again. Here page headers of all backups are read at first
+ * to find the newest copy of every block, truncations are applied in the same
+ * way, then the target file is written in one pass and every block is read,
+ * decompressed and written exactly once.
+ *
+ * If incremental is true, the target file may exist already. Its blocks are
+ * compared with the blocks of the backups and only the differing ones are
+ * rewritten.
+ */
+void
+restore_data_file_chain(const char *to_path, pgFile **files, parray *chain,
+						bool incremental)
+{
+	int			nbackups = parray_num(chain);
+	FILE	  **in;
+	uint32	   *versions;
+	FILE	   *out;
+	ChainBlock *blocks = NULL;
+	BlockNumber	nblocks = 0;
+	BlockNumber	allocated = 0;
+	BlockNumber	blknum;
+	BlockNumber	write_blknum = 0;
+	BlockNumber	target_nblocks = 0;
+	BlockNumber	n_written = 0;
+	DataPage	zero_page;
+	pgFile	   *last_file = NULL;
+	int			i;
+
+	in = pgut_newarray(FILE *, nbackups);
+	versions = pgut_newarray(uint32, nbackups);
+
+	for (i = 0; i < nbackups; i++)
+	{
+		pgFile	   *file = files[i];
+		pgBackup   *backup = (pgBackup *) parray_get(chain, i);
+
+		in[i] = NULL;
+		versions[i] = parse_program_version(backup->program_version);
+
+		if (file == NULL || file->write_size == FILE_NOT_FOUND)
+			continue;
+
+		/*
+		 * File didn`t change since previous backup. DELTA backup still knows
+		 * its size.
+		 */
+		if (file->write_size == BYTES_INVALID &&
+			backup->backup_mode != BACKUP_MODE_DIFF_DELTA)
+			continue;
+
+		last_file = file;
+		in[i] = chain_blocks_scan(file, i,
+								  backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
+								  &blocks, &nblocks, &allocated);
+	}
+
+	/* There is nothing to restore */
+	if (last_file == NULL)
+	{
+		free(in);
+		free(versions);
+		return;
+	}
+
+	out = NULL;
+	if (incremental)
+	{
+		struct stat	st;
+
+		/* Open existing file to overwrite only differing blocks */
+		out = fopen(to_path, PG_BINARY_R "+");
+		if (out == NULL && errno != ENOENT)
+			elog(ERROR, "cannot open restore target file \"%s\": %s",
+				 to_path, strerror(errno));
+		if (out != NULL)
+		{
+			if (fstat(fileno(out), &st) != 0)
+				elog(ERROR, "cannot stat \"%s\": %s", to_path, strerror(errno));
+			target_nblocks = st.st_size / BLCKSZ;
+		}
+		MemSet(zero_page.data, 0, BLCKSZ);
+	}
+	if (out == NULL)
+		out = fopen(to_path, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "cannot open restore target file \"%s\": %s",
+			 to_path, strerror(errno));
+
+	for (blknum = 0; blknum < nblocks; blknum++)
+	{
+		ChainBlock *block = &blocks[blknum];
+		DataPage	compressed_page; /* used as read buffer */
+		DataPage	page;
+		char	   *data;
+
+		if (block->backup < 0)
+		{
+			/*
+			 * Holes are left to ftruncate() below, existing blocks have to be
+			 * zeroed.
+			 */
+			if (blknum >= target_nblocks)
+				continue;
+			data = zero_page.data;
+		}
+		else
+		{
+			chain_block_read(block, blknum, files[block->backup],
+							 in[block->backup], compressed_page.data);
+			data = chain_block_decompress(block, blknum, files[block->backup],
+										  versions[block->backup],
+										  compressed_page.data, page.data);
+		}
+
+		if (blknum < target_nblocks)
+		{
+			DataPage	target_page;
+
+			/* Leave the block alone if it is the same already */
+			if (fseek(out, (off_t) blknum * BLCKSZ, SEEK_SET) < 0 ||
+				fread(target_page.data, 1, BLCKSZ, out) != BLCKSZ)
+				elog(ERROR, "cannot read block %u of \"%s\": %s",
+					 blknum, to_path, strerror(errno));
+			/* Reading and writing must be separated by fseek() */
+			write_blknum = InvalidBlockNumber;
+			if (memcmp(target_page.data, data, BLCKSZ) == 0)
+				continue;
+		}
+
+		/* Seek only after a hole to keep writes buffered */
+		if (blknum != write_blknum &&
+			fseek(out, (off_t) blknum * BLCKSZ, SEEK_SET) < 0)
+			elog(ERROR, "cannot seek block %u of \"%s\": %s",
+				 blknum, to_path, strerror(errno));
+
+		if (fwrite(data, 1, BLCKSZ, out) != BLCKSZ)
+			elog(ERROR, "cannot write block %u of \"%s\": %s",
+				 blknum, to_path, strerror(errno));
+		write_blknum = blknum + 1;
+		n_written++;
+	}
+
+	/* Set the final length, it covers trailing holes */
+	if (fflush(out) != 0 ||
+		ftruncate(fileno(out), (off_t) nblocks * BLCKSZ) != 0)
+		elog(ERROR, "cannot truncate \"%s\": %s", to_path, strerror(errno));
+
+	/* update file permission */
+	if (chmod(to_path, last_file->mode) == -1)
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno));
+
+	if (fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
+
+	for (i = 0; i < nbackups; i++)
+	{
+		if (in[i])
+			fclose(in[i]);
+	}
+	free(in);
+	free(versions);
+	free(blocks);
+
+	if (incremental)
+		elog(VERBOSE, "Rewritten %u of %u blocks of \"%s\"",
+			 n_written, nblocks, to_path);
+}
+
+/*
+ * Merge data file of the incremental backup "from_file" into the file of
+ * compressed FULL backup "to_file", which may be NULL if the file is new.
+ * Both files must have full paths. The result is written into to_path with
+ * calg compression, and its sizes and CRC are saved in from_file.
+ *
+ * Page headers of both files are merged block by block in the same way as
+ * restoring the files one after another does it. Compressed pages are copied
+ * as is if they are compressed by calg, other pages are decompressed and
+ * compressed again.
+ */
+void
+merge_data_file(const char *to_path, pgFile *to_file, pgFile *from_file,
+				bool allow_truncate, uint32 to_version, uint32 from_version,
+				CompressAlg calg, int clevel)
+{
+	pgFile	   *files[2];
+	uint32		versions[2];
+	FILE	   *in[2];
+	FILE	   *out;
+	char		tmp_path[MAXPGPATH];
+	ChainBlock *blocks = NULL;
+	BlockNumber	nblocks = 0;
+	BlockNumber	allocated = 0;
+	BlockNumber	blknum;
+	BlockNumber	n_copied = 0;
+	DataPage	zero_page;
+	PGLZ_State *pglz_state = NULL;
+	int			i;
+
+	files[0] = to_file;
+	files[1] = from_file;
+	versions[0] = to_version;
+	versions[1] = from_version;
+
+	/* The same truncation rules as for restore_data_file() in merge_files() */
+	in[0] = to_file ? chain_blocks_scan(to_file, 0, false,
+										&blocks, &nblocks, &allocated) : NULL;
+	in[1] = chain_blocks_scan(from_file, 1, allow_truncate,
+							  &blocks, &nblocks, &allocated);
+
+	snprintf(tmp_path, MAXPGPATH, "%s_tmp", to_path);
+	out = fopen(tmp_path, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "cannot open backup file \"%s\": %s",
+			 tmp_path, strerror(errno));
+
+	from_file->read_size = 0;
+	from_file->write_size = 0;
+	INIT_FILE_CRC32(true, from_file->crc);
+	MemSet(zero_page.data, 0, BLCKSZ);
+
+	if (calg == PGLZ_COMPRESS)
+		pglz_state = pglz_state_alloc();
+
+	for (blknum = 0; blknum < nblocks; blknum++)
+	{
+		ChainBlock *block = &blocks[blknum];
+		char		write_buffer[BLCKSZ + sizeof(BackupPageHeader)];
+		size_t		write_buffer_size;
+
+		if (block->backup < 0)
 		{
-			truncate_from = file->n_blocks;
-			need_truncate = true;
+			/* Holes of the file are backed up as zeroed pages */
+			write_buffer_size = compress_page(from_file, blknum, write_buffer,
+											  0, zero_page.data,
+											  calg, clevel, pglz_state);
 		}
-	}
+		else
+		{
+			pgFile	   *file = files[block->backup];
+			DataPage	page;
+			char	   *buf = write_buffer + sizeof(BackupPageHeader);
 
-	if (need_truncate)
-	{
-		off_t		write_pos;
+			chain_block_read(block, blknum, file, in[block->backup], buf);
 
-		write_pos = (write_header) ? truncate_from * (BLCKSZ + sizeof(header)) :
-									 truncate_from * BLCKSZ;
+			/*
+			 * Copy page compressed by the same algorithm as is. Pages of
+			 * BLCKSZ size are ambiguous in old versions, see
+			 * page_may_be_compressed(), so let compress_page() handle them.
+			 */
+			if (block->compressed_size < BLCKSZ && file->compress_alg == calg)
+			{
+				BackupPageHeader header;
+
+				header.block = blknum;
+				header.compressed_size = block->compressed_size;
+				memcpy(write_buffer, &header, sizeof(header));
+				write_buffer_size = sizeof(header) +
+					MAXALIGN(block->compressed_size);
+				n_copied++;
+			}
+			else
+			{
+				char	   *data;
 
-		/*
-		 * Truncate file to this length.
-		 */
-		if (ftruncate(fileno(out), write_pos) != 0)
-			elog(ERROR, "cannot truncate \"%s\": %s",
-				 file->path, strerror(errno));
-		elog(VERBOSE, "Delta truncate file %s to block %u",
-			 file->path, truncate_from);
-	}
+				data = chain_block_decompress(block, blknum, file,
+											  versions[block->backup],
+											  buf, page.data);
+				/* compress_page() overwrites the buffer */
+				if (data == buf)
+				{
+					memcpy(page.data, buf, BLCKSZ);
+					data = page.data;
+				}
+				write_buffer_size = compress_page(from_file, blknum,
+												  write_buffer, 0, data,
+												  calg, clevel, pglz_state);
+			}
+		}
 
-	/* update file permission */
-	if (chmod(to_path, file->mode) == -1)
-	{
-		int errno_tmp = errno;
+		COMP_FILE_CRC32(true, from_file->crc, write_buffer, write_buffer_size);
+		if (fwrite(write_buffer, 1, write_buffer_size, out) != write_buffer_size)
+			elog(ERROR, "cannot write block %u of \"%s\": %s",
+				 blknum, tmp_path, strerror(errno));
 
-		if (in)
-			fclose(in);
-		fclose(out);
-		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
-			 strerror(errno_tmp));
+		from_file->read_size += BLCKSZ;
+		from_file->write_size += write_buffer_size;
 	}
 
+	FIN_FILE_CRC32(true, from_file->crc);
+	from_file->compress_alg = calg;
+
+	if (pglz_state)
+		free(pglz_state);
+
+	if (chmod(tmp_path, FILE_PERMISSION) == -1)
+		elog(ERROR, "cannot change mode of \"%s\": %s", tmp_path,
+			 strerror(errno));
+
 	if (fflush(out) != 0 ||
 		fsync(fileno(out)) != 0 ||
 		fclose(out))
-		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
-	if (in)
-		fclose(in);
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 tmp_path, strerror(errno));
+
+	for (i = 0; i < 2; i++)
+	{
+		if (in[i])
+			fclose(in[i]);
+	}
+	free(blocks);
+
+	if (rename(tmp_path, to_path) == -1)
+		elog(ERROR, "Could not rename file \"%s\" to \"%s\": %s",
+			 tmp_path, to_path, strerror(errno));
+
+	elog(VERBOSE, "Merged %u blocks of \"%s\", %u of them copied compressed",
+		 nblocks, to_path, n_copied);
 }
 
 /*
@@ -1000,124 +2261,574 @@ copy_file(const char *from_root, const char *to_root, pgFile *file)
 		file->read_size += read_len;
 	}
 
-	errno_tmp = errno;
-	if (!feof(in))
+	errno_tmp = errno;
+	if (!feof(in))
+	{
+		fclose(in);
+		fclose(out);
+		elog(ERROR, "cannot read backup mode file \"%s\": %s",
+			 file->path, strerror(errno_tmp));
+	}
+
+	/* copy odd part. */
+	if (read_len > 0)
+	{
+		if (fwrite(buf, 1, read_len, out) != read_len)
+		{
+			errno_tmp = errno;
+			/* oops */
+			fclose(in);
+			fclose(out);
+			elog(ERROR, "cannot write to \"%s\": %s", to_path,
+				 strerror(errno_tmp));
+		}
+		/* update CRC */
+		COMP_FILE_CRC32(true, crc, buf, read_len);
+
+		file->read_size += read_len;
+	}
+
+	file->write_size = (int64) file->read_size;
+	/* finish CRC calculation and store into pgFile */
+	FIN_FILE_CRC32(true, crc);
+	file->crc = crc;
+
+	/* update file permission */
+	if (chmod(to_path, st.st_mode) == -1)
+	{
+		errno_tmp = errno;
+		fclose(in);
+		fclose(out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno_tmp));
+	}
+
+	if (fflush(out) != 0 ||
+		fsync(fileno(out)) != 0 ||
+		fclose(out))
+		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
+	fclose(in);
+
+	return true;
+}
+
+#ifdef HAVE_LIBZ
+/*
+ * Show error during work with compressed file
+ */
+static const char *
+get_gz_error(gzFile gzf, int errnum)
+{
+	int			gz_errnum;
+	const char *errmsg;
+
+	errmsg = gzerror(gzf, &gz_errnum);
+	if (gz_errnum == Z_ERRNO)
+		return strerror(errnum);
+	else
+		return errmsg;
+}
+#endif
+
+/*
+ * Copy file attributes
+ */
+static void
+copy_meta(const char *from_path, const char *to_path, bool unlink_on_error)
+{
+	struct stat st;
+
+	if (stat(from_path, &st) == -1)
+	{
+		if (unlink_on_error)
+			unlink(to_path);
+		elog(ERROR, "Cannot stat file \"%s\": %s",
+			 from_path, strerror(errno));
+	}
+
+	if (chmod(to_path, st.st_mode) == -1)
+	{
+		if (unlink_on_error)
+			unlink(to_path);
+		elog(ERROR, "Cannot change mode of file \"%s\": %s",
+			 to_path, strerror(errno));
+	}
+}
+
+/*
+ * Return suffix of WAL segments compressed by the algorithm in the archive,
+ * or NULL if this build cannot compress WAL by the algorithm.
+ */
+const char *
+wal_compress_suffix(CompressAlg alg)
+{
+	switch (alg)
+	{
+#ifdef HAVE_LIBZ
+		case ZLIB_COMPRESS:
+			return ".gz";
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return ".zst";
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return ".lz4";
+#endif
+		default:
+			break;
+	}
+
+	return NULL;
+}
+
+/*
+ * Look for WAL segment "path" compressed by any supported algorithm.
+ * If it is found, put its path into compressed_path and return the algorithm.
+ * Otherwise return NONE_COMPRESS.
+ */
+CompressAlg
+find_compressed_wal_file(const char *path, char *compressed_path)
+{
+	static const CompressAlg algs[] = {ZLIB_COMPRESS, ZSTD_COMPRESS,
+									   LZ4_COMPRESS};
+	int			i;
+
+	for (i = 0; i < lengthof(algs); i++)
+	{
+		const char *suffix = wal_compress_suffix(algs[i]);
+
+		if (suffix == NULL)
+			continue;
+
+		snprintf(compressed_path, MAXPGPATH, "%s%s", path, suffix);
+		if (fileExists(compressed_path))
+			return algs[i];
+	}
+
+	return NONE_COMPRESS;
+}
+
+/*
+ * Read the whole file into malloc'd buffer. Returns NULL and sets errno
+ * on failure.
+ */
+static char *
+read_whole_file(const char *path, size_t *size)
+{
+	FILE	   *in;
+	struct stat	st;
+	char	   *buf;
+	int			errno_temp;
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+		return NULL;
+
+	if (fstat(fileno(in), &st) != 0)
+	{
+		errno_temp = errno;
+		fclose(in);
+		errno = errno_temp;
+		return NULL;
+	}
+
+	buf = pgut_malloc(st.st_size > 0 ? st.st_size : 1);
+	if (fread(buf, 1, st.st_size, in) != (size_t) st.st_size)
+	{
+		errno_temp = ferror(in) ? errno : EIO;
+		free(buf);
+		fclose(in);
+		errno = errno_temp;
+		return NULL;
+	}
+
+	fclose(in);
+	*size = st.st_size;
+	return buf;
+}
+
+/*
+ * Compress the whole WAL segment into a single zstd or lz4 frame.
+ * zstd compresses it in up to nworkers threads.
+ * Returns malloc'd buffer, or NULL and *errormsg if compression fails.
+ */
+static char *
+compress_wal_frame(const char *src, size_t src_size, CompressAlg alg,
+				   int level, int nworkers, size_t *dst_size,
+				   const char **errormsg)
+{
+	switch (alg)
+	{
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			{
+				ZSTD_CCtx  *cctx;
+				size_t		bound = ZSTD_compressBound(src_size);
+				size_t		rc;
+				char	   *dst;
+
+				cctx = ZSTD_createCCtx();
+				if (cctx == NULL)
+				{
+					*errormsg = "out of memory";
+					return NULL;
+				}
+
+				ZSTD_CCtx_setParameter(cctx, ZSTD_c_compressionLevel, level);
+				ZSTD_CCtx_setParameter(cctx, ZSTD_c_checksumFlag, 1);
+				/*
+				 * Compress the segment in several threads. The parameter is
+				 * rejected by libzstd built without multithreading, then
+				 * the segment is compressed by this thread.
+				 */
+				if (nworkers > 1)
+					(void) ZSTD_CCtx_setParameter(cctx, ZSTD_c_nbWorkers,
+												  nworkers);
+
+				dst = pgut_malloc(bound);
+				rc = ZSTD_compress2(cctx, dst, bound, src, src_size);
+				ZSTD_freeCCtx(cctx);
+
+				if (ZSTD_isError(rc))
+				{
+					free(dst);
+					*errormsg = ZSTD_getErrorName(rc);
+					return NULL;
+				}
+				*dst_size = rc;
+				return dst;
+			}
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			{
+				LZ4F_preferences_t prefs;
+				size_t		bound;
+				size_t		rc;
+				char	   *dst;
+
+				MemSet(&prefs, 0, sizeof(prefs));
+				prefs.compressionLevel = level;
+				prefs.frameInfo.contentSize = src_size;
+				prefs.frameInfo.contentChecksumFlag = LZ4F_contentChecksumEnabled;
+
+				bound = LZ4F_compressFrameBound(src_size, &prefs);
+				dst = pgut_malloc(bound);
+				rc = LZ4F_compressFrame(dst, bound, src, src_size, &prefs);
+
+				if (LZ4F_isError(rc))
+				{
+					free(dst);
+					*errormsg = LZ4F_getErrorName(rc);
+					return NULL;
+				}
+				*dst_size = rc;
+				return dst;
+			}
+#endif
+		default:
+			*errormsg = "This build does not support the compression algorithm";
+			break;
+	}
+
+	return NULL;
+}
+
+/*
+ * Read WAL segment compressed by zstd or lz4 and decompress it into memory.
+ * Returns malloc'd buffer, or NULL and *errormsg if the file cannot be read
+ * or decompressed.
+ */
+char *
+decompress_wal_file(const char *path, CompressAlg alg, size_t *size,
+					const char **errormsg)
+{
+	char	   *src;
+	size_t		src_size;
+	char	   *dst = NULL;
+
+	src = read_whole_file(path, &src_size);
+	if (src == NULL)
+	{
+		*errormsg = strerror(errno);
+		return NULL;
+	}
+
+	switch (alg)
+	{
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			{
+				unsigned long long content_size;
+				size_t		rc;
+
+				content_size = ZSTD_getFrameContentSize(src, src_size);
+				if (content_size == ZSTD_CONTENTSIZE_ERROR ||
+					content_size == ZSTD_CONTENTSIZE_UNKNOWN)
+				{
+					*errormsg = "Invalid zstd frame header";
+					break;
+				}
+
+				dst = pgut_malloc(content_size > 0 ? content_size : 1);
+				rc = ZSTD_decompress(dst, content_size, src, src_size);
+				if (ZSTD_isError(rc))
+				{
+					*errormsg = ZSTD_getErrorName(rc);
+					free(dst);
+					dst = NULL;
+					break;
+				}
+				*size = rc;
+				break;
+			}
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			{
+				LZ4F_dctx  *dctx;
+				LZ4F_frameInfo_t info;
+				size_t		src_pos;
+				size_t		dst_pos = 0;
+				size_t		src_len = src_size;
+				size_t		rc;
+
+				rc = LZ4F_createDecompressionContext(&dctx, LZ4F_VERSION);
+				if (LZ4F_isError(rc))
+				{
+					*errormsg = LZ4F_getErrorName(rc);
+					break;
+				}
+
+				rc = LZ4F_getFrameInfo(dctx, &info, src, &src_len);
+				if (LZ4F_isError(rc) || info.contentSize == 0)
+				{
+					*errormsg = LZ4F_isError(rc) ? LZ4F_getErrorName(rc) :
+						"Invalid lz4 frame header";
+					LZ4F_freeDecompressionContext(dctx);
+					break;
+				}
+
+				dst = pgut_malloc(info.contentSize);
+				src_pos = src_len;
+				while (src_pos < src_size)
+				{
+					size_t		dst_len = info.contentSize - dst_pos;
+
+					src_len = src_size - src_pos;
+					rc = LZ4F_decompress(dctx, dst + dst_pos, &dst_len,
+										 src + src_pos, &src_len, NULL);
+					if (LZ4F_isError(rc))
+						break;
+
+					src_pos += src_len;
+					dst_pos += dst_len;
+					/* The frame is decoded completely */
+					if (rc == 0 || (src_len == 0 && dst_len == 0))
+						break;
+				}
+				LZ4F_freeDecompressionContext(dctx);
+
+				if (rc != 0)
+				{
+					*errormsg = LZ4F_isError(rc) ? LZ4F_getErrorName(rc) :
+						"Truncated lz4 frame";
+					free(dst);
+					dst = NULL;
+					break;
+				}
+				*size = dst_pos;
+				break;
+			}
+#endif
+		default:
+			*errormsg = "This build does not support the compression algorithm";
+			break;
+	}
+
+	free(src);
+	return dst;
+}
+
+/*
+ * Read WAL segment "path", or its compressed version if the segment itself
+ * is absent, into memory. Path of the file read is put into loaded_path.
+ * Returns malloc'd buffer with uncompressed content of the segment, or NULL
+ * if the segment is absent or cannot be read.
+ */
+char *
+load_wal_segment(const char *path, char *loaded_path, bool *is_compressed,
+				 size_t *size)
+{
+	CompressAlg	calg;
+	const char *errormsg = NULL;
+	char	   *data;
+
+	*is_compressed = false;
+	if (fileExists(path))
 	{
-		fclose(in);
-		fclose(out);
-		elog(ERROR, "cannot read backup mode file \"%s\": %s",
-			 file->path, strerror(errno_tmp));
+		StrNCpy(loaded_path, path, MAXPGPATH);
+		return read_whole_file(path, size);
 	}
 
-	/* copy odd part. */
-	if (read_len > 0)
+	calg = find_compressed_wal_file(path, loaded_path);
+	if (calg == NONE_COMPRESS)
+		return NULL;
+	*is_compressed = true;
+
+#ifdef HAVE_LIBZ
+	if (calg == ZLIB_COMPRESS)
 	{
-		if (fwrite(buf, 1, read_len, out) != read_len)
+		gzFile		gz_in;
+		size_t		allocated = XLOG_BLCKSZ * 64;
+		int			read_len;
+
+		gz_in = gzopen(loaded_path, PG_BINARY_R);
+		if (gz_in == NULL)
+			return NULL;
+
+		data = pgut_malloc(allocated);
+		*size = 0;
+		for (;;)
 		{
-			errno_tmp = errno;
-			/* oops */
-			fclose(in);
-			fclose(out);
-			elog(ERROR, "cannot write to \"%s\": %s", to_path,
-				 strerror(errno_tmp));
-		}
-		/* update CRC */
-		COMP_FILE_CRC32(true, crc, buf, read_len);
+			if (*size == allocated)
+			{
+				allocated *= 2;
+				data = pgut_realloc(data, allocated);
+			}
 
-		file->read_size += read_len;
-	}
+			read_len = gzread(gz_in, data + *size, allocated - *size);
+			if (read_len <= 0)
+				break;
+			*size += read_len;
+		}
 
-	file->write_size = (int64) file->read_size;
-	/* finish CRC calculation and store into pgFile */
-	FIN_FILE_CRC32(true, crc);
-	file->crc = crc;
+		if (read_len < 0 || !gzeof(gz_in))
+		{
+			free(data);
+			data = NULL;
+		}
+		gzclose(gz_in);
 
-	/* update file permission */
-	if (chmod(to_path, st.st_mode) == -1)
-	{
-		errno_tmp = errno;
-		fclose(in);
-		fclose(out);
-		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
-			 strerror(errno_tmp));
+		return data;
 	}
+#endif
 
-	if (fflush(out) != 0 ||
-		fsync(fileno(out)) != 0 ||
-		fclose(out))
-		elog(ERROR, "cannot write \"%s\": %s", to_path, strerror(errno));
-	fclose(in);
+	data = decompress_wal_file(loaded_path, calg, size, &errormsg);
+	if (data == NULL)
+		elog(VERBOSE, "Cannot decompress WAL segment \"%s\": %s",
+			 loaded_path, errormsg);
 
-	return true;
+	return data;
 }
 
-#ifdef HAVE_LIBZ
 /*
- * Show error during work with compressed file
+ * Read CRC of archived WAL segment "to_path" from its checksum file.
+ * Returns false if there is no checksum file or it cannot be read.
  */
-static const char *
-get_gz_error(gzFile gzf, int errnum)
+bool
+read_wal_crc_file(const char *to_path, pg_crc32 *crc)
 {
-	int			gz_errnum;
-	const char *errmsg;
+	char		crc_path[MAXPGPATH];
+	FILE	   *fp;
+	unsigned int value;
+	bool		ok;
+
+	snprintf(crc_path, sizeof(crc_path), "%s%s", to_path, WAL_CRC_SUFFIX);
+	fp = fopen(crc_path, "r");
+	if (fp == NULL)
+		return false;
 
-	errmsg = gzerror(gzf, &gz_errnum);
-	if (gz_errnum == Z_ERRNO)
-		return strerror(errnum);
-	else
-		return errmsg;
+	ok = fscanf(fp, "%u", &value) == 1;
+	fclose(fp);
+
+	if (ok)
+		*crc = (pg_crc32) value;
+	return ok;
 }
-#endif
 
 /*
- * Copy file attributes
+ * Write CRC of uncompressed content of archived WAL segment "to_path" into
+ * its checksum file. Errors are not fatal, without the checksum file the
+ * segment is compared by content.
  */
 static void
-copy_meta(const char *from_path, const char *to_path, bool unlink_on_error)
+write_wal_crc_file(const char *to_path, pg_crc32 crc)
 {
-	struct stat st;
+	char		crc_path[MAXPGPATH];
+	char		crc_path_temp[MAXPGPATH];
+	FILE	   *fp;
 
-	if (stat(from_path, &st) == -1)
+	snprintf(crc_path, sizeof(crc_path), "%s%s", to_path, WAL_CRC_SUFFIX);
+	snprintf(crc_path_temp, sizeof(crc_path_temp), "%s.partial", crc_path);
+
+	fp = fopen(crc_path_temp, PG_BINARY_W);
+	if (fp == NULL)
 	{
-		if (unlink_on_error)
-			unlink(to_path);
-		elog(ERROR, "Cannot stat file \"%s\": %s",
-			 from_path, strerror(errno));
+		elog(WARNING, "Cannot open checksum file \"%s\": %s",
+			 crc_path_temp, strerror(errno));
+		return;
 	}
 
-	if (chmod(to_path, st.st_mode) == -1)
+	if (fprintf(fp, "%u\n", (unsigned int) crc) < 0 ||
+		fflush(fp) != 0 ||
+		fsync(fileno(fp)) != 0 ||
+		fclose(fp) != 0)
 	{
-		if (unlink_on_error)
-			unlink(to_path);
-		elog(ERROR, "Cannot change mode of file \"%s\": %s",
-			 to_path, strerror(errno));
+		elog(WARNING, "Cannot write checksum file \"%s\": %s",
+			 crc_path_temp, strerror(errno));
+		unlink(crc_path_temp);
+		return;
+	}
+
+	if (rename(crc_path_temp, crc_path) < 0)
+	{
+		elog(WARNING, "Cannot rename checksum file \"%s\" to \"%s\": %s",
+			 crc_path_temp, crc_path, strerror(errno));
+		unlink(crc_path_temp);
 	}
 }
 
 /*
  * Copy WAL segment from pgdata to archive catalog with possible compression.
+ * Compression algorithm is instance_config.compress_alg, zstd may use up to
+ * compress_threads threads.
+ *
+ * CRC of the segment is stored in the checksum file next to the archived
+ * segment, so that pushing the same segment again needs to read only the
+ * source segment.
  */
 void
 push_wal_file(const char *from_path, const char *to_path, bool is_compress,
-			  bool overwrite)
+			  bool overwrite, int compress_threads)
 {
 	FILE	   *in = NULL;
 	int			out;
 	char		buf[XLOG_BLCKSZ];
 	const char *to_path_p;
 	char		to_path_temp[MAXPGPATH];
+	char		compressed_to_path[MAXPGPATH];
 	int			errno_temp;
+	pg_crc32	crc;
+	/* Checksum files are kept for WAL segments only */
+	bool		use_crc_file = IsXLogFileName(last_dir_separator(to_path) + 1);
+	/* zstd and lz4 compress the whole segment at once */
+	bool		is_frame = is_compress &&
+		instance_config.compress_alg != ZLIB_COMPRESS;
 
 #ifdef HAVE_LIBZ
-	char		gz_to_path[MAXPGPATH];
 	gzFile		gz_out = NULL;
+#endif
+
 	if (is_compress)
 	{
-		snprintf(gz_to_path, sizeof(gz_to_path), "%s.gz", to_path);
-		to_path_p = gz_to_path;
+		snprintf(compressed_to_path, sizeof(compressed_to_path), "%s%s",
+				 to_path, wal_compress_suffix(instance_config.compress_alg));
+		to_path_p = compressed_to_path;
 	}
 	else
-#endif
 		to_path_p = to_path;
 
 	/* open file for read */
@@ -1129,91 +2840,159 @@ push_wal_file(const char *from_path, const char *to_path, bool is_compress,
 	/* Check if possible to skip copying */
 	if (fileExists(to_path_p))
 	{
-		if (fileEqualCRC(from_path, to_path_p, is_compress))
+		pg_crc32	archived_crc;
+		bool		equal;
+
+		if (use_crc_file && read_wal_crc_file(to_path, &archived_crc))
+		{
+			crc = pgFileGetCRC(from_path, true, true, NULL);
+			equal = EQ_CRC32C(crc, archived_crc);
+		}
+		else
+			/* Segment archived by older version, compare content */
+			equal = fileEqualCRC(from_path, to_path_p, is_compress);
+
+		/* Do not copy and do not rise error. Just quit as normal. */
+		if (equal)
+		{
+			fclose(in);
 			return;
-			/* Do not copy and do not rise error. Just quit as normal. */
+		}
 		else if (!overwrite)
 			elog(ERROR, "WAL segment \"%s\" already exists.", to_path_p);
 	}
 
-	/* open backup file for write  */
-#ifdef HAVE_LIBZ
-	if (is_compress)
+	/*
+	 * Remove the checksum and the block summary of the segment to be
+	 * overwritten before the segment itself is replaced.
+	 */
+	if (use_crc_file)
 	{
-		snprintf(to_path_temp, sizeof(to_path_temp), "%s.partial", gz_to_path);
+		snprintf(to_path_temp, sizeof(to_path_temp), "%s%s", to_path,
+				 WAL_CRC_SUFFIX);
+		if (unlink(to_path_temp) != 0 && errno != ENOENT)
+			elog(ERROR, "Cannot remove checksum file \"%s\": %s",
+				 to_path_temp, strerror(errno));
 
-		out = open(to_path_temp, O_RDWR | O_CREAT | O_EXCL | PG_BINARY,
-				   S_IRUSR | S_IWUSR);
-		if (out < 0)
-			elog(ERROR, "Cannot open destination temporary WAL file \"%s\": %s",
+		snprintf(to_path_temp, sizeof(to_path_temp), "%s%s", to_path,
+				 WAL_SUMMARY_SUFFIX);
+		if (unlink(to_path_temp) != 0 && errno != ENOENT)
+			elog(ERROR, "Cannot remove block summary file \"%s\": %s",
 				 to_path_temp, strerror(errno));
+	}
+
+	INIT_FILE_CRC32(true, crc);
+
+	/* open backup file for write  */
+	snprintf(to_path_temp, sizeof(to_path_temp), "%s.partial", to_path_p);
+
+	out = open(to_path_temp, O_RDWR | O_CREAT | O_EXCL | PG_BINARY,
+			   S_IRUSR | S_IWUSR);
+	if (out < 0)
+		elog(ERROR, "Cannot open destination temporary WAL file \"%s\": %s",
+			 to_path_temp, strerror(errno));
 
+#ifdef HAVE_LIBZ
+	if (is_compress && !is_frame)
+	{
 		gz_out = gzdopen(out, PG_BINARY_W);
 		if (gzsetparams(gz_out, instance_config.compress_level, Z_DEFAULT_STRATEGY) != Z_OK)
 			elog(ERROR, "Cannot set compression level %d to file \"%s\": %s",
 				 instance_config.compress_level, to_path_temp,
 				 get_gz_error(gz_out, errno));
 	}
-	else
 #endif
-	{
-		snprintf(to_path_temp, sizeof(to_path_temp), "%s.partial", to_path);
-
-		out = open(to_path_temp, O_RDWR | O_CREAT | O_EXCL | PG_BINARY,
-				   S_IRUSR | S_IWUSR);
-		if (out < 0)
-			elog(ERROR, "Cannot open destination temporary WAL file \"%s\": %s",
-				 to_path_temp, strerror(errno));
-	}
 
-	/* copy content */
-	for (;;)
+	if (is_frame)
 	{
-		size_t		read_len = 0;
-
-		read_len = fread(buf, 1, sizeof(buf), in);
+		char	   *src;
+		size_t		src_size;
+		char	   *dst;
+		size_t		dst_size;
+		const char *errormsg = NULL;
 
-		if (ferror(in))
+		src = read_whole_file(from_path, &src_size);
+		if (src == NULL)
 		{
 			errno_temp = errno;
 			unlink(to_path_temp);
-			elog(ERROR,
-				 "Cannot read source WAL file \"%s\": %s",
+			elog(ERROR, "Cannot read source WAL file \"%s\": %s",
 				 from_path, strerror(errno_temp));
 		}
 
-		if (read_len > 0)
+		COMP_FILE_CRC32(true, crc, src, src_size);
+		dst = compress_wal_frame(src, src_size, instance_config.compress_alg,
+								 instance_config.compress_level,
+								 compress_threads, &dst_size, &errormsg);
+		free(src);
+		if (dst == NULL)
 		{
-#ifdef HAVE_LIBZ
-			if (is_compress)
+			unlink(to_path_temp);
+			elog(ERROR, "Cannot compress WAL file \"%s\": %s",
+				 from_path, errormsg);
+		}
+
+		if (write(out, dst, dst_size) != dst_size)
+		{
+			errno_temp = errno;
+			unlink(to_path_temp);
+			elog(ERROR, "Cannot write to compressed WAL file \"%s\": %s",
+				 to_path_temp, strerror(errno_temp));
+		}
+		free(dst);
+	}
+	else
+	{
+		/* copy content */
+		for (;;)
+		{
+			size_t		read_len = 0;
+
+			read_len = fread(buf, 1, sizeof(buf), in);
+
+			if (ferror(in))
+			{
+				errno_temp = errno;
+				unlink(to_path_temp);
+				elog(ERROR,
+					 "Cannot read source WAL file \"%s\": %s",
+					 from_path, strerror(errno_temp));
+			}
+
+			if (read_len > 0)
 			{
-				if (gzwrite(gz_out, buf, read_len) != read_len)
+				COMP_FILE_CRC32(true, crc, buf, read_len);
+#ifdef HAVE_LIBZ
+				if (is_compress)
 				{
-					errno_temp = errno;
-					unlink(to_path_temp);
-					elog(ERROR, "Cannot write to compressed WAL file \"%s\": %s",
-						 to_path_temp, get_gz_error(gz_out, errno_temp));
+					if (gzwrite(gz_out, buf, read_len) != read_len)
+					{
+						errno_temp = errno;
+						unlink(to_path_temp);
+						elog(ERROR, "Cannot write to compressed WAL file \"%s\": %s",
+							 to_path_temp, get_gz_error(gz_out, errno_temp));
+					}
 				}
-			}
-			else
+				else
 #endif
-			{
-				if (write(out, buf, read_len) != read_len)
 				{
-					errno_temp = errno;
-					unlink(to_path_temp);
-					elog(ERROR, "Cannot write to WAL file \"%s\": %s",
-						 to_path_temp, strerror(errno_temp));
+					if (write(out, buf, read_len) != read_len)
+					{
+						errno_temp = errno;
+						unlink(to_path_temp);
+						elog(ERROR, "Cannot write to WAL file \"%s\": %s",
+							 to_path_temp, strerror(errno_temp));
+					}
 				}
 			}
-		}
 
-		if (feof(in) || read_len == 0)
-			break;
+			if (feof(in) || read_len == 0)
+				break;
+		}
 	}
 
 #ifdef HAVE_LIBZ
-	if (is_compress)
+	if (is_compress && !is_frame)
 	{
 		if (gzclose(gz_out) != 0)
 		{
@@ -1254,10 +3033,12 @@ push_wal_file(const char *from_path, const char *to_path, bool is_compress,
 			 to_path_temp, to_path_p, strerror(errno_temp));
 	}
 
-#ifdef HAVE_LIBZ
+	FIN_FILE_CRC32(true, crc);
+	if (use_crc_file)
+		write_wal_crc_file(to_path, crc);
+
 	if (is_compress)
-		elog(INFO, "WAL file compressed to \"%s\"", gz_to_path);
-#endif
+		elog(INFO, "WAL file compressed to \"%s\"", compressed_to_path);
 }
 
 /*
@@ -1271,11 +3052,14 @@ get_wal_file(const char *from_path, const char *to_path)
 	char		buf[XLOG_BLCKSZ];
 	const char *from_path_p = from_path;
 	char		to_path_temp[MAXPGPATH];
+	char		compressed_from_path[MAXPGPATH];
 	int			errno_temp;
-	bool		is_decompress = false;
+	CompressAlg	calg = NONE_COMPRESS;
+	/* Decompressed zstd or lz4 segment */
+	char	   *frame_data = NULL;
+	size_t		frame_size = 0;
 
 #ifdef HAVE_LIBZ
-	char		gz_from_path[MAXPGPATH];
 	gzFile		gz_in = NULL;
 #endif
 
@@ -1283,35 +3067,34 @@ get_wal_file(const char *from_path, const char *to_path)
 	in = fopen(from_path, PG_BINARY_R);
 	if (in == NULL)
 	{
+		int			errno_open = errno;
+
+		/* Maybe we need to decompress the file */
+		calg = find_compressed_wal_file(from_path, compressed_from_path);
+		if (calg == NONE_COMPRESS)
+			elog(ERROR, "Cannot open source WAL file \"%s\": %s",
+				 from_path, strerror(errno_open));
+
+		from_path_p = compressed_from_path;
 #ifdef HAVE_LIBZ
-		/*
-		 * Maybe we need to decompress the file. Check it with .gz
-		 * extension.
-		 */
-		snprintf(gz_from_path, sizeof(gz_from_path), "%s.gz", from_path);
-		gz_in = gzopen(gz_from_path, PG_BINARY_R);
-		if (gz_in == NULL)
+		if (calg == ZLIB_COMPRESS)
 		{
-			if (errno == ENOENT)
-			{
-				/* There is no compressed file too, raise an error below */
-			}
-			/* Cannot open compressed file for some reason */
-			else
+			gz_in = gzopen(compressed_from_path, PG_BINARY_R);
+			if (gz_in == NULL)
 				elog(ERROR, "Cannot open compressed WAL file \"%s\": %s",
-					 gz_from_path, strerror(errno));
+					 compressed_from_path, strerror(errno));
 		}
 		else
+#endif
 		{
-			/* Found compressed file */
-			is_decompress = true;
-			from_path_p = gz_from_path;
+			const char *errormsg = NULL;
+
+			frame_data = decompress_wal_file(compressed_from_path, calg,
+											 &frame_size, &errormsg);
+			if (frame_data == NULL)
+				elog(ERROR, "Cannot decompress WAL file \"%s\": %s",
+					 compressed_from_path, errormsg);
 		}
-#endif
-		/* Didn't find compressed file */
-		if (!is_decompress)
-			elog(ERROR, "Cannot open source WAL file \"%s\": %s",
-				 from_path, strerror(errno));
 	}
 
 	/* open backup file for write  */
@@ -1323,59 +3106,73 @@ get_wal_file(const char *from_path, const char *to_path)
 		elog(ERROR, "Cannot open destination temporary WAL file \"%s\": %s",
 				to_path_temp, strerror(errno));
 
-	/* copy content */
-	for (;;)
+	if (frame_data)
 	{
-		size_t		read_len = 0;
+		if (write(out, frame_data, frame_size) != frame_size)
+		{
+			errno_temp = errno;
+			unlink(to_path_temp);
+			elog(ERROR, "Cannot write to WAL file \"%s\": %s", to_path_temp,
+				 strerror(errno_temp));
+		}
+		free(frame_data);
+	}
+	else
+	{
+		/* copy content */
+		for (;;)
+		{
+			size_t		read_len = 0;
 
 #ifdef HAVE_LIBZ
-		if (is_decompress)
-		{
-			read_len = gzread(gz_in, buf, sizeof(buf));
-			if (read_len != sizeof(buf) && !gzeof(gz_in))
+			if (gz_in)
 			{
-				errno_temp = errno;
-				unlink(to_path_temp);
-				elog(ERROR, "Cannot read compressed WAL file \"%s\": %s",
-					 gz_from_path, get_gz_error(gz_in, errno_temp));
+				read_len = gzread(gz_in, buf, sizeof(buf));
+				if (read_len != sizeof(buf) && !gzeof(gz_in))
+				{
+					errno_temp = errno;
+					unlink(to_path_temp);
+					elog(ERROR, "Cannot read compressed WAL file \"%s\": %s",
+						 compressed_from_path, get_gz_error(gz_in, errno_temp));
+				}
 			}
-		}
-		else
+			else
 #endif
-		{
-			read_len = fread(buf, 1, sizeof(buf), in);
-			if (ferror(in))
 			{
-				errno_temp = errno;
-				unlink(to_path_temp);
-				elog(ERROR, "Cannot read source WAL file \"%s\": %s",
-					 from_path, strerror(errno_temp));
+				read_len = fread(buf, 1, sizeof(buf), in);
+				if (ferror(in))
+				{
+					errno_temp = errno;
+					unlink(to_path_temp);
+					elog(ERROR, "Cannot read source WAL file \"%s\": %s",
+						 from_path, strerror(errno_temp));
+				}
 			}
-		}
 
-		if (read_len > 0)
-		{
-			if (write(out, buf, read_len) != read_len)
+			if (read_len > 0)
 			{
-				errno_temp = errno;
-				unlink(to_path_temp);
-				elog(ERROR, "Cannot write to WAL file \"%s\": %s", to_path_temp,
-					 strerror(errno_temp));
+				if (write(out, buf, read_len) != read_len)
+				{
+					errno_temp = errno;
+					unlink(to_path_temp);
+					elog(ERROR, "Cannot write to WAL file \"%s\": %s", to_path_temp,
+						 strerror(errno_temp));
+				}
 			}
-		}
 
-		/* Check for EOF */
+			/* Check for EOF */
 #ifdef HAVE_LIBZ
-		if (is_decompress)
-		{
-			if (gzeof(gz_in) || read_len == 0)
-				break;
-		}
-		else
+			if (gz_in)
+			{
+				if (gzeof(gz_in) || read_len == 0)
+					break;
+			}
+			else
 #endif
-		{
-			if (feof(in) || read_len == 0)
-				break;
+			{
+				if (feof(in) || read_len == 0)
+					break;
+			}
 		}
 	}
 
@@ -1388,18 +3185,19 @@ get_wal_file(const char *from_path, const char *to_path)
 	}
 
 #ifdef HAVE_LIBZ
-	if (is_decompress)
+	if (gz_in)
 	{
 		if (gzclose(gz_in) != 0)
 		{
 			errno_temp = errno;
 			unlink(to_path_temp);
 			elog(ERROR, "Cannot close compressed WAL file \"%s\": %s",
-				 gz_from_path, get_gz_error(gz_in, errno_temp));
+				 compressed_from_path, get_gz_error(gz_in, errno_temp));
 		}
 	}
 	else
 #endif
+	if (in)
 	{
 		if (fclose(in))
 		{
@@ -1421,10 +3219,8 @@ get_wal_file(const char *from_path, const char *to_path)
 			 to_path_temp, to_path, strerror(errno_temp));
 	}
 
-#ifdef HAVE_LIBZ
-	if (is_decompress)
-		elog(INFO, "WAL file decompressed from \"%s\"", gz_from_path);
-#endif
+	if (calg != NONE_COMPRESS)
+		elog(INFO, "WAL file decompressed from \"%s\"", compressed_from_path);
 }
 
 /*
@@ -1567,7 +3363,7 @@ check_file_pages(pgFile *file, XLogRecPtr stop_lsn, uint32 checksum_version,
 	bool		is_valid = true;
 	FILE		*in;
 	pg_crc32	crc;
-	bool		use_crc32c = backup_version <= 20021 || backup_version >= 20025;
+	bool		use_crc32c = BACKUP_USES_CRC32C(backup_version);
 
 	elog(VERBOSE, "validate relation blocks for file %s", file->path);
 
@@ -1703,8 +3499,25 @@ fileEqualCRC(const char *path1, const char *path2, bool path2_is_compressed)
 	pg_crc32	crc2;
 
 	/* Get checksum of backup file */
+	if (path2_is_compressed && instance_config.compress_alg != ZLIB_COMPRESS)
+	{
+		char	   *data;
+		size_t		size;
+		const char *errormsg = NULL;
+
+		data = decompress_wal_file(path2, instance_config.compress_alg,
+								   &size, &errormsg);
+		if (data == NULL)
+			elog(ERROR, "Cannot compare WAL file \"%s\" with compressed \"%s\": %s",
+				 path1, path2, errormsg);
+
+		INIT_FILE_CRC32(true, crc2);
+		COMP_FILE_CRC32(true, crc2, data, size);
+		FIN_FILE_CRC32(true, crc2);
+		free(data);
+	}
 #ifdef HAVE_LIBZ
-	if (path2_is_compressed)
+	else if (path2_is_compressed)
 	{
 		char 		buf [1024];
 		gzFile		gz_in = NULL;
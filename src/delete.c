@@ -369,12 +369,15 @@ delete_walfiles(XLogRecPtr oldest_lsn, TimeLineID oldest_tli,
 			 * file. Note that this means files are not removed in the order
 			 * they were originally written, in case this worries you.
 			 *
-			 * We also should not forget that WAL segment can be compressed.
+			 * We also should not forget that WAL segment can be compressed
+			 * and has checksum and block summary files.
 			 */
 			if (IsXLogFileName(arcde->d_name) ||
 				IsPartialXLogFileName(arcde->d_name) ||
 				IsBackupHistoryFileName(arcde->d_name) ||
-				IsCompressedXLogFileName(arcde->d_name))
+				IsCompressedXLogFileName(arcde->d_name) ||
+				IsXLogChecksumFileName(arcde->d_name) ||
+				IsXLogSummaryFileName(arcde->d_name))
 			{
 				if (XLogRecPtrIsInvalid(oldest_lsn) ||
 					strncmp(arcde->d_name + 8, oldestSegmentNeeded + 8, 16) < 0)
@@ -15,6 +15,7 @@
 #endif
 #include "catalog/pg_tablespace.h"
 
+#include <fcntl.h>
 #include <unistd.h>
 #include <sys/stat.h>
 #include <dirent.h>
@@ -116,8 +117,66 @@ typedef struct TablespaceCreatedList
 	TablespaceCreatedListCell *tail;
 } TablespaceCreatedList;
 
+/*
+ * Binary backup content list.
+ *
+ * The file starts with FileListHeader followed by nfiles FileListEntry
+ * sorted by path and the string table holding NUL-terminated paths.
+ * Offset 0 of the string table is always an empty string, it is used for
+ * absent optional strings. Integers are stored in little-endian byte order,
+ * so the list can be read on a host with another byte order; the CRC is
+ * computed over the stored bytes.
+ */
+#define FILE_LIST_MAGIC		"PGPBFL\n"
+#define FILE_LIST_VERSION	2
+
+typedef struct FileListHeader
+{
+	char		magic[8];		/* FILE_LIST_MAGIC */
+	uint32		version;		/* FILE_LIST_VERSION */
+	uint32		nfiles;			/* number of entries */
+	uint32		strtab_size;	/* size of string table */
+	pg_crc32	crc;			/* CRC of entries and string table */
+} FileListHeader;
+
+typedef struct FileListEntry
+{
+	int64		write_size;
+	uint32		path;			/* offset of path in string table */
+	uint32		linked;			/* offset of linked path, 0 if none */
+	uint32		mode;
+	pg_crc32	crc;
+	int32		segno;
+	int32		n_blocks;
+	uint8		is_datafile;
+	uint8		is_cfs;
+	uint8		compress_alg;
+	uint8		padding[5];
+} FileListEntry;
+
+struct FileList
+{
+	char	   *data;			/* content of binary list */
+	uint32		nfiles;
+	FileListEntry *entries;
+	char	   *strtab;
+	parray	   *files;			/* text list of older versions, sorted by path */
+};
+
+/* Used to sort files by relative path before writing binary list */
+typedef struct FileListSortItem
+{
+	const char *path;
+	pgFile	   *file;
+} FileListSortItem;
+
 static int BlackListCompare(const void *str1, const void *str2);
 
+#ifdef WORDS_BIGENDIAN
+static void file_list_header_swap(FileListHeader *header);
+static void file_list_entries_swap(FileListEntry *entries, uint32 nfiles);
+#endif
+
 static char dir_check_file(const char *root, pgFile *file);
 static void dir_list_file_internal(parray *files, const char *root,
 								   pgFile *parent, bool exclude,
@@ -260,22 +319,30 @@ delete_file:
 	}
 }
 
+/*
+ * Compute CRC of the file content. CRC-32 is needed only for files of backups
+ * taken by some older versions, see BACKUP_USES_CRC32C.
+ *
+ * The file is read by large chunks bypassing stdio buffering, the buffer is
+ * not larger than the file itself, so small files are cheap too.
+ */
 pg_crc32
 pgFileGetCRC(const char *file_path, bool use_crc32c, bool raise_on_deleted,
 			 size_t *bytes_read)
 {
-	FILE	   *fp;
+	int			fd;
+	struct stat	st;
 	pg_crc32	crc = 0;
-	char		buf[1024];
-	size_t		len;
+	char	   *buf;
+	size_t		bufsize = CRC_READ_BUFSIZE;
+	ssize_t		len;
 	size_t		total = 0;
-	int			errno_tmp;
 
 	INIT_FILE_CRC32(use_crc32c, crc);
 
 	/* open file in binary read mode */
-	fp = fopen(file_path, PG_BINARY_R);
-	if (fp == NULL)
+	fd = open(file_path, O_RDONLY | PG_BINARY, 0);
+	if (fd < 0)
 	{
 		if (!raise_on_deleted && errno == ENOENT)
 		{
@@ -287,14 +354,33 @@ pgFileGetCRC(const char *file_path, bool use_crc32c, bool raise_on_deleted,
 				file_path, strerror(errno));
 	}
 
+	/* Small file is read by one call, do not allocate more than it needs */
+	if (fstat(fd, &st) == 0 && (size_t) st.st_size < bufsize)
+		bufsize = Max((size_t) st.st_size + 1, BLCKSZ);
+
+#if defined(HAVE_POSIX_FADVISE) && defined(POSIX_FADV_SEQUENTIAL)
+	if (bufsize == CRC_READ_BUFSIZE)
+		(void) posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL);
+#endif
+
+	buf = pgut_malloc(bufsize);
+
 	/* calc CRC of file */
 	for (;;)
 	{
 		if (interrupted)
 			elog(ERROR, "interrupted during CRC calculation");
 
-		len = fread(buf, 1, sizeof(buf), fp);
-		if(len == 0)
+		len = read(fd, buf, bufsize);
+		if (len < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			elog(WARNING, "cannot read \"%s\": %s", file_path,
+				strerror(errno));
+			break;
+		}
+		if (len == 0)
 			break;
 		/* update CRC */
 		COMP_FILE_CRC32(use_crc32c, crc, buf, len);
@@ -304,13 +390,9 @@ pgFileGetCRC(const char *file_path, bool use_crc32c, bool raise_on_deleted,
 	if (bytes_read)
 		*bytes_read = total;
 
-	errno_tmp = errno;
-	if (!feof(fp))
-		elog(WARNING, "cannot read \"%s\": %s", file_path,
-			strerror(errno_tmp));
-
 	FIN_FILE_CRC32(use_crc32c, crc);
-	fclose(fp);
+	free(buf);
+	close(fd);
 
 	return crc;
 }
@@ -954,6 +1036,29 @@ opt_tablespace_map(ConfigOption *opt, const char *arg)
 	tablespace_dirs.tail = cell;
 }
 
+/*
+ * Check whether symlink() failed because the link already points to the
+ * linked path, it happens during incremental restore. errno is preserved.
+ */
+static bool
+symlink_exists(const char *link_path, const char *linked_path)
+{
+	char		buf[MAXPGPATH];
+	int			len;
+	int			errno_tmp = errno;
+
+	if (errno_tmp != EEXIST)
+		return false;
+
+	len = readlink(link_path, buf, sizeof(buf) - 1);
+	errno = errno_tmp;
+	if (len < 0)
+		return false;
+	buf[len] = '\0';
+
+	return strcmp(buf, linked_path) == 0;
+}
+
 /*
  * Create backup directories from **backup_dir** to **data_dir**. Doesn't raise
  * an error if target directories exist.
@@ -1071,7 +1176,8 @@ create_data_directories(const char *data_dir, const char *backup_dir,
 
 				/* Secondly, create link */
 				join_path_components(to_path, to_path, link_name);
-				if (symlink(linked_path, to_path) < 0)
+				if (symlink(linked_path, to_path) < 0 &&
+					!symlink_exists(to_path, linked_path))
 					elog(ERROR, "could not create symbolic link \"%s\": %s",
 						 to_path, strerror(errno));
 
@@ -1159,13 +1265,14 @@ read_tablespace_map(parray *files, const char *backup_dir)
 
 /*
  * Check that all tablespace mapping entries have correct linked directory
- * paths. Linked directories must be empty or do not exist.
+ * paths. Linked directories must be empty or do not exist, unless incremental
+ * restore is going to reuse their content.
  *
  * If tablespace-mapping option is supplied, all OLDDIR entries must have
  * entries in tablespace_map file.
  */
 void
-check_tablespace_mapping(pgBackup *backup)
+check_tablespace_mapping(pgBackup *backup, bool incremental)
 {
 	char		this_backup_path[MAXPGPATH];
 	parray	   *links;
@@ -1214,7 +1321,7 @@ check_tablespace_mapping(pgBackup *backup)
 			elog(ERROR, "tablespace directory is not an absolute path: %s\n",
 				 linked_path);
 
-		if (!dir_is_empty(linked_path))
+		if (!incremental && !dir_is_empty(linked_path))
 			elog(ERROR, "restore tablespace destination is not empty: \"%s\"",
 				 linked_path);
 	}
@@ -1224,198 +1331,203 @@ check_tablespace_mapping(pgBackup *backup)
 	parray_free(links);
 }
 
+/* Fields of a text backup content list line */
+typedef struct FileListLine
+{
+	char		path[MAXPGPATH];
+	char		linked[MAXPGPATH];
+	char		compress_alg[32];
+	int64		write_size;
+	int64		mode;		/* bit length of mode_t depends on platforms */
+	int64		is_datafile;
+	int64		is_cfs;
+	int64		crc;
+	int64		segno;
+	int64		n_blocks;
+	bool		has_path;
+	bool		has_size;
+	bool		has_mode;
+	bool		has_is_datafile;
+	bool		has_crc;
+	bool		has_segno;
+	bool		has_n_blocks;
+} FileListLine;
+
 /*
- * Print backup content list.
+ * Parse integer value of the field "name" of text backup content list line.
  */
-void
-print_file_list(FILE *out, const parray *files, const char *root)
+static int64
+parse_control_int64(const char *value, const char *name, const char *line)
 {
-	size_t		i;
-
-	/* print each file in the list */
-	for (i = 0; i < parray_num(files); i++)
-	{
-		pgFile	   *file = (pgFile *) parray_get(files, i);
-		char	   *path = file->path;
-
-		/* omit root directory portion */
-		if (root && strstr(path, root) == path)
-			path = GetRelativePath(path, root);
-
-		fprintf(out, "{\"path\":\"%s\", \"size\":\"" INT64_FORMAT "\", "
-					 "\"mode\":\"%u\", \"is_datafile\":\"%u\", "
-					 "\"is_cfs\":\"%u\", \"crc\":\"%u\", "
-					 "\"compress_alg\":\"%s\"",
-				path, file->write_size, file->mode,
-				file->is_datafile ? 1 : 0, file->is_cfs ? 1 : 0, file->crc,
-				deparse_compress_alg(file->compress_alg));
-
-		if (file->is_datafile)
-			fprintf(out, ",\"segno\":\"%d\"", file->segno);
-
-		if (file->linked)
-			fprintf(out, ",\"linked\":\"%s\"", file->linked);
+	int64		result;
 
-		if (file->n_blocks != BLOCKNUM_INVALID)
-			fprintf(out, ",\"n_blocks\":\"%i\"", file->n_blocks);
+	/* Length of value should not be greater than 31 */
+	if (strlen(value) >= 32)
+		elog(ERROR, "field \"%s\" is out of range in the line %s of the file %s",
+			 name, line, DATABASE_FILE_LIST);
 
-		fprintf(out, "}\n");
+	if (!parse_int64(value, &result, 0))
+	{
+		/* We assume that too big value is -1 */
+		if (errno == ERANGE)
+			return BYTES_INVALID;
+		elog(ERROR, "%s file has invalid format in line %s",
+			 DATABASE_FILE_LIST, line);
 	}
-}
 
-/* Parsing states for get_control_value() */
-#define CONTROL_WAIT_NAME			1
-#define CONTROL_INNAME				2
-#define CONTROL_WAIT_COLON			3
-#define CONTROL_WAIT_VALUE			4
-#define CONTROL_INVALUE				5
-#define CONTROL_WAIT_NEXT_NAME		6
+	return result;
+}
 
 /*
- * Get value from json-like line "str" of backup_content.control file.
+ * Parse json-like line "line" of backup_content.control file.
  *
  * The line has the following format:
  *   {"name1":"value1", "name2":"value2"}
  *
- * The value will be returned to "value_str" as string if it is not NULL. If it
- * is NULL the value will be returned to "value_int64" as int64.
- *
- * Returns true if the value was found in the line.
+ * The line is scanned only once, every known field is stored into "fields".
+ * Unknown fields are ignored, they could be added by newer versions.
  */
-static bool
-get_control_value(const char *str, const char *name,
-				  char *value_str, int64 *value_int64, bool is_mandatory)
+static void
+parse_file_list_line(const char *line, FileListLine *fields)
 {
-	int			state = CONTROL_WAIT_NAME;
-	char	   *name_ptr = (char *) name;
-	char	   *buf = (char *) str;
-	char		buf_int64[32],	/* Buffer for "value_int64" */
-			   *buf_int64_ptr = buf_int64;
-
-	/* Set default values */
-	if (value_str)
-		*value_str = '\0';
-	else if (value_int64)
-		*value_int64 = 0;
-
-	while (*buf)
+	const char *ptr = line;
+	char		name[32];
+	char		value[MAXPGPATH];
+
+	memset(fields, 0, sizeof(FileListLine));
+
+	while (IsSpace(*ptr))
+		ptr++;
+	if (*ptr != '{')
+		goto bad_format;
+	ptr++;
+
+	for (;;)
 	{
-		switch (state)
-		{
-			case CONTROL_WAIT_NAME:
-				if (*buf == '"')
-					state = CONTROL_INNAME;
-				else if (IsAlpha(*buf))
-					goto bad_format;
-				break;
-			case CONTROL_INNAME:
-				/* Found target field. Parse value. */
-				if (*buf == '"')
-					state = CONTROL_WAIT_COLON;
-				/* Check next field */
-				else if (*buf != *name_ptr)
-				{
-					name_ptr = (char *) name;
-					state = CONTROL_WAIT_NEXT_NAME;
-				}
-				else
-					name_ptr++;
-				break;
-			case CONTROL_WAIT_COLON:
-				if (*buf == ':')
-					state = CONTROL_WAIT_VALUE;
-				else if (!IsSpace(*buf))
-					goto bad_format;
-				break;
-			case CONTROL_WAIT_VALUE:
-				if (*buf == '"')
-				{
-					state = CONTROL_INVALUE;
-					buf_int64_ptr = buf_int64;
-				}
-				else if (IsAlpha(*buf))
-					goto bad_format;
-				break;
-			case CONTROL_INVALUE:
-				/* Value was parsed, exit */
-				if (*buf == '"')
-				{
-					if (value_str)
-					{
-						*value_str = '\0';
-					}
-					else if (value_int64)
-					{
-						/* Length of buf_uint64 should not be greater than 31 */
-						if (buf_int64_ptr - buf_int64 >= 32)
-							elog(ERROR, "field \"%s\" is out of range in the line %s of the file %s",
-								 name, str, DATABASE_FILE_LIST);
-
-						*buf_int64_ptr = '\0';
-						if (!parse_int64(buf_int64, value_int64, 0))
-						{
-							/* We assume that too big value is -1 */
-							if (errno == ERANGE)
-								*value_int64 = BYTES_INVALID;
-							else
-								goto bad_format;
-						}
-					}
+		const char *start;
+		size_t		len;
 
-					return true;
-				}
-				else
-				{
-					if (value_str)
-					{
-						*value_str = *buf;
-						value_str++;
-					}
-					else
-					{
-						*buf_int64_ptr = *buf;
-						buf_int64_ptr++;
-					}
-				}
-				break;
-			case CONTROL_WAIT_NEXT_NAME:
-				if (*buf == ',')
-					state = CONTROL_WAIT_NAME;
-				break;
-			default:
-				/* Should not happen */
-				break;
-		}
+		while (IsSpace(*ptr) || *ptr == ',')
+			ptr++;
+		if (*ptr == '}')
+			break;
 
-		buf++;
+		/* Field name */
+		if (*ptr != '"')
+			goto bad_format;
+		start = ++ptr;
+		while (*ptr && *ptr != '"')
+			ptr++;
+		if (*ptr != '"')
+			goto bad_format;
+		len = ptr - start;
+		/* Field names are short, longer one cannot be known to us */
+		if (len >= sizeof(name))
+			len = sizeof(name) - 1;
+		memcpy(name, start, len);
+		name[len] = '\0';
+		ptr++;
+
+		while (IsSpace(*ptr))
+			ptr++;
+		if (*ptr != ':')
+			goto bad_format;
+		ptr++;
+		while (IsSpace(*ptr))
+			ptr++;
+
+		/* Field value */
+		if (*ptr != '"')
+			goto bad_format;
+		start = ++ptr;
+		while (*ptr && *ptr != '"')
+			ptr++;
+		if (*ptr != '"')
+			goto bad_format;
+		len = ptr - start;
+		if (len >= sizeof(value))
+			elog(ERROR, "field \"%s\" is out of range in the line %s of the file %s",
+				 name, line, DATABASE_FILE_LIST);
+		memcpy(value, start, len);
+		value[len] = '\0';
+		ptr++;
+
+		if (strcmp(name, "path") == 0)
+		{
+			strcpy(fields->path, value);
+			fields->has_path = true;
+		}
+		else if (strcmp(name, "size") == 0)
+		{
+			fields->write_size = parse_control_int64(value, name, line);
+			fields->has_size = true;
+		}
+		else if (strcmp(name, "mode") == 0)
+		{
+			fields->mode = parse_control_int64(value, name, line);
+			fields->has_mode = true;
+		}
+		else if (strcmp(name, "is_datafile") == 0)
+		{
+			fields->is_datafile = parse_control_int64(value, name, line);
+			fields->has_is_datafile = true;
+		}
+		else if (strcmp(name, "is_cfs") == 0)
+			fields->is_cfs = parse_control_int64(value, name, line);
+		else if (strcmp(name, "crc") == 0)
+		{
+			fields->crc = parse_control_int64(value, name, line);
+			fields->has_crc = true;
+		}
+		else if (strcmp(name, "compress_alg") == 0)
+			StrNCpy(fields->compress_alg, value, sizeof(fields->compress_alg));
+		else if (strcmp(name, "linked") == 0)
+			strcpy(fields->linked, value);
+		else if (strcmp(name, "segno") == 0)
+		{
+			fields->segno = parse_control_int64(value, name, line);
+			fields->has_segno = true;
+		}
+		else if (strcmp(name, "n_blocks") == 0)
+		{
+			fields->n_blocks = parse_control_int64(value, name, line);
+			fields->has_n_blocks = true;
+		}
 	}
 
-	/* There is no close quotes */
-	if (state == CONTROL_INNAME || state == CONTROL_INVALUE)
-		goto bad_format;
-
-	/* Did not find target field */
-	if (is_mandatory)
+	if (!fields->has_path)
+		elog(ERROR, "field \"%s\" is not found in the line %s of the file %s",
+			 "path", line, DATABASE_FILE_LIST);
+	if (!fields->has_size)
+		elog(ERROR, "field \"%s\" is not found in the line %s of the file %s",
+			 "size", line, DATABASE_FILE_LIST);
+	if (!fields->has_mode)
+		elog(ERROR, "field \"%s\" is not found in the line %s of the file %s",
+			 "mode", line, DATABASE_FILE_LIST);
+	if (!fields->has_is_datafile)
+		elog(ERROR, "field \"%s\" is not found in the line %s of the file %s",
+			 "is_datafile", line, DATABASE_FILE_LIST);
+	if (!fields->has_crc)
 		elog(ERROR, "field \"%s\" is not found in the line %s of the file %s",
-			 name, str, DATABASE_FILE_LIST);
-	return false;
+			 "crc", line, DATABASE_FILE_LIST);
+	return;
 
 bad_format:
 	elog(ERROR, "%s file has invalid format in line %s",
-		 DATABASE_FILE_LIST, str);
-	return false;	/* Make compiler happy */
+		 DATABASE_FILE_LIST, line);
 }
 
 /*
- * Construct parray of pgFile from the backup content list.
+ * Construct parray of pgFile from the text backup content list.
  * If root is not NULL, path will be absolute path.
  */
-parray *
-dir_read_file_list(const char *root, const char *file_txt)
+static parray *
+read_file_list_text(const char *root, const char *file_txt)
 {
 	FILE   *fp;
 	parray *files;
 	char	buf[MAXPGPATH * 2];
+	FileListLine fields;
 
 	fp = fopen(file_txt, "rt");
 	if (fp == NULL)
@@ -1425,53 +1537,37 @@ dir_read_file_list(const char *root, const char *file_txt)
 
 	while (fgets(buf, lengthof(buf), fp))
 	{
-		char		path[MAXPGPATH];
 		char		filepath[MAXPGPATH];
-		char		linked[MAXPGPATH];
-		char		compress_alg_string[MAXPGPATH];
-		int64		write_size,
-					mode,		/* bit length of mode_t depends on platforms */
-					is_datafile,
-					is_cfs,
-					crc,
-					segno,
-					n_blocks;
 		pgFile	   *file;
 
-		get_control_value(buf, "path", path, NULL, true);
-		get_control_value(buf, "size", NULL, &write_size, true);
-		get_control_value(buf, "mode", NULL, &mode, true);
-		get_control_value(buf, "is_datafile", NULL, &is_datafile, true);
-		get_control_value(buf, "is_cfs", NULL, &is_cfs, false);
-		get_control_value(buf, "crc", NULL, &crc, true);
-		get_control_value(buf, "compress_alg", compress_alg_string, NULL, false);
+		parse_file_list_line(buf, &fields);
 
 		if (root)
-			join_path_components(filepath, root, path);
+			join_path_components(filepath, root, fields.path);
 		else
-			strcpy(filepath, path);
+			strcpy(filepath, fields.path);
 
 		file = pgFileInit(filepath);
 
-		file->write_size = (int64) write_size;
-		file->mode = (mode_t) mode;
-		file->is_datafile = is_datafile ? true : false;
-		file->is_cfs = is_cfs ? true : false;
-		file->crc = (pg_crc32) crc;
-		file->compress_alg = parse_compress_alg(compress_alg_string);
+		file->write_size = (int64) fields.write_size;
+		file->mode = (mode_t) fields.mode;
+		file->is_datafile = fields.is_datafile ? true : false;
+		file->is_cfs = fields.is_cfs ? true : false;
+		file->crc = (pg_crc32) fields.crc;
+		file->compress_alg = parse_compress_alg(fields.compress_alg);
 
 		/*
 		 * Optional fields
 		 */
 
-		if (get_control_value(buf, "linked", linked, NULL, false) && linked[0])
-			file->linked = pgut_strdup(linked);
+		if (fields.linked[0])
+			file->linked = pgut_strdup(fields.linked);
 
-		if (get_control_value(buf, "segno", NULL, &segno, false))
-			file->segno = (int) segno;
+		if (fields.has_segno)
+			file->segno = (int) fields.segno;
 
-		if (get_control_value(buf, "n_blocks", NULL, &n_blocks, false))
-			file->n_blocks = (int) n_blocks;
+		if (fields.has_n_blocks)
+			file->n_blocks = (int) fields.n_blocks;
 
 		parray_append(files, file);
 	}
@@ -1480,6 +1576,409 @@ dir_read_file_list(const char *root, const char *file_txt)
 	return files;
 }
 
+/*
+ * Check if the backup content list is in binary format.
+ */
+static bool
+file_list_is_binary(const char *path)
+{
+	FILE	   *fp;
+	char		magic[sizeof(FILE_LIST_MAGIC)];
+	bool		result;
+
+	fp = fopen(path, PG_BINARY_R);
+	if (fp == NULL)
+		elog(ERROR, "cannot open \"%s\": %s", path, strerror(errno));
+
+	result = fread(magic, 1, sizeof(magic), fp) == sizeof(magic) &&
+		memcmp(magic, FILE_LIST_MAGIC, sizeof(magic)) == 0;
+
+	fclose(fp);
+	return result;
+}
+
+/*
+ * Construct parray of pgFile from the backup content list.
+ * If root is not NULL, path will be absolute path.
+ */
+parray *
+dir_read_file_list(const char *root, const char *file_txt)
+{
+	FileList   *list;
+	parray	   *files;
+	int			i;
+
+	if (!file_list_is_binary(file_txt))
+		return read_file_list_text(root, file_txt);
+
+	list = file_list_open(file_txt);
+	files = parray_new();
+	for (i = 0; i < file_list_num(list); i++)
+		parray_append(files, file_list_get(list, i, root));
+	file_list_close(list);
+
+	return files;
+}
+
+static int
+FileListSortItemCompare(const void *a, const void *b)
+{
+	return strcmp(((const FileListSortItem *) a)->path,
+				  ((const FileListSortItem *) b)->path);
+}
+
+/*
+ * Print backup content list in binary format. Entries are sorted by
+ * relative path, so the list can be searched without parsing it.
+ */
+void
+print_file_list_binary(FILE *out, const parray *files, const char *root)
+{
+	FileListHeader header;
+	FileListEntry *entries;
+	FileListSortItem *items;
+	char	   *strtab;
+	size_t		strtab_size = 1;
+	size_t		strtab_len = 1;
+	size_t		nfiles = parray_num(files);
+	size_t		i;
+
+	items = (FileListSortItem *) pgut_malloc(sizeof(FileListSortItem) *
+											 Max(nfiles, 1));
+	for (i = 0; i < nfiles; i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		const char *path = file->path;
+
+		/* omit root directory portion */
+		if (root && strstr(path, root) == path)
+			path = GetRelativePath(path, root);
+
+		items[i].path = path;
+		items[i].file = file;
+
+		strtab_size += strlen(path) + 1;
+		if (file->linked)
+			strtab_size += strlen(file->linked) + 1;
+	}
+
+	if (strtab_size > PG_UINT32_MAX)
+		elog(ERROR, "File list is too large");
+
+	qsort(items, nfiles, sizeof(FileListSortItem), FileListSortItemCompare);
+
+	strtab = (char *) pgut_malloc(strtab_size);
+	strtab[0] = '\0';
+	entries = (FileListEntry *) pgut_malloc(sizeof(FileListEntry) *
+											Max(nfiles, 1));
+	memset(entries, 0, sizeof(FileListEntry) * nfiles);
+
+	for (i = 0; i < nfiles; i++)
+	{
+		FileListEntry *entry = &entries[i];
+		pgFile	   *file = items[i].file;
+		size_t		len;
+
+		len = strlen(items[i].path) + 1;
+		memcpy(strtab + strtab_len, items[i].path, len);
+		entry->path = (uint32) strtab_len;
+		strtab_len += len;
+
+		if (file->linked)
+		{
+			len = strlen(file->linked) + 1;
+			memcpy(strtab + strtab_len, file->linked, len);
+			entry->linked = (uint32) strtab_len;
+			strtab_len += len;
+		}
+
+		entry->write_size = file->write_size;
+		entry->mode = (uint32) file->mode;
+		entry->crc = file->crc;
+		entry->segno = file->segno;
+		entry->n_blocks = file->n_blocks;
+		entry->is_datafile = file->is_datafile ? 1 : 0;
+		entry->is_cfs = file->is_cfs ? 1 : 0;
+		entry->compress_alg = (uint8) file->compress_alg;
+	}
+
+	memset(&header, 0, sizeof(header));
+	memcpy(header.magic, FILE_LIST_MAGIC, sizeof(header.magic));
+	header.version = FILE_LIST_VERSION;
+	header.nfiles = (uint32) nfiles;
+	header.strtab_size = (uint32) strtab_size;
+
+#ifdef WORDS_BIGENDIAN
+	file_list_entries_swap(entries, (uint32) nfiles);
+#endif
+
+	INIT_FILE_CRC32(true, header.crc);
+	COMP_FILE_CRC32(true, header.crc, entries, sizeof(FileListEntry) * nfiles);
+	COMP_FILE_CRC32(true, header.crc, strtab, strtab_size);
+	FIN_FILE_CRC32(true, header.crc);
+
+#ifdef WORDS_BIGENDIAN
+	file_list_header_swap(&header);
+#endif
+
+	if (fwrite(&header, 1, sizeof(header), out) != sizeof(header) ||
+		fwrite(entries, sizeof(FileListEntry), nfiles, out) != nfiles ||
+		fwrite(strtab, 1, strtab_size, out) != strtab_size)
+		elog(ERROR, "Cannot write file list: %s", strerror(errno));
+
+	free(items);
+	free(strtab);
+	free(entries);
+}
+
+/*
+ * Open backup content list for lookups.
+ *
+ * Binary list is loaded with one read and is not parsed: entries are
+ * materialized by file_list_get() only when requested. Text list of older
+ * versions is parsed with relative paths and sorted by path.
+ */
+FileList *
+file_list_open(const char *path)
+{
+	FileList   *list = pgut_new(FileList);
+	FileListHeader *header;
+	FILE	   *fp;
+	struct stat	st;
+	size_t		entries_size;
+	pg_crc32	crc;
+
+	memset(list, 0, sizeof(FileList));
+
+	if (!file_list_is_binary(path))
+	{
+		list->files = read_file_list_text(NULL, path);
+		parray_qsort(list->files, pgFileComparePath);
+		list->nfiles = parray_num(list->files);
+		return list;
+	}
+
+	fp = fopen(path, PG_BINARY_R);
+	if (fp == NULL)
+		elog(ERROR, "cannot open \"%s\": %s", path, strerror(errno));
+	if (fstat(fileno(fp), &st) != 0)
+		elog(ERROR, "cannot stat \"%s\": %s", path, strerror(errno));
+
+	list->data = (char *) pgut_malloc(Max(st.st_size, 1));
+	if (fread(list->data, 1, st.st_size, fp) != st.st_size)
+		elog(ERROR, "cannot read \"%s\": %s", path, strerror(errno));
+	fclose(fp);
+
+	if (st.st_size < sizeof(FileListHeader))
+		elog(ERROR, "%s file has invalid format: file is truncated", path);
+
+	header = (FileListHeader *) list->data;
+#ifdef WORDS_BIGENDIAN
+	file_list_header_swap(header);
+#endif
+	if (header->version != FILE_LIST_VERSION)
+		elog(ERROR, "%s file has unsupported version %u", path,
+			 header->version);
+
+	entries_size = sizeof(FileListEntry) * (size_t) header->nfiles;
+	if (sizeof(FileListHeader) + entries_size + header->strtab_size != st.st_size ||
+		header->strtab_size == 0)
+		elog(ERROR, "%s file has invalid format: wrong size", path);
+
+	list->nfiles = header->nfiles;
+	list->entries = (FileListEntry *) (list->data + sizeof(FileListHeader));
+	list->strtab = list->data + sizeof(FileListHeader) + entries_size;
+
+	INIT_FILE_CRC32(true, crc);
+	COMP_FILE_CRC32(true, crc, list->entries, entries_size);
+	COMP_FILE_CRC32(true, crc, list->strtab, header->strtab_size);
+	FIN_FILE_CRC32(true, crc);
+
+	if (crc != header->crc || list->strtab[header->strtab_size - 1] != '\0')
+		elog(ERROR, "%s file is corrupted", path);
+
+#ifdef WORDS_BIGENDIAN
+	file_list_entries_swap(list->entries, list->nfiles);
+#endif
+
+	return list;
+}
+
+#ifdef WORDS_BIGENDIAN
+static uint32
+file_list_swap32(uint32 x)
+{
+	return ((x << 24) & 0xff000000) |
+		   ((x << 8) & 0x00ff0000) |
+		   ((x >> 8) & 0x0000ff00) |
+		   ((x >> 24) & 0x000000ff);
+}
+
+static uint64
+file_list_swap64(uint64 x)
+{
+	return ((uint64) file_list_swap32((uint32) x) << 32) |
+		   (uint64) file_list_swap32((uint32) (x >> 32));
+}
+
+/*
+ * Convert integers of the header between host and little-endian byte order.
+ */
+static void
+file_list_header_swap(FileListHeader *header)
+{
+	header->version = file_list_swap32(header->version);
+	header->nfiles = file_list_swap32(header->nfiles);
+	header->strtab_size = file_list_swap32(header->strtab_size);
+	header->crc = file_list_swap32(header->crc);
+}
+
+/*
+ * Convert integers of the entries between host and little-endian byte order.
+ */
+static void
+file_list_entries_swap(FileListEntry *entries, uint32 nfiles)
+{
+	uint32		i;
+
+	for (i = 0; i < nfiles; i++)
+	{
+		FileListEntry *entry = &entries[i];
+
+		entry->write_size = (int64) file_list_swap64((uint64) entry->write_size);
+		entry->path = file_list_swap32(entry->path);
+		entry->linked = file_list_swap32(entry->linked);
+		entry->mode = file_list_swap32(entry->mode);
+		entry->crc = file_list_swap32(entry->crc);
+		entry->segno = (int32) file_list_swap32((uint32) entry->segno);
+		entry->n_blocks = (int32) file_list_swap32((uint32) entry->n_blocks);
+	}
+}
+#endif
+
+void
+file_list_close(FileList *list)
+{
+	if (list->files)
+	{
+		parray_walk(list->files, pgFileFree);
+		parray_free(list->files);
+	}
+	if (list->data)
+		free(list->data);
+	free(list);
+}
+
+int
+file_list_num(FileList *list)
+{
+	return (int) list->nfiles;
+}
+
+/*
+ * Construct pgFile for the i-th entry of the list.
+ * If root is not NULL, path will be absolute path.
+ */
+pgFile *
+file_list_get(FileList *list, int i, const char *root)
+{
+	char		filepath[MAXPGPATH];
+	pgFile	   *file;
+
+	Assert(i >= 0 && i < list->nfiles);
+
+	if (list->files)
+	{
+		pgFile	   *src = (pgFile *) parray_get(list->files, i);
+
+		if (root)
+			join_path_components(filepath, root, src->path);
+		else
+			strcpy(filepath, src->path);
+
+		file = pgFileInit(filepath);
+		file->write_size = src->write_size;
+		file->mode = src->mode;
+		file->is_datafile = src->is_datafile;
+		file->is_cfs = src->is_cfs;
+		file->crc = src->crc;
+		file->compress_alg = src->compress_alg;
+		file->segno = src->segno;
+		file->n_blocks = src->n_blocks;
+		if (src->linked)
+			file->linked = pgut_strdup(src->linked);
+	}
+	else
+	{
+		FileListEntry *entry = &list->entries[i];
+
+		if (root)
+			join_path_components(filepath, root, list->strtab + entry->path);
+		else
+			strcpy(filepath, list->strtab + entry->path);
+
+		file = pgFileInit(filepath);
+		file->write_size = entry->write_size;
+		file->mode = (mode_t) entry->mode;
+		file->is_datafile = entry->is_datafile ? true : false;
+		file->is_cfs = entry->is_cfs ? true : false;
+		file->crc = entry->crc;
+		file->compress_alg = (CompressAlg) entry->compress_alg;
+		file->segno = entry->segno;
+		file->n_blocks = entry->n_blocks;
+		if (entry->linked)
+			file->linked = pgut_strdup(list->strtab + entry->linked);
+	}
+
+	return file;
+}
+
+/*
+ * Get CRC of the i-th entry without constructing pgFile.
+ */
+pg_crc32
+file_list_get_crc(FileList *list, int i)
+{
+	Assert(i >= 0 && i < list->nfiles);
+
+	if (list->files)
+		return ((pgFile *) parray_get(list->files, i))->crc;
+	return list->entries[i].crc;
+}
+
+/*
+ * Find file by its relative path using binary search.
+ * Returns index of the entry or -1 if it is not found.
+ */
+int
+file_list_find(FileList *list, const char *path)
+{
+	int			low = 0;
+	int			high = (int) list->nfiles - 1;
+
+	while (low <= high)
+	{
+		int			mid = low + (high - low) / 2;
+		const char *mid_path;
+		int			cmp;
+
+		if (list->files)
+			mid_path = ((pgFile *) parray_get(list->files, mid))->path;
+		else
+			mid_path = list->strtab + list->entries[mid].path;
+
+		cmp = strcmp(path, mid_path);
+		if (cmp == 0)
+			return mid;
+		else if (cmp < 0)
+			high = mid - 1;
+		else
+			low = mid + 1;
+	}
+
+	return -1;
+}
+
 /*
  * Check if directory empty.
  */
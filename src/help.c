@@ -22,6 +22,7 @@ static void help_add_instance(void);
 static void help_del_instance(void);
 static void help_archive_push(void);
 static void help_archive_get(void);
+static void help_index_wal(void);
 
 void
 help_command(char *command)
@@ -52,6 +53,8 @@ help_command(char *command)
 		help_archive_push();
 	else if (strcmp(command, "archive-get") == 0)
 		help_archive_get();
+	else if (strcmp(command, "index-wal") == 0)
+		help_index_wal();
 	else if (strcmp(command, "--help") == 0
 			 || strcmp(command, "help") == 0
 			 || strcmp(command, "-?") == 0
@@ -98,8 +101,8 @@ help_pg_probackup(void)
 
 	printf(_("\n  %s backup -B backup-path -b backup-mode --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 [-C] [--stream [-S slot-name]] [--backup-pg-log]\n"));
-	printf(_("                 [-j num-threads] [--archive-timeout=archive-timeout]\n"));
-	printf(_("                 [--progress]\n"));
+	printf(_("                 [-j num-threads] [--compress-threads=num-threads]\n"));
+	printf(_("                 [--archive-timeout=archive-timeout] [--progress]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
 	printf(_("                 [--log-filename=log-filename]\n"));
@@ -118,7 +121,8 @@ help_pg_probackup(void)
 	printf(_("                 [--master-db=db_name] [--master-host=host_name]\n"));
 	printf(_("                 [--master-port=port] [--master-user=user_name]\n"));
 	printf(_("                 [--replica-timeout=timeout]\n"));
-	printf(_("                 [--skip-block-validation]\n"));
+	printf(_("                 [--skip-block-validation] [--wal-summary]\n"));
+	printf(_("                 [--wal-readahead=NUM]\n"));
 
 	printf(_("\n  %s restore -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 [-D pgdata-path] [-i backup-id] [--progress]\n"));
@@ -128,14 +132,16 @@ help_pg_probackup(void)
 	printf(_("                 [--recovery-target-action=pause|promote|shutdown]\n"));
 	printf(_("                 [--restore-as-replica]\n"));
 	printf(_("                 [--no-validate]\n"));
-	printf(_("                 [--skip-block-validation]\n"));
+	printf(_("                 [--skip-block-validation] [--force-validation]\n"));
+	printf(_("                 [--incremental] [--wal-readahead=NUM]\n"));
 
 	printf(_("\n  %s validate -B backup-path [--instance=instance_name]\n"), PROGRAM_NAME);
-	printf(_("                 [-i backup-id] [--progress]\n"));
+	printf(_("                 [-i backup-id] [-j num-threads] [--progress]\n"));
 	printf(_("                 [--time=time|--xid=xid|--lsn=lsn [--inclusive=boolean]]\n"));
 	printf(_("                 [--recovery-target-name=target-name]\n"));
 	printf(_("                 [--timeline=timeline]\n"));
-	printf(_("                 [--skip-block-validation]\n"));
+	printf(_("                 [--skip-block-validation] [--force-validation]\n"));
+	printf(_("                 [--wal-readahead=NUM]\n"));
 
 	printf(_("\n  %s show -B backup-path\n"), PROGRAM_NAME);
 	printf(_("                 [--instance=instance_name [-i backup-id]]\n"));
@@ -144,7 +150,7 @@ help_pg_probackup(void)
 	printf(_("\n  %s delete -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 [--wal] [-i backup-id | --expired]\n"));
 	printf(_("\n  %s merge -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
-	printf(_("                 -i backup-id\n"));
+	printf(_("                 -i backup-id [--force-validation]\n"));
 
 	printf(_("\n  %s add-instance -B backup-path -D pgdata-path\n"), PROGRAM_NAME);
 	printf(_("                 --instance=instance_name\n"));
@@ -158,11 +164,16 @@ help_pg_probackup(void)
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
-	printf(_("                 [--overwrite]\n"));
+	printf(_("                 [--overwrite] [-j num-threads]\n"));
+	printf(_("                 [--batch-size=batch-size] [--wal-index]\n"));
 
 	printf(_("\n  %s archive-get -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
 	printf(_("                 --wal-file-name=wal-file-name\n"));
+	printf(_("                 [--prefetch-depth=prefetch-depth]\n"));
+
+	printf(_("\n  %s index-wal -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
+	printf(_("                 [-j num-threads]\n"));
 
 	if ((PROGRAM_URL || PROGRAM_EMAIL))
 	{
@@ -187,8 +198,8 @@ help_backup(void)
 {
 	printf(_("%s backup -B backup-path -b backup-mode --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 [-C] [--stream [-S slot-name]] [--backup-pg-log]\n"));
-	printf(_("                 [-j num-threads] [--archive-timeout=archive-timeout]\n"));
-	printf(_("                 [--progress]\n"));
+	printf(_("                 [-j num-threads] [--compress-threads=num-threads]\n"));
+	printf(_("                 [--archive-timeout=archive-timeout] [--progress]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
 	printf(_("                 [--log-filename=log-filename]\n"));
@@ -207,7 +218,8 @@ help_backup(void)
 	printf(_("                 [--master-db=db_name] [--master-host=host_name]\n"));
 	printf(_("                 [--master-port=port] [--master-user=user_name]\n"));
 	printf(_("                 [--replica-timeout=timeout]\n"));
-	printf(_("                 [--skip-block-validation]\n\n"));
+	printf(_("                 [--skip-block-validation] [--wal-summary]\n"));
+	printf(_("                 [--wal-readahead=NUM]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("  -b, --backup-mode=backup-mode    backup mode=FULL|PAGE|DELTA|PTRACK\n"));
@@ -217,9 +229,15 @@ help_backup(void)
 	printf(_("  -S, --slot=SLOTNAME              replication slot to use\n"));
 	printf(_("      --backup-pg-log              backup of '%s' directory\n"), PG_LOG_DIR);
 	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
+	printf(_("      --compress-threads=NUM       number of threads compressing data files read by\n"));
+	printf(_("                                   --threads (default: 0, compressed by readers)\n"));
 	printf(_("      --archive-timeout=timeout    wait timeout for WAL segment archiving (default: 5min)\n"));
 	printf(_("      --progress                   show progress\n"));
 	printf(_("      --skip-block-validation      set to validate only file-level checksum\n"));
+	printf(_("      --wal-summary                write summaries of blocks changed by parsed WAL\n"));
+	printf(_("                                   segments next to them to speed up next PAGE backups\n"));
+	printf(_("      --wal-readahead=NUM          read and decompress up to NUM next WAL segments\n"));
+	printf(_("                                   in background while parsing WAL (default: 0)\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -254,7 +272,7 @@ help_backup(void)
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress                   compress data files\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib', 'pglz', 'none' (default: zlib)\n"));
+	printf(_("                                   available options: 'zlib', 'pglz', 'zstd', 'lz4', 'none' (default: zlib)\n"));
 	printf(_("      --compress-level=compress-level\n"));
 	printf(_("                                   level of compression [0-9] (default: 1)\n"));
 
@@ -283,8 +301,9 @@ help_restore(void)
 	printf(_("                 [--timeline=timeline] [-T OLDDIR=NEWDIR]\n"));
 	printf(_("                 [--immediate] [--recovery-target-name=target-name]\n"));
 	printf(_("                 [--recovery-target-action=pause|promote|shutdown]\n"));
-	printf(_("                 [--restore-as-replica] [--no-validate]\n\n"));
-	printf(_("                 [--skip-block-validation]\n\n"));
+	printf(_("                 [--restore-as-replica] [--no-validate]\n"));
+	printf(_("                 [--skip-block-validation] [--force-validation]\n"));
+	printf(_("                 [--incremental] [--wal-readahead=NUM]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance\n"));
@@ -312,6 +331,12 @@ help_restore(void)
 	printf(_("                                   to ease setting up a standby server\n"));
 	printf(_("      --no-validate                disable backup validation during restore\n"));
 	printf(_("      --skip-block-validation      set to validate only file-level checksum\n"));
+	printf(_("      --force-validation           validate backups even if they are not changed\n"));
+	printf(_("                                   since the last successful validation\n"));
+	printf(_("      --incremental                restore into existing data directory rewriting\n"));
+	printf(_("                                   only files and blocks which differ from the backup\n"));
+	printf(_("      --wal-readahead=NUM          read and decompress up to NUM next WAL segments\n"));
+	printf(_("                                   in background while parsing WAL (default: 0)\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -339,15 +364,17 @@ static void
 help_validate(void)
 {
 	printf(_("%s validate -B backup-path [--instance=instance_name]\n"), PROGRAM_NAME);
-	printf(_("                 [-i backup-id] [--progress]\n"));
+	printf(_("                 [-i backup-id] [-j num-threads] [--progress]\n"));
 	printf(_("                 [--time=time|--xid=xid|--lsn=lsn [--inclusive=boolean]]\n"));
 	printf(_("                 [--timeline=timeline]\n\n"));
-	printf(_("                 [--skip-block-validation]\n\n"));
+	printf(_("                 [--skip-block-validation] [--force-validation]\n"));
+	printf(_("                 [--wal-readahead=NUM]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance\n"));
 	printf(_("  -i, --backup-id=backup-id        backup to validate\n"));
 
+	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
 	printf(_("      --progress                   show progress\n"));
 	printf(_("      --time=time                  time stamp up to which recovery will proceed\n"));
 	printf(_("      --xid=xid                    transaction ID up to which recovery will proceed\n"));
@@ -357,6 +384,10 @@ help_validate(void)
 	printf(_("      --recovery-target-name=target-name\n"));
 	printf(_("                                   the named restore point to which recovery will proceed\n"));
 	printf(_("      --skip-block-validation      set to validate only file-level checksum\n"));
+	printf(_("      --force-validation           validate backups even if they are not changed\n"));
+	printf(_("                                   since the last successful validation\n"));
+	printf(_("      --wal-readahead=NUM          read and decompress up to NUM next WAL segments\n"));
+	printf(_("                                   in background while parsing WAL (default: 0)\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -433,6 +464,7 @@ help_merge(void)
 {
 	printf(_("%s merge -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 -i backup-id [-j num-threads] [--progress]\n"));
+	printf(_("                 [--force-validation]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
 	printf(_("                 [--log-filename=log-filename]\n"));
@@ -447,6 +479,8 @@ help_merge(void)
 
 	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
 	printf(_("      --progress                   show progress\n"));
+	printf(_("      --force-validation           validate backups even if they are not changed\n"));
+	printf(_("                                   since the last successful validation\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -523,7 +557,7 @@ help_set_config(void)
 
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib','pglz','none'\n"));
+	printf(_("                                   available options: 'zlib','pglz','zstd','lz4','none'\n"));
 	printf(_("      --compress-level=compress-level\n"));
 	printf(_("                                   level of compression [0-9] (default: 1)\n"));
 
@@ -584,7 +618,8 @@ help_archive_push(void)
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
-	printf(_("                 [--overwrite]\n\n"));
+	printf(_("                 [--overwrite] [-j num-threads]\n"));
+	printf(_("                 [--batch-size=batch-size] [--wal-index]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance to delete\n"));
@@ -594,10 +629,15 @@ help_archive_push(void)
 	printf(_("                                   name of the WAL file to retrieve from the server\n"));
 	printf(_("      --compress                   compress WAL file during archiving\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib','none'\n"));
+	printf(_("                                   available options: 'zlib','zstd','lz4','none'\n"));
 	printf(_("      --compress-level=compress-level\n"));
 	printf(_("                                   level of compression [0-9] (default: 1)\n"));
 	printf(_("      --overwrite                  overwrite archived WAL file\n"));
+	printf(_("  -j, --threads=NUM                number of parallel threads pushing a batch\n"));
+	printf(_("      --batch-size=NUM             also push up to NUM-1 next WAL segments ready\n"));
+	printf(_("                                   to be archived (default: 1)\n"));
+	printf(_("      --wal-index                  add pushed WAL segments to the WAL index used\n"));
+	printf(_("                                   to validate WAL up to a recovery target\n"));
 }
 
 static void
@@ -605,7 +645,8 @@ help_archive_get(void)
 {
 	printf(_("\n  %s archive-get -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
-	printf(_("                 --wal-file-name=wal-file-name\n\n"));
+	printf(_("                 --wal-file-name=wal-file-name\n"));
+	printf(_("                 [--prefetch-depth=prefetch-depth]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance to delete\n"));
@@ -613,4 +654,20 @@ help_archive_get(void)
 	printf(_("                                   relative destination path name of the WAL file on the server\n"));
 	printf(_("      --wal-file-name=wal-file-name\n"));
 	printf(_("                                   name of the WAL file to retrieve from the archive\n"));
+	printf(_("      --prefetch-depth=NUM         fetch NUM next WAL segments in background into\n"));
+	printf(_("                                   'pbk_prefetch' subdirectory of WAL directory,\n"));
+	printf(_("                                   older segments are removed from it, the whole\n"));
+	printf(_("                                   subdirectory is removed when the requested\n"));
+	printf(_("                                   segment is not archived (default: 0)\n"));
+}
+
+static void
+help_index_wal(void)
+{
+	printf(_("\n  %s index-wal -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
+	printf(_("                 [-j num-threads]\n\n"));
+
+	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
+	printf(_("      --instance=instance_name     name of the instance\n"));
+	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
 }
@@ -231,6 +231,8 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 
 	write_backup_status(to_backup, BACKUP_STATUS_MERGING);
 	write_backup_status(from_backup, BACKUP_STATUS_MERGING);
+	/* Files of to_backup are going to be changed */
+	remove_backup_validation_state(to_backup);
 
 	create_data_directories(to_database_path, from_backup_path, false);
 
@@ -461,75 +463,34 @@ merge_files(void *arg)
 			 * We need more complicate algorithm if target file should be
 			 * compressed.
 			 */
-			if (to_backup->compress_alg == PGLZ_COMPRESS ||
-				to_backup->compress_alg == ZLIB_COMPRESS)
+			if (to_backup->compress_alg != NONE_COMPRESS &&
+				to_backup->compress_alg != NOT_DEFINED_COMPRESS)
 			{
-				char		tmp_file_path[MAXPGPATH];
-				char	   *prev_path;
-
-				snprintf(tmp_file_path, MAXPGPATH, "%s_tmp", to_file_path);
-
-				/* Start the magic */
-
-				/*
-				 * Merge files:
-				 * - if target file exists restore and decompress it to the temp
-				 *   path
-				 * - decompress source file if necessary and merge it with the
-				 *   target decompressed file
-				 * - compress result file
-				 */
+				char	   *prev_path = NULL;
 
 				/*
-				 * We need to decompress target file if it exists.
+				 * Merge page headers of target and source files block by
+				 * block, pages compressed by the same algorithm are copied
+				 * without decompression.
+				 *
+				 * file->path points to the file in from_root directory. But we
+				 * need the target file in directory to_root.
 				 */
 				if (to_file)
 				{
-					elog(VERBOSE, "Merge target and source files into the temporary path \"%s\"",
-						 tmp_file_path);
-
-					/*
-					 * file->path points to the file in from_root directory. But we
-					 * need the file in directory to_root.
-					 */
 					prev_path = to_file->path;
 					to_file->path = to_file_path;
-					/* Decompress target file into temporary one */
-					restore_data_file(tmp_file_path, to_file, false, false,
-									  parse_program_version(to_backup->program_version));
-					to_file->path = prev_path;
 				}
-				else
-					elog(VERBOSE, "Restore source file into the temporary path \"%s\"",
-						 tmp_file_path);
-				/* Merge source file with target file */
-				restore_data_file(tmp_file_path, file,
-								  from_backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
-								  false,
-								  parse_program_version(from_backup->program_version));
 
-				elog(VERBOSE, "Compress file and save it into the directory \"%s\"",
-					 argument->to_root);
-
-				/* Again we need to change path */
-				prev_path = file->path;
-				file->path = tmp_file_path;
-				/* backup_data_file() requires file size to calculate nblocks */
-				file->size = pgFileSize(file->path);
-				/* Now we can compress the file */
-				backup_data_file(NULL, /* We shouldn't need 'arguments' here */
-								 to_file_path, file,
-								 to_backup->start_lsn,
-								 to_backup->backup_mode,
-								 to_backup->compress_alg,
-								 to_backup->compress_level);
-
-				file->path = prev_path;
-
-				/* We can remove temporary file now */
-				if (unlink(tmp_file_path))
-					elog(ERROR, "Could not remove temporary file \"%s\": %s",
-						 tmp_file_path, strerror(errno));
+				merge_data_file(to_file_path, to_file, file,
+								from_backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
+								parse_program_version(to_backup->program_version),
+								parse_program_version(from_backup->program_version),
+								to_backup->compress_alg,
+								to_backup->compress_level);
+
+				if (to_file)
+					to_file->path = prev_path;
 			}
 			/*
 			 * Otherwise merging algorithm is simpler.
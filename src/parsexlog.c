@@ -83,9 +83,145 @@ typedef struct xl_xact_abort
 	/* xl_xact_twophase follows if XINFO_HAS_TWOPHASE */
 } xl_xact_abort;
 
-static void extractPageInfo(XLogReaderState *record);
+/*
+ * Blocks of a relation segment changed by WAL records.
+ */
+typedef struct PageMapEntry
+{
+	RelFileNode	rnode;
+	BlockNumber	segno;
+	bool		used;
+	datapagemap_t pagemap;
+} PageMapEntry;
+
+/*
+ * Open addressing hash table of PageMapEntry keyed by relation and segment
+ * number. Every WAL reader thread fills its own table, they are merged into
+ * pagemaps of backup files after the threads are finished.
+ */
+typedef struct PageMapHash
+{
+	PageMapEntry *entries;
+	uint32		size;			/* power of 2 */
+	uint32		nused;
+	PageMapEntry *last;			/* the last found entry */
+} PageMapHash;
+
+#define PAGEMAP_HASH_INITIAL_SIZE	1024
+
+#define PAGEMAP_BLOCK_IS_SET(map, blk) \
+	(((map)->bitmap[(blk) / 8] & (1 << ((blk) % 8))) != 0)
+
+/*
+ * Summary of blocks changed by WAL records which start in an archived WAL
+ * segment, it is stored next to the segment with WAL_SUMMARY_SUFFIX.
+ *
+ * The file starts with WalSummaryHeader followed by nentries
+ * WalSummaryEntry, every entry is a range of blocks of a relation fork.
+ * Integers are stored in native byte order.
+ */
+#define WAL_SUMMARY_MAGIC	"PGPBWS\n"
+#define WAL_SUMMARY_VERSION	1
+
+typedef struct WalSummaryHeader
+{
+	char		magic[8];		/* WAL_SUMMARY_MAGIC */
+	uint32		version;		/* WAL_SUMMARY_VERSION */
+	uint32		nentries;		/* number of entries */
+	pg_crc32	crc;			/* CRC of entries */
+} WalSummaryHeader;
+
+typedef struct WalSummaryEntry
+{
+	RelFileNode	rnode;
+	uint32		forknum;
+	BlockNumber	blkno;			/* the first block of the range */
+	uint32		nblocks;
+} WalSummaryEntry;
+
+/*
+ * Sparse index of archived WAL segments of a timeline, it is stored in the
+ * archive as <timeline>WAL_INDEX_SUFFIX. Every entry describes records which
+ * start in a segment, so validate_wal() may skip segments which cannot
+ * contain the recovery target.
+ *
+ * Entries are appended by concurrent processes and are never rewritten, an
+ * entry torn by a crash is skipped by the reader using magic and CRC.
+ * Every entry keeps the CRC of the segment from its checksum file: if the
+ * segment is overwritten, its old entry remains in the index but does not
+ * match the segment anymore, and a new entry is appended.
+ * Integers are stored in native byte order.
+ */
+#define WAL_INDEX_SUFFIX	".walindex"
+#define WAL_INDEX_MAGIC		0x32495750	/* "PWI2" */
+
+typedef struct WalIndexEntry
+{
+	uint32		magic;			/* WAL_INDEX_MAGIC */
+	XLogSegNo	segno;
+	XLogRecPtr	start_lsn;		/* the first record, invalid if none */
+	XLogRecPtr	end_lsn;		/* the last record */
+	TransactionId min_xid;		/* InvalidTransactionId if no records */
+	TransactionId max_xid;		/* have xid */
+	TransactionId last_xid;
+	TimestampTz	min_time;		/* 0 if there are no timestamp records */
+	TimestampTz	max_time;
+	TimestampTz	last_time;
+	pg_crc32	seg_crc;		/* CRC of the segment content */
+	pg_crc32	crc;			/* CRC of the fields above */
+} WalIndexEntry;
+
+/* Compare normal xids, which may wrap around */
+#define XidPrecedes(xid1, xid2)	((int32) ((xid1) - (xid2)) < 0)
+
+static void extractPageInfo(XLogReaderState *record, PageMapHash *pagemaps);
 static bool getRecordTimestamp(XLogReaderState *record, TimestampTz *recordXtime);
 
+/*
+ * Read-ahead of WAL segments.
+ *
+ * Loader threads read and decompress segments following the segment
+ * requested by WAL readers into memory, so that readers do not wait for I/O
+ * and decompression. At most wal_readahead_depth segments are kept in
+ * memory, segment segno is loaded into buffer (segno - start_segno) % depth.
+ * A segment which is not loaded in time is read by the reader itself.
+ */
+typedef enum WalSegmentState
+{
+	WAL_SEGMENT_EMPTY,
+	WAL_SEGMENT_LOADING,
+	WAL_SEGMENT_LOADED,
+	WAL_SEGMENT_FAILED
+} WalSegmentState;
+
+typedef struct WalSegmentBuffer
+{
+	XLogSegNo	segno;
+	WalSegmentState state;
+	int			refcount;		/* number of readers using the data */
+	char	   *data;			/* uncompressed content of the segment */
+	size_t		size;
+	char		path[MAXPGPATH];	/* file the segment is read from */
+	bool		is_compressed;
+} WalSegmentBuffer;
+
+typedef struct WalLoader
+{
+	const char *archivedir;
+	TimeLineID	tli;
+	uint32		seg_size;
+	XLogSegNo	start_segno;
+	XLogSegNo	end_segno;
+	const bool *skip_segments;	/* segments not to load, may be NULL */
+	XLogSegNo	next_segno;		/* the next segment to load */
+	XLogSegNo	read_segno;		/* the latest segment requested by readers */
+	int			depth;
+	WalSegmentBuffer *buffers;
+	bool		stopping;
+	pthread_t  *threads;
+	int			nthreads;
+} WalLoader;
+
 typedef struct XLogPageReadPrivate
 {
 	int			thread_num;
@@ -104,12 +240,28 @@ typedef struct XLogPageReadPrivate
 	char		xlogpath[MAXPGPATH];
 	bool		xlogexists;
 
+	char		compressed_xlogpath[MAXPGPATH];
 #ifdef HAVE_LIBZ
 	gzFile		gz_xlogfile;
-	char		gz_xlogpath[MAXPGPATH];
 #endif
+	/* Segment compressed by zstd or lz4 is decompressed into memory */
+	char	   *xlogdata;
+	size_t		xlogdata_size;
+	/* Or xlogdata points to the segment loaded by read-ahead */
+	WalSegmentBuffer *readahead_buf;
 } XLogPageReadPrivate;
 
+/* Last values found by validate_wal() in records starting in a segment */
+typedef struct ValidateSegmentResult
+{
+	XLogSegNo	segno;
+	/* The last record of the segment satisfies the recovery target */
+	bool		target_found;
+	TransactionId last_xid;		/* InvalidTransactionId if none */
+	TimestampTz	last_time;		/* 0 if there are no timestamp records */
+	XLogRecPtr	last_lsn;
+} ValidateSegmentResult;
+
 /* An argument for a thread function */
 typedef struct
 {
@@ -119,6 +271,32 @@ typedef struct
 	XLogRecPtr	endpoint;
 	XLogSegNo	endSegNo;
 
+	/* Changed blocks found by the thread */
+	PageMapHash	pagemaps;
+
+	/*
+	 * Blocks changed by records of the segment summary_segno, they are
+	 * written into the summary of the segment and then added to pagemaps.
+	 * Used with --wal-summary only.
+	 */
+	PageMapHash	segment_pagemaps;
+	XLogSegNo	summary_segno;
+
+	/* Recovery target, used by validate_wal() threads only */
+	time_t		target_time;
+	TransactionId target_xid;
+	XLogRecPtr	target_lsn;
+	/* ValidateSegmentResult of segments read, NULL for extractPageMap() */
+	parray	   *results;
+
+	/*
+	 * The segment, where reading of the validate_wal() thread failed, the
+	 * error message and the state of the reader to report it.
+	 */
+	XLogSegNo	failed_segno;
+	char	   *failed_errormsg;
+	XLogPageReadPrivate *failed_private;
+
 	/*
 	 * Return value from the thread.
 	 * 0 means there is no error, 1 - there is an error.
@@ -138,8 +316,33 @@ static void CleanupXLogPageRead(XLogReaderState *xlogreader);
 static void PrintXLogCorruptionMsg(XLogPageReadPrivate *private_data, int elevel);
 
 static XLogSegNo nextSegNoToRead = 0;
+/* Segments after it are not read, lowered when validate_wal() may stop */
+static XLogSegNo stopSegNoToRead = 0;
 static pthread_mutex_t wal_segment_mutex = PTHREAD_MUTEX_INITIALIZER;
 
+static WalLoader *wal_loader = NULL;
+#ifndef WIN32
+static pthread_mutex_t wal_loader_mutex = PTHREAD_MUTEX_INITIALIZER;
+/* Signaled when a segment is loaded, requested or released */
+static pthread_cond_t wal_loader_cond = PTHREAD_COND_INITIALIZER;
+#endif
+
+static void wal_loader_start(const char *archivedir, TimeLineID tli,
+							 uint32 seg_size, XLogSegNo start_segno,
+							 XLogSegNo end_segno, const bool *skip_segments);
+static void wal_loader_stop(void);
+static WalSegmentBuffer *wal_loader_get(XLogSegNo segno);
+static void wal_loader_release(WalSegmentBuffer *buf);
+
+/*
+ * Segments of the extractPageMap() range, the blocks of which are already
+ * taken from their summaries. Only segments between the first and the last
+ * one may have summaries, the boundary segments are read partially.
+ */
+static XLogSegNo summaryStartSegNo = 0;
+static XLogSegNo summaryEndSegNo = 0;
+static bool *segmentSummarized = NULL;
+
 /* copied from timestamp.c */
 static pg_time_t
 timestamptz_to_time_t(TimestampTz t)
@@ -156,6 +359,418 @@ timestamptz_to_time_t(TimestampTz t)
 	return result;
 }
 
+static uint32
+pagemap_hash_key(RelFileNode rnode, BlockNumber segno)
+{
+	uint32		h;
+
+	h = rnode.relNode * 0x9E3779B1;
+	h ^= rnode.dbNode * 0x85EBCA77;
+	h ^= rnode.spcNode * 0xC2B2AE3D;
+	h ^= segno * 0x27D4EB2F;
+	h ^= h >> 15;
+
+	return h;
+}
+
+/*
+ * Find the entry of the relation segment in the table, creating it if it
+ * doesn't exist.
+ */
+static PageMapEntry *
+pagemap_hash_lookup(PageMapHash *pagemaps, RelFileNode rnode,
+					BlockNumber segno)
+{
+	PageMapEntry *entry;
+	uint32		i;
+
+	/* Consecutive records usually change the same relation */
+	if (pagemaps->last && pagemaps->last->segno == segno &&
+		RelFileNodeEquals(pagemaps->last->rnode, rnode))
+		return pagemaps->last;
+
+	/* Keep the table at most half full */
+	if (pagemaps->nused * 2 >= pagemaps->size)
+	{
+		PageMapEntry *old_entries = pagemaps->entries;
+		uint32		old_size = pagemaps->size;
+
+		pagemaps->size = old_size ? old_size * 2 : PAGEMAP_HASH_INITIAL_SIZE;
+		pagemaps->entries = (PageMapEntry *)
+			pgut_malloc(sizeof(PageMapEntry) * pagemaps->size);
+		MemSet(pagemaps->entries, 0, sizeof(PageMapEntry) * pagemaps->size);
+
+		for (i = 0; i < old_size; i++)
+		{
+			uint32		j;
+
+			if (!old_entries[i].used)
+				continue;
+
+			j = pagemap_hash_key(old_entries[i].rnode, old_entries[i].segno);
+			while (pagemaps->entries[j & (pagemaps->size - 1)].used)
+				j++;
+			pagemaps->entries[j & (pagemaps->size - 1)] = old_entries[i];
+		}
+		free(old_entries);
+	}
+
+	for (i = pagemap_hash_key(rnode, segno);; i++)
+	{
+		entry = &pagemaps->entries[i & (pagemaps->size - 1)];
+
+		if (!entry->used)
+		{
+			entry->used = true;
+			entry->rnode = rnode;
+			entry->segno = segno;
+			pagemaps->nused++;
+			break;
+		}
+		if (entry->segno == segno && RelFileNodeEquals(entry->rnode, rnode))
+			break;
+	}
+
+	pagemaps->last = entry;
+	return entry;
+}
+
+/*
+ * Add blocks collected in the table to pagemaps of backup files and free
+ * the table.
+ */
+static void
+pagemap_hash_flush(PageMapHash *pagemaps)
+{
+	uint32		i;
+
+	for (i = 0; i < pagemaps->size; i++)
+	{
+		PageMapEntry *entry = &pagemaps->entries[i];
+
+		if (!entry->used)
+			continue;
+
+		process_block_changes(MAIN_FORKNUM, entry->rnode, entry->segno,
+							  &entry->pagemap);
+		pg_free(entry->pagemap.bitmap);
+	}
+
+	free(pagemaps->entries);
+	MemSet(pagemaps, 0, sizeof(PageMapHash));
+}
+
+/*
+ * Move blocks collected in the table "src" into the table "dst" and free
+ * "src".
+ */
+static void
+pagemap_hash_merge(PageMapHash *dst, PageMapHash *src)
+{
+	uint32		i;
+
+	for (i = 0; i < src->size; i++)
+	{
+		PageMapEntry *entry = &src->entries[i];
+		datapagemap_t *pagemap;
+		int			j;
+
+		if (!entry->used)
+			continue;
+
+		pagemap = &pagemap_hash_lookup(dst, entry->rnode,
+									   entry->segno)->pagemap;
+		if (pagemap->bitmap == NULL)
+		{
+			*pagemap = entry->pagemap;
+			continue;
+		}
+
+		if (entry->pagemap.bitmapsize > pagemap->bitmapsize)
+		{
+			pagemap->bitmap = pg_realloc(pagemap->bitmap,
+										 entry->pagemap.bitmapsize);
+			memset(pagemap->bitmap + pagemap->bitmapsize, 0,
+				   entry->pagemap.bitmapsize - pagemap->bitmapsize);
+			pagemap->bitmapsize = entry->pagemap.bitmapsize;
+		}
+
+		for (j = 0; j < entry->pagemap.bitmapsize; j++)
+			pagemap->bitmap[j] |= entry->pagemap.bitmap[j];
+		pg_free(entry->pagemap.bitmap);
+	}
+
+	free(src->entries);
+	MemSet(src, 0, sizeof(PageMapHash));
+}
+
+static void
+get_wal_summary_path(char *path, const char *archivedir, TimeLineID tli,
+					 XLogSegNo segno, uint32 seg_size)
+{
+	char		xlogfname[MAXFNAMELEN];
+
+	GetXLogFileName(xlogfname, tli, segno, seg_size);
+	snprintf(path, MAXPGPATH, "%s/%s%s", archivedir, xlogfname,
+			 WAL_SUMMARY_SUFFIX);
+}
+
+/*
+ * Add blocks from the summary file "path" to the table. Returns false if
+ * there is no summary file or it is corrupted, then the segment has to be
+ * parsed.
+ */
+static bool
+read_wal_summary_file(const char *path, PageMapHash *pagemaps)
+{
+	FILE	   *fp;
+	struct stat	st;
+	WalSummaryHeader header;
+	WalSummaryEntry *entries = NULL;
+	pg_crc32	crc;
+	bool		ok;
+	uint32		i;
+
+	fp = fopen(path, PG_BINARY_R);
+	if (fp == NULL)
+	{
+		if (errno != ENOENT)
+			elog(WARNING, "Cannot open block summary file \"%s\": %s",
+				 path, strerror(errno));
+		return false;
+	}
+
+	ok = fstat(fileno(fp), &st) == 0 &&
+		fread(&header, sizeof(header), 1, fp) == 1 &&
+		memcmp(header.magic, WAL_SUMMARY_MAGIC, sizeof(header.magic)) == 0 &&
+		header.version == WAL_SUMMARY_VERSION &&
+		st.st_size == sizeof(header) +
+		(off_t) header.nentries * sizeof(WalSummaryEntry);
+
+	if (ok && header.nentries > 0)
+	{
+		entries = (WalSummaryEntry *)
+			pgut_malloc(sizeof(WalSummaryEntry) * header.nentries);
+		ok = fread(entries, sizeof(WalSummaryEntry), header.nentries,
+				   fp) == header.nentries;
+	}
+	fclose(fp);
+
+	if (ok)
+	{
+		INIT_FILE_CRC32(true, crc);
+		if (header.nentries > 0)
+			COMP_FILE_CRC32(true, crc, entries,
+							sizeof(WalSummaryEntry) * header.nentries);
+		FIN_FILE_CRC32(true, crc);
+		ok = EQ_CRC32C(crc, header.crc);
+	}
+
+	if (!ok)
+	{
+		elog(WARNING, "Block summary file \"%s\" is corrupted, WAL segment will be parsed",
+			 path);
+		pg_free(entries);
+		return false;
+	}
+
+	for (i = 0; i < header.nentries; i++)
+	{
+		WalSummaryEntry *entry = &entries[i];
+		BlockNumber	blkno;
+
+		/* We only care about the main fork; others are copied in toto */
+		if (entry->forknum != MAIN_FORKNUM)
+			continue;
+
+		for (blkno = entry->blkno; blkno - entry->blkno < entry->nblocks;
+			 blkno++)
+			datapagemap_add(&pagemap_hash_lookup(pagemaps, entry->rnode,
+												 blkno / RELSEG_SIZE)->pagemap,
+							blkno % RELSEG_SIZE);
+	}
+
+	pg_free(entries);
+	return true;
+}
+
+/*
+ * Write blocks changed by records of the segment summary_segno into its
+ * summary file as ranges of blocks. Errors are not fatal, without the summary
+ * the segment is parsed again.
+ */
+static void
+write_wal_summary_file(xlog_thread_arg *arg)
+{
+	XLogPageReadPrivate *private_data = &arg->private_data;
+	PageMapHash *pagemaps = &arg->segment_pagemaps;
+	WalSummaryHeader header;
+	WalSummaryEntry *entries = NULL;
+	uint32		nentries = 0;
+	uint32		allocated = 0;
+	char		path[MAXPGPATH];
+	char		path_temp[MAXPGPATH];
+	FILE	   *fp;
+	uint32		i;
+
+	for (i = 0; i < pagemaps->size; i++)
+	{
+		PageMapEntry *entry = &pagemaps->entries[i];
+		BlockNumber	maxblkno;
+		BlockNumber	blkno = 0;
+
+		if (!entry->used)
+			continue;
+
+		maxblkno = (BlockNumber) entry->pagemap.bitmapsize * 8;
+		while (blkno < maxblkno)
+		{
+			BlockNumber	start;
+
+			if (!PAGEMAP_BLOCK_IS_SET(&entry->pagemap, blkno))
+			{
+				blkno++;
+				continue;
+			}
+
+			start = blkno;
+			while (blkno < maxblkno &&
+				   PAGEMAP_BLOCK_IS_SET(&entry->pagemap, blkno))
+				blkno++;
+
+			if (nentries == allocated)
+			{
+				allocated = allocated ? allocated * 2 : 64;
+				entries = (WalSummaryEntry *)
+					pgut_realloc(entries, sizeof(WalSummaryEntry) * allocated);
+			}
+			entries[nentries].rnode = entry->rnode;
+			entries[nentries].forknum = MAIN_FORKNUM;
+			entries[nentries].blkno = entry->segno * RELSEG_SIZE + start;
+			entries[nentries].nblocks = blkno - start;
+			nentries++;
+		}
+	}
+
+	MemSet(&header, 0, sizeof(header));
+	memcpy(header.magic, WAL_SUMMARY_MAGIC, sizeof(header.magic));
+	header.version = WAL_SUMMARY_VERSION;
+	header.nentries = nentries;
+	INIT_FILE_CRC32(true, header.crc);
+	if (nentries > 0)
+		COMP_FILE_CRC32(true, header.crc, entries,
+						sizeof(WalSummaryEntry) * nentries);
+	FIN_FILE_CRC32(true, header.crc);
+
+	get_wal_summary_path(path, private_data->archivedir, private_data->tli,
+						 arg->summary_segno, private_data->xlog_seg_size);
+	/* The same summary may be written by another thread or process */
+	snprintf(path_temp, sizeof(path_temp), "%s.%d.%d.partial", path,
+			 (int) getpid(), private_data->thread_num);
+
+	fp = fopen(path_temp, PG_BINARY_W);
+	if (fp == NULL)
+	{
+		elog(WARNING, "Thread [%d]: cannot open block summary file \"%s\": %s",
+			 private_data->thread_num, path_temp, strerror(errno));
+		pg_free(entries);
+		return;
+	}
+
+	if (fwrite(&header, sizeof(header), 1, fp) != 1 ||
+		fwrite(entries, sizeof(WalSummaryEntry), nentries, fp) != nentries ||
+		fflush(fp) != 0 ||
+		fsync(fileno(fp)) != 0 ||
+		fclose(fp) != 0)
+	{
+		elog(WARNING, "Thread [%d]: cannot write block summary file \"%s\": %s",
+			 private_data->thread_num, path_temp, strerror(errno));
+		unlink(path_temp);
+		pg_free(entries);
+		return;
+	}
+	pg_free(entries);
+
+	if (rename(path_temp, path) < 0)
+	{
+		elog(WARNING, "Thread [%d]: cannot rename block summary file \"%s\" to \"%s\": %s",
+			 private_data->thread_num, path_temp, path, strerror(errno));
+		unlink(path_temp);
+		return;
+	}
+
+	elog(VERBOSE, "Thread [%d]: block summary is written to \"%s\"",
+		 private_data->thread_num, path);
+}
+
+/*
+ * Called when the thread has read all records of the segment summary_segno.
+ * Writes the summary of the segment if it was read as a whole and moves its
+ * blocks to the blocks found by the thread.
+ */
+static void
+finishSegmentSummary(xlog_thread_arg *arg)
+{
+	if (arg->summary_segno > summaryStartSegNo &&
+		arg->summary_segno < summaryEndSegNo &&
+		!segmentSummarized[arg->summary_segno - summaryStartSegNo])
+		write_wal_summary_file(arg);
+
+	pagemap_hash_merge(&arg->pagemaps, &arg->segment_pagemaps);
+}
+
+/*
+ * Returns the first segment starting from "segno" which has to be read,
+ * segments with summaries are skipped.
+ */
+static XLogSegNo
+nextSegmentToRead(XLogSegNo segno)
+{
+	while (segmentSummarized != NULL && segno <= summaryEndSegNo &&
+		   segmentSummarized[segno - summaryStartSegNo])
+		segno++;
+
+	return segno;
+}
+
+/*
+ * Lower the last segment to read, segments after "segno" are not needed
+ * anymore.
+ */
+static void
+stopReadingAfter(XLogSegNo segno)
+{
+	pthread_lock(&wal_segment_mutex);
+	if (segno < stopSegNoToRead)
+		stopSegNoToRead = segno;
+	pthread_mutex_unlock(&wal_segment_mutex);
+}
+
+/*
+ * Remember the segment, where the validate_wal() thread couldn't read WAL,
+ * and the state of its reader. Segments after the failed one are not read.
+ */
+static void
+validateWalFailed(xlog_thread_arg *arg, XLogSegNo segno, const char *errormsg)
+{
+	XLogPageReadPrivate *private_data = &arg->private_data;
+
+	arg->failed_segno = segno;
+	arg->failed_errormsg = errormsg ? pgut_strdup(errormsg) : NULL;
+
+	arg->failed_private = pgut_new(XLogPageReadPrivate);
+	memcpy(arg->failed_private, private_data, sizeof(XLogPageReadPrivate));
+	/* Buffers are released by CleanupXLogPageRead(), keep only the path */
+	if (private_data->readahead_buf != NULL &&
+		!private_data->readahead_buf->is_compressed)
+		strcpy(arg->failed_private->compressed_xlogpath,
+			   private_data->xlogpath);
+	arg->failed_private->readahead_buf = NULL;
+	arg->failed_private->xlogdata = NULL;
+
+	stopReadingAfter(segno);
+}
+
 /*
  * Do manual switch to the next WAL segment.
  *
@@ -166,6 +781,7 @@ switchToNextWal(XLogReaderState *xlogreader, xlog_thread_arg *arg)
 {
 	XLogPageReadPrivate *private_data;
 	XLogRecPtr	found;
+	XLogSegNo	stopSegNo;
 
 	private_data = (XLogPageReadPrivate *) xlogreader->private_data;
 	private_data->need_switch = false;
@@ -173,12 +789,14 @@ switchToNextWal(XLogReaderState *xlogreader, xlog_thread_arg *arg)
 	/* Critical section */
 	pthread_lock(&wal_segment_mutex);
 	Assert(nextSegNoToRead);
-	private_data->xlogsegno = nextSegNoToRead;
-	nextSegNoToRead++;
+	private_data->xlogsegno = nextSegmentToRead(nextSegNoToRead);
+	nextSegNoToRead = private_data->xlogsegno + 1;
+	stopSegNo = stopSegNoToRead;
 	pthread_mutex_unlock(&wal_segment_mutex);
 
 	/* We've reached the end */
-	if (private_data->xlogsegno > arg->endSegNo)
+	if (private_data->xlogsegno > arg->endSegNo ||
+		private_data->xlogsegno > stopSegNo)
 		return false;
 
 	/* Adjust next record position */
@@ -195,6 +813,13 @@ switchToNextWal(XLogReaderState *xlogreader, xlog_thread_arg *arg)
 	 */
 	if (XLogRecPtrIsInvalid(found))
 	{
+		/* It is the end of WAL available for validate_wal() */
+		if (arg->results != NULL)
+		{
+			validateWalFailed(arg, private_data->xlogsegno, NULL);
+			return false;
+		}
+
 		elog(WARNING, "Thread [%d]: could not read WAL record at %X/%X",
 			 private_data->thread_num,
 			 (uint32) (arg->startpoint >> 32), (uint32) (arg->startpoint));
@@ -322,7 +947,23 @@ doExtractPageMap(void *arg)
 			PrintXLogCorruptionMsg(private_data, ERROR);
 		}
 
-		extractPageInfo(xlogreader);
+		if (write_wal_summary)
+		{
+			XLogSegNo	recordSegNo;
+
+			/* All records of the previous segment are read */
+			GetXLogSegNo(xlogreader->ReadRecPtr, recordSegNo,
+						 private_data->xlog_seg_size);
+			if (recordSegNo != extract_arg->summary_segno)
+			{
+				finishSegmentSummary(extract_arg);
+				extract_arg->summary_segno = recordSegNo;
+			}
+
+			extractPageInfo(xlogreader, &extract_arg->segment_pagemaps);
+		}
+		else
+			extractPageInfo(xlogreader, &extract_arg->pagemaps);
 
 		/* continue reading at next record */
 		extract_arg->startpoint = InvalidXLogRecPtr;
@@ -332,6 +973,9 @@ doExtractPageMap(void *arg)
 	} while (nextSegNo <= extract_arg->endSegNo &&
 			 xlogreader->ReadRecPtr < extract_arg->endpoint);
 
+	if (write_wal_summary)
+		finishSegmentSummary(extract_arg);
+
 	CleanupXLogPageRead(xlogreader);
 	XLogReaderFree(xlogreader);
 
@@ -346,6 +990,10 @@ doExtractPageMap(void *arg)
  *
  * Pagemap extracting is processed using threads. Eeach thread reads single WAL
  * file.
+ *
+ * Blocks of segments having summaries are taken from the summaries, other
+ * segments are parsed. With --wal-summary summaries of parsed segments are
+ * written.
  */
 void
 extractPageMap(const char *archivedir, TimeLineID tli, uint32 seg_size,
@@ -353,7 +1001,11 @@ extractPageMap(const char *archivedir, TimeLineID tli, uint32 seg_size,
 {
 	int			i;
 	int			threads_need = 0;
+	XLogSegNo	startSegNo;
 	XLogSegNo	endSegNo;
+	XLogSegNo	segno;
+	int			nsummarized = 0;
+	PageMapHash	summary_pagemaps;
 	bool		extract_isok = true;
 	pthread_t  *threads;
 	xlog_thread_arg *thread_args;
@@ -369,14 +1021,40 @@ extractPageMap(const char *archivedir, TimeLineID tli, uint32 seg_size,
 		elog(ERROR, "Invalid endpoint value %X/%X",
 			 (uint32) (endpoint >> 32), (uint32) (endpoint));
 
+	GetXLogSegNo(startpoint, startSegNo, seg_size);
 	GetXLogSegNo(endpoint, endSegNo, seg_size);
 
-	nextSegNoToRead = 0;
 	time(&start_time);
 
+	/* Take blocks of whole segments from their summaries, if any */
+	MemSet(&summary_pagemaps, 0, sizeof(PageMapHash));
+	summaryStartSegNo = startSegNo;
+	summaryEndSegNo = endSegNo;
+	segmentSummarized = (bool *) pgut_malloc(endSegNo - startSegNo + 1);
+	MemSet(segmentSummarized, 0, endSegNo - startSegNo + 1);
+
+	for (segno = startSegNo + 1; segno < endSegNo; segno++)
+	{
+		char		summary_path[MAXPGPATH];
+
+		get_wal_summary_path(summary_path, archivedir, tli, segno, seg_size);
+		if (read_wal_summary_file(summary_path, &summary_pagemaps))
+		{
+			segmentSummarized[segno - startSegNo] = true;
+			nsummarized++;
+		}
+	}
+
+	if (nsummarized > 0)
+		elog(LOG, "Block summaries are used for %d WAL segments",
+			 nsummarized);
+
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	thread_args = (xlog_thread_arg *) palloc(sizeof(xlog_thread_arg)*num_threads);
 
+	nextSegNoToRead = startSegNo;
+	stopSegNoToRead = endSegNo;
+
 	/*
 	 * Initialize thread args.
 	 *
@@ -392,16 +1070,17 @@ extractPageMap(const char *archivedir, TimeLineID tli, uint32 seg_size,
 		thread_args[i].startpoint = startpoint;
 		thread_args[i].endpoint = endpoint;
 		thread_args[i].endSegNo = endSegNo;
+		MemSet(&thread_args[i].pagemaps, 0, sizeof(PageMapHash));
+		MemSet(&thread_args[i].segment_pagemaps, 0, sizeof(PageMapHash));
+		thread_args[i].summary_segno = 0;
+		thread_args[i].results = NULL;
 		/* By default there is some error */
 		thread_args[i].ret = 1;
 
 		threads_need++;
 
 		/* Adjust startpoint to the next thread */
-		if (nextSegNoToRead == 0)
-			GetXLogSegNo(startpoint, nextSegNoToRead, seg_size);
-
-		nextSegNoToRead++;
+		nextSegNoToRead = nextSegmentToRead(nextSegNoToRead + 1);
 		/*
 		 * If we need to read less WAL segments than num_threads, create less
 		 * threads.
@@ -411,6 +1090,9 @@ extractPageMap(const char *archivedir, TimeLineID tli, uint32 seg_size,
 		GetXLogRecPtr(nextSegNoToRead, 0, seg_size, startpoint);
 	}
 
+	wal_loader_start(archivedir, tli, seg_size, startSegNo, endSegNo,
+					 segmentSummarized);
+
 	/* Run threads */
 	for (i = 0; i < threads_need; i++)
 	{
@@ -426,8 +1108,20 @@ extractPageMap(const char *archivedir, TimeLineID tli, uint32 seg_size,
 			extract_isok = false;
 	}
 
+	wal_loader_stop();
+
+	/* Merge blocks found by every thread into pagemaps of files */
+	if (extract_isok)
+	{
+		for (i = 0; i < threads_need; i++)
+			pagemap_hash_flush(&thread_args[i].pagemaps);
+		pagemap_hash_flush(&summary_pagemaps);
+	}
+
 	pfree(threads);
 	pfree(thread_args);
+	pg_free(segmentSummarized);
+	segmentSummarized = NULL;
 
 	time(&end_time);
 	if (extract_isok)
@@ -455,55 +1149,598 @@ validate_backup_wal_from_start_to_stop(pgBackup *backup,
 	xlogreader = InitXLogPageRead(&private, backup_xlog_path, tli,
 								  xlog_seg_size, true);
 
-	while (true)
-	{
-		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
+	while (true)
+	{
+		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
+
+		if (record == NULL)
+		{
+			if (errormsg)
+				elog(WARNING, "%s", errormsg);
+
+			break;
+		}
+
+		/* Got WAL record at stop_lsn */
+		if (xlogreader->ReadRecPtr == backup->stop_lsn)
+		{
+			got_endpoint = true;
+			break;
+		}
+		startpoint = InvalidXLogRecPtr; /* continue reading at next record */
+	}
+
+	if (!got_endpoint)
+	{
+		PrintXLogCorruptionMsg(&private, WARNING);
+
+		/*
+		 * If we don't have WAL between start_lsn and stop_lsn,
+		 * the backup is definitely corrupted. Update its status.
+		 */
+		write_backup_status(backup, BACKUP_STATUS_CORRUPT);
+
+		elog(WARNING, "There are not enough WAL records to consistenly restore "
+			"backup %s from START LSN: %X/%X to STOP LSN: %X/%X",
+			 base36enc(backup->start_time),
+			 (uint32) (backup->start_lsn >> 32),
+			 (uint32) (backup->start_lsn),
+			 (uint32) (backup->stop_lsn >> 32),
+			 (uint32) (backup->stop_lsn));
+	}
+
+	/* clean */
+	CleanupXLogPageRead(xlogreader);
+	XLogReaderFree(xlogreader);
+}
+
+static void
+get_wal_index_path(char *path, const char *archivedir, TimeLineID tli)
+{
+	snprintf(path, MAXPGPATH, "%s/%08X%s", archivedir, tli, WAL_INDEX_SUFFIX);
+}
+
+static int
+compareWalIndexEntry(const void *e1, const void *e2)
+{
+	const WalIndexEntry *e1p = (const WalIndexEntry *) e1;
+	const WalIndexEntry *e2p = (const WalIndexEntry *) e2;
+
+	if (e1p->segno > e2p->segno)
+		return 1;
+	else if (e1p->segno < e2p->segno)
+		return -1;
+	return 0;
+}
+
+/*
+ * Find the entry of the segment with content CRC seg_crc. Entries of
+ * overwritten segments are there too, they do not match the current CRC.
+ */
+static WalIndexEntry *
+find_wal_index_entry(WalIndexEntry *entries, int nentries, XLogSegNo segno,
+					 pg_crc32 seg_crc)
+{
+	WalIndexEntry key;
+	WalIndexEntry *entry;
+	WalIndexEntry *end = entries + nentries;
+
+	if (entries == NULL)
+		return NULL;
+
+	key.segno = segno;
+	entry = (WalIndexEntry *) bsearch(&key, entries, nentries,
+									  sizeof(WalIndexEntry),
+									  compareWalIndexEntry);
+	if (entry == NULL)
+		return NULL;
+
+	/* bsearch() returns any of the entries of the segment */
+	while (entry > entries && (entry - 1)->segno == segno)
+		entry--;
+
+	for (; entry < end && entry->segno == segno; entry++)
+	{
+		if (EQ_CRC32C(entry->seg_crc, seg_crc))
+			return entry;
+	}
+
+	return NULL;
+}
+
+/*
+ * Read valid entries of the WAL index of the timeline sorted by segment
+ * number. A segment may have several entries if it was overwritten.
+ * Returns NULL if there is no index.
+ */
+static WalIndexEntry *
+read_wal_index(const char *archivedir, TimeLineID tli, int *nentries)
+{
+	char		path[MAXPGPATH];
+	FILE	   *fp;
+	struct stat	st;
+	char	   *buf;
+	WalIndexEntry *entries;
+	size_t		off = 0;
+	int			n = 0;
+
+	*nentries = 0;
+	get_wal_index_path(path, archivedir, tli);
+
+	fp = fopen(path, PG_BINARY_R);
+	if (fp == NULL)
+	{
+		if (errno != ENOENT)
+			elog(WARNING, "Cannot open WAL index file \"%s\": %s",
+				 path, strerror(errno));
+		return NULL;
+	}
+
+	if (fstat(fileno(fp), &st) != 0)
+	{
+		elog(WARNING, "Cannot stat WAL index file \"%s\": %s",
+			 path, strerror(errno));
+		fclose(fp);
+		return NULL;
+	}
+
+	buf = (char *) pgut_malloc(st.st_size + 1);
+	if (fread(buf, 1, st.st_size, fp) != (size_t) st.st_size)
+	{
+		elog(WARNING, "Cannot read WAL index file \"%s\": %s",
+			 path, strerror(errno));
+		fclose(fp);
+		pg_free(buf);
+		return NULL;
+	}
+	fclose(fp);
+
+	entries = (WalIndexEntry *)
+		pgut_malloc(sizeof(WalIndexEntry) * (st.st_size / sizeof(WalIndexEntry) + 1));
+
+	while (off + sizeof(WalIndexEntry) <= (size_t) st.st_size)
+	{
+		WalIndexEntry *entry = &entries[n];
+		pg_crc32	crc;
+
+		memcpy(entry, buf + off, sizeof(WalIndexEntry));
+
+		INIT_FILE_CRC32(true, crc);
+		COMP_FILE_CRC32(true, crc, entry, offsetof(WalIndexEntry, crc));
+		FIN_FILE_CRC32(true, crc);
+
+		if (entry->magic != WAL_INDEX_MAGIC || !EQ_CRC32C(crc, entry->crc))
+		{
+			/* Look for the next entry after the torn one */
+			off++;
+			continue;
+		}
+
+		n++;
+		off += sizeof(WalIndexEntry);
+	}
+	pg_free(buf);
+
+	qsort(entries, n, sizeof(WalIndexEntry), compareWalIndexEntry);
+	*nentries = n;
+	return entries;
+}
+
+/*
+ * Append the entry to the WAL index of the timeline. Errors are not fatal,
+ * the segment is just not indexed.
+ */
+static void
+append_wal_index_entry(const char *archivedir, TimeLineID tli,
+					   WalIndexEntry *entry)
+{
+	char		path[MAXPGPATH];
+	int			fd;
+
+	entry->magic = WAL_INDEX_MAGIC;
+	INIT_FILE_CRC32(true, entry->crc);
+	COMP_FILE_CRC32(true, entry->crc, entry, offsetof(WalIndexEntry, crc));
+	FIN_FILE_CRC32(true, entry->crc);
+
+	get_wal_index_path(path, archivedir, tli);
+
+	/* A single write of the entry is not mixed with writes of others */
+	fd = open(path, O_WRONLY | O_CREAT | O_APPEND | PG_BINARY,
+			  FILE_PERMISSION);
+	if (fd < 0)
+	{
+		elog(WARNING, "Cannot open WAL index file \"%s\": %s",
+			 path, strerror(errno));
+		return;
+	}
+
+	if (write(fd, entry, sizeof(WalIndexEntry)) != sizeof(WalIndexEntry) ||
+		fsync(fd) != 0)
+		elog(WARNING, "Cannot write WAL index file \"%s\": %s",
+			 path, strerror(errno));
+	close(fd);
+}
+
+static bool
+wal_segment_exists(const char *archivedir, TimeLineID tli, XLogSegNo segno,
+				   uint32 seg_size)
+{
+	char		xlogfname[MAXFNAMELEN];
+	char		path[MAXPGPATH];
+	char		compressed_path[MAXPGPATH];
+
+	GetXLogFileName(xlogfname, tli, segno, seg_size);
+	join_path_components(path, archivedir, xlogfname);
+
+	return fileExists(path) ||
+		find_compressed_wal_file(path, compressed_path) != NONE_COMPRESS;
+}
+
+/*
+ * Get CRC of the archived segment from its checksum file. Returns false if
+ * the segment has no checksum file, such segments are not indexed.
+ */
+static bool
+wal_segment_crc(const char *archivedir, TimeLineID tli, XLogSegNo segno,
+				uint32 seg_size, pg_crc32 *crc)
+{
+	char		xlogfname[MAXFNAMELEN];
+	char		path[MAXPGPATH];
+
+	GetXLogFileName(xlogfname, tli, segno, seg_size);
+	join_path_components(path, archivedir, xlogfname);
+
+	return read_wal_crc_file(path, crc);
+}
+
+/*
+ * Read records starting in the archived segment into the index entry.
+ * The last record may continue in the next segment, so it has to be in the
+ * archive too. Returns false if the segment cannot be read.
+ */
+static bool
+build_wal_index_entry(const char *archivedir, TimeLineID tli,
+					  uint32 seg_size, XLogSegNo segno, WalIndexEntry *entry)
+{
+	XLogReaderState *xlogreader;
+	XLogPageReadPrivate private;
+	XLogRecPtr	startpoint;
+	XLogRecPtr	found;
+	bool		complete = false;
+
+	MemSet(entry, 0, sizeof(WalIndexEntry));
+	entry->segno = segno;
+
+	xlogreader = InitXLogPageRead(&private, archivedir, tli, seg_size, true);
+
+	GetXLogRecPtr(segno, 0, seg_size, startpoint);
+	found = XLogFindNextRecord(xlogreader, startpoint);
+	if (XLogRecPtrIsInvalid(found))
+	{
+		PrintXLogCorruptionMsg(&private, WARNING);
+		goto cleanup;
+	}
+
+	startpoint = found;
+	while (true)
+	{
+		XLogRecord *record;
+		XLogSegNo	recordSegNo;
+		TransactionId xid;
+		TimestampTz	record_time;
+		char	   *errormsg;
+
+		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
+		if (record == NULL)
+		{
+			/* Every record of the segment is read */
+			GetXLogSegNo(xlogreader->EndRecPtr, recordSegNo, seg_size);
+			if (startpoint == InvalidXLogRecPtr && recordSegNo > segno)
+			{
+				complete = true;
+				break;
+			}
+
+			if (errormsg)
+				elog(WARNING, "%s", errormsg);
+			PrintXLogCorruptionMsg(&private, WARNING);
+			break;
+		}
+
+		GetXLogSegNo(xlogreader->ReadRecPtr, recordSegNo, seg_size);
+		if (recordSegNo > segno)
+		{
+			complete = true;
+			break;
+		}
+
+		if (XLogRecPtrIsInvalid(entry->start_lsn))
+			entry->start_lsn = xlogreader->ReadRecPtr;
+		entry->end_lsn = xlogreader->ReadRecPtr;
+
+		xid = XLogRecGetXid(xlogreader);
+		if (TransactionIdIsValid(xid))
+		{
+			if (!TransactionIdIsValid(entry->min_xid) ||
+				XidPrecedes(xid, entry->min_xid))
+				entry->min_xid = xid;
+			if (!TransactionIdIsValid(entry->max_xid) ||
+				XidPrecedes(entry->max_xid, xid))
+				entry->max_xid = xid;
+			entry->last_xid = xid;
+		}
+
+		if (getRecordTimestamp(xlogreader, &record_time))
+		{
+			if (entry->min_time == 0 || record_time < entry->min_time)
+				entry->min_time = record_time;
+			if (record_time > entry->max_time)
+				entry->max_time = record_time;
+			entry->last_time = record_time;
+		}
+
+		/* continue reading at next record */
+		startpoint = InvalidXLogRecPtr;
+	}
+
+cleanup:
+	CleanupXLogPageRead(xlogreader);
+	XLogReaderFree(xlogreader);
+
+	return complete;
+}
+
+/*
+ * Add archived segments from first_segno to last_segno of the timeline to
+ * the WAL index, unless they are already indexed with the same content.
+ * A segment is indexed only if it has a checksum file and the next segment
+ * is archived too. Returns the number of added entries.
+ */
+int
+index_wal(const char *archivedir, TimeLineID tli, uint32 seg_size,
+		  XLogSegNo first_segno, XLogSegNo last_segno)
+{
+	WalIndexEntry *entries;
+	int			nentries;
+	XLogSegNo	segno;
+	int			nindexed = 0;
+
+	entries = read_wal_index(archivedir, tli, &nentries);
+
+	for (segno = first_segno; segno <= last_segno; segno++)
+	{
+		WalIndexEntry entry;
+		pg_crc32	seg_crc;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during WAL indexing");
+
+		if (!wal_segment_exists(archivedir, tli, segno, seg_size) ||
+			!wal_segment_crc(archivedir, tli, segno, seg_size, &seg_crc) ||
+			find_wal_index_entry(entries, nentries, segno, seg_crc) != NULL ||
+			!wal_segment_exists(archivedir, tli, segno + 1, seg_size))
+			continue;
+
+		if (build_wal_index_entry(archivedir, tli, seg_size, segno, &entry))
+		{
+			entry.seg_crc = seg_crc;
+			append_wal_index_entry(archivedir, tli, &entry);
+			nindexed++;
+		}
+	}
+
+	pg_free(entries);
+	return nindexed;
+}
+
+/*
+ * Skip segments starting from "segno", which are known from the WAL index
+ * not to contain the recovery target and are present in the archive. Last
+ * xid, time and LSN of skipped segments are returned. Returns the first
+ * segment which has to be read.
+ */
+static XLogSegNo
+skipIndexedSegments(const char *archivedir, TimeLineID tli, uint32 seg_size,
+					XLogSegNo segno, XLogSegNo endSegNo,
+					time_t target_time, TransactionId target_xid,
+					TransactionId *last_xid, TimestampTz *last_time,
+					XLogRecPtr *last_lsn)
+{
+	WalIndexEntry *entries;
+	int			nentries;
+	int			nskipped = 0;
+
+	entries = read_wal_index(archivedir, tli, &nentries);
+	if (entries == NULL)
+		return segno;
+
+	/* Records of the segment of target lsn are always read */
+	for (; segno < endSegNo; segno++)
+	{
+		WalIndexEntry *entry;
+		pg_crc32	seg_crc;
+
+		/*
+		 * Skipped segment is still required to be in the archive, and to be
+		 * the same segment which was indexed.
+		 */
+		if (!wal_segment_exists(archivedir, tli, segno, seg_size) ||
+			!wal_segment_crc(archivedir, tli, segno, seg_size, &seg_crc))
+			break;
+
+		entry = find_wal_index_entry(entries, nentries, segno, seg_crc);
+		if (entry == NULL)
+			break;
+
+		if (target_time != 0 && entry->max_time != 0 &&
+			timestamptz_to_time_t(entry->max_time) >= target_time)
+			break;
+
+		if (TransactionIdIsValid(target_xid) &&
+			TransactionIdIsValid(entry->min_xid) &&
+			!XidPrecedes(target_xid, entry->min_xid) &&
+			!XidPrecedes(entry->max_xid, target_xid))
+			break;
+
+		if (TransactionIdIsValid(entry->last_xid))
+			*last_xid = entry->last_xid;
+		if (entry->last_time != 0)
+			*last_time = entry->last_time;
+		if (!XLogRecPtrIsInvalid(entry->end_lsn))
+			*last_lsn = entry->end_lsn;
+		nskipped++;
+	}
+
+	if (nskipped > 0)
+		elog(LOG, "WAL index allows to skip %d WAL segments", nskipped);
+
+	pg_free(entries);
+	return segno;
+}
+
+/* Compare two ValidateSegmentResult by segment number */
+static int
+compareValidateSegmentResult(const void *r1, const void *r2)
+{
+	ValidateSegmentResult *r1p = *(ValidateSegmentResult **) r1;
+	ValidateSegmentResult *r2p = *(ValidateSegmentResult **) r2;
+
+	if (r1p->segno > r2p->segno)
+		return 1;
+	else if (r1p->segno < r2p->segno)
+		return -1;
+	return 0;
+}
+
+/*
+ * validate_wal() worker. Reads records of the segments taken one by one until
+ * a record satisfying the recovery target or the end of available WAL.
+ */
+static void *
+doValidateWal(void *arg)
+{
+	xlog_thread_arg *validate_arg = (xlog_thread_arg *) arg;
+	XLogPageReadPrivate *private_data;
+	XLogReaderState *xlogreader;
+	ValidateSegmentResult *result = NULL;
+	XLogSegNo	recordSegNo;
+	XLogRecPtr	found;
+	char	   *errormsg;
+
+	private_data = &validate_arg->private_data;
+#if PG_VERSION_NUM >= 110000
+	xlogreader = XLogReaderAllocate(private_data->xlog_seg_size,
+									&SimpleXLogPageRead, private_data);
+#else
+	xlogreader = XLogReaderAllocate(&SimpleXLogPageRead, private_data);
+#endif
+	if (xlogreader == NULL)
+		elog(ERROR, "Thread [%d]: out of memory", private_data->thread_num);
+	xlogreader->system_identifier = instance_config.system_identifier;
+
+	found = XLogFindNextRecord(xlogreader, validate_arg->startpoint);
+	if (XLogRecPtrIsInvalid(found))
+	{
+		GetXLogSegNo(validate_arg->startpoint, recordSegNo,
+					 private_data->xlog_seg_size);
+		validateWalFailed(validate_arg, recordSegNo, NULL);
+		goto cleanup;
+	}
+	validate_arg->startpoint = found;
+
+	/* Switch WAL segment manually below without using SimpleXLogPageRead() */
+	private_data->manual_switch = true;
+
+	while (true)
+	{
+		XLogRecord *record;
+		TimestampTz	record_time;
+		bool		timestamp_record;
+
+		if (interrupted)
+			elog(ERROR, "Thread [%d]: Interrupted during WAL reading",
+				 private_data->thread_num);
+
+		if (private_data->need_switch)
+		{
+			if (!switchToNextWal(xlogreader, validate_arg))
+				break;
+		}
 
+		record = XLogReadRecord(xlogreader, validate_arg->startpoint, &errormsg);
 		if (record == NULL)
 		{
-			if (errormsg)
-				elog(WARNING, "%s", errormsg);
+			XLogRecPtr	errptr;
+
+			if (private_data->need_switch && errormsg == NULL)
+			{
+				if (switchToNextWal(xlogreader, validate_arg))
+					continue;
+				else
+					break;
+			}
 
+			errptr = validate_arg->startpoint ?
+				validate_arg->startpoint : xlogreader->EndRecPtr;
+			GetXLogSegNo(errptr, recordSegNo, private_data->xlog_seg_size);
+			validateWalFailed(validate_arg, recordSegNo, errormsg);
 			break;
 		}
 
-		/* Got WAL record at stop_lsn */
-		if (xlogreader->ReadRecPtr == backup->stop_lsn)
+		GetXLogSegNo(xlogreader->ReadRecPtr, recordSegNo,
+					 private_data->xlog_seg_size);
+		if (result == NULL || result->segno != recordSegNo)
 		{
-			got_endpoint = true;
-			break;
+			result = pgut_new(ValidateSegmentResult);
+			result->segno = recordSegNo;
+			result->target_found = false;
+			result->last_xid = InvalidTransactionId;
+			result->last_time = 0;
+			parray_append(validate_arg->results, result);
 		}
-		startpoint = InvalidXLogRecPtr; /* continue reading at next record */
-	}
-
-	if (!got_endpoint)
-	{
-		PrintXLogCorruptionMsg(&private, WARNING);
 
-		/*
-		 * If we don't have WAL between start_lsn and stop_lsn,
-		 * the backup is definitely corrupted. Update its status.
-		 */
-		write_backup_status(backup, BACKUP_STATUS_CORRUPT);
+		timestamp_record = getRecordTimestamp(xlogreader, &record_time);
+		if (timestamp_record)
+			result->last_time = record_time;
+		if (XLogRecGetXid(xlogreader) != InvalidTransactionId)
+			result->last_xid = XLogRecGetXid(xlogreader);
+		result->last_lsn = xlogreader->ReadRecPtr;
+
+		/* Check target xid, target time and target lsn */
+		if ((TransactionIdIsValid(validate_arg->target_xid) &&
+			 validate_arg->target_xid == result->last_xid) ||
+			(validate_arg->target_time != 0 && timestamp_record &&
+			 timestamptz_to_time_t(record_time) >= validate_arg->target_time) ||
+			(XRecOffIsValid(validate_arg->target_lsn) &&
+			 result->last_lsn >= validate_arg->target_lsn))
+		{
+			result->target_found = true;
+			/* Segments after this one are not needed anymore */
+			stopReadingAfter(recordSegNo);
+			break;
+		}
 
-		elog(WARNING, "There are not enough WAL records to consistenly restore "
-			"backup %s from START LSN: %X/%X to STOP LSN: %X/%X",
-			 base36enc(backup->start_time),
-			 (uint32) (backup->start_lsn >> 32),
-			 (uint32) (backup->start_lsn),
-			 (uint32) (backup->stop_lsn >> 32),
-			 (uint32) (backup->stop_lsn));
+		/* continue reading at next record */
+		validate_arg->startpoint = InvalidXLogRecPtr;
 	}
 
-	/* clean */
+cleanup:
 	CleanupXLogPageRead(xlogreader);
 	XLogReaderFree(xlogreader);
+
+	validate_arg->ret = 0;
+	return NULL;
 }
 
 /*
  * Ensure that the backup has all wal files needed for recovery to consistent
  * state. And check if we have in archive all files needed to restore the backup
  * up to the given recovery target.
+ *
+ * WAL after the backup is read by threads, each thread reads its own WAL
+ * segment. Segments after the one containing the recovery target or the first
+ * unreadable one are not read. Segments which cannot contain the target
+ * according to the WAL index are not read either.
  */
 void
 validate_wal(pgBackup *backup, const char *archivedir,
@@ -511,19 +1748,25 @@ validate_wal(pgBackup *backup, const char *archivedir,
 			 XLogRecPtr target_lsn,
 			 TimeLineID tli, uint32 seg_size)
 {
-	XLogRecPtr	startpoint = backup->start_lsn;
+	XLogRecPtr	startpoint;
 	const char *backup_id;
-	XLogRecord *record;
-	XLogReaderState *xlogreader;
-	char	   *errormsg;
-	XLogPageReadPrivate private;
 	TransactionId last_xid = InvalidTransactionId;
 	TimestampTz last_time = 0;
 	char		last_timestamp[100],
 				target_timestamp[100];
 	XLogRecPtr	last_lsn = InvalidXLogRecPtr;
 	bool		all_wal = false;
+	bool		validate_isok = true;
 	char		backup_xlog_path[MAXPGPATH];
+	XLogSegNo	startSegNo;
+	XLogSegNo	endSegNo;
+	XLogSegNo	segno;
+	int			i;
+	int			threads_need = 0;
+	pthread_t  *threads;
+	xlog_thread_arg *thread_args;
+	xlog_thread_arg *failed_arg = NULL;
+	parray	   *results;
 
 	/* We need free() this later */
 	backup_id = base36enc(backup->start_time);
@@ -581,67 +1824,132 @@ validate_wal(pgBackup *backup, const char *archivedir,
 	 * Check if we have in archive all files needed to restore backup
 	 * up to the given recovery target.
 	 * In any case we cannot restore to the point before stop_lsn.
+	 * We can restore at least up to the backup end.
 	 */
-	xlogreader = InitXLogPageRead(&private, archivedir, tli, seg_size,
-								  true);
-
-	/* We can restore at least up to the backup end */
 	time2iso(last_timestamp, lengthof(last_timestamp), backup->recovery_time);
 	last_xid = backup->recovery_xid;
 	last_lsn = backup->stop_lsn;
 
+	/* The backup itself satisfies the target, WAL after it is not needed */
 	if ((TransactionIdIsValid(target_xid) && target_xid == last_xid)
 		|| (target_time != 0 && backup->recovery_time >= target_time)
 		|| (XRecOffIsValid(target_lsn) && backup->stop_lsn >= target_lsn))
-		all_wal = true;
+	{
+		elog(INFO, "backup validation completed successfully on time %s, xid " XID_FMT " and LSN %X/%X",
+			 last_timestamp, last_xid,
+			 (uint32) (last_lsn >> 32), (uint32) last_lsn);
+		return;
+	}
 
+	/* The end of WAL to read is known only for target lsn */
+	GetXLogSegNo(backup->stop_lsn, startSegNo, seg_size);
+	if (XRecOffIsValid(target_lsn))
+		GetXLogSegNo(target_lsn, endSegNo, seg_size);
+	else
+		endSegNo = PG_UINT64_MAX;
+
+	/* Jump over segments which cannot contain the target using WAL index */
 	startpoint = backup->stop_lsn;
-	while (true)
+	segno = skipIndexedSegments(archivedir, tli, seg_size, startSegNo,
+								endSegNo, target_time, target_xid,
+								&last_xid, &last_time, &last_lsn);
+	if (segno > startSegNo)
 	{
-		bool		timestamp_record;
+		startSegNo = segno;
+		GetXLogRecPtr(startSegNo, 0, seg_size, startpoint);
+	}
 
-		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
-		if (record == NULL)
-		{
-			if (errormsg)
-				elog(WARNING, "%s", errormsg);
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
+	thread_args = (xlog_thread_arg *) palloc(sizeof(xlog_thread_arg)*num_threads);
 
-			break;
-		}
+	nextSegNoToRead = startSegNo;
+	stopSegNoToRead = endSegNo;
 
-		timestamp_record = getRecordTimestamp(xlogreader, &last_time);
-		if (XLogRecGetXid(xlogreader) != InvalidTransactionId)
-			last_xid = XLogRecGetXid(xlogreader);
-		last_lsn = xlogreader->ReadRecPtr;
+	/*
+	 * Initialize thread args. The first thread starts at stop_lsn or at the
+	 * first segment not skipped, others start at the beginning of the next
+	 * segments.
+	 */
+	for (i = 0; i < num_threads; i++)
+	{
+		InitXLogPageRead(&thread_args[i].private_data, archivedir, tli,
+						 seg_size, false);
+		thread_args[i].private_data.thread_num = i + 1;
 
-		/* Check target xid */
-		if (TransactionIdIsValid(target_xid) && target_xid == last_xid)
-		{
-			all_wal = true;
+		thread_args[i].startpoint = startpoint;
+		thread_args[i].endpoint = InvalidXLogRecPtr;
+		thread_args[i].endSegNo = endSegNo;
+		thread_args[i].target_time = target_time;
+		thread_args[i].target_xid = target_xid;
+		thread_args[i].target_lsn = target_lsn;
+		thread_args[i].results = parray_new();
+		thread_args[i].failed_segno = 0;
+		thread_args[i].failed_errormsg = NULL;
+		thread_args[i].failed_private = NULL;
+		/* By default there is some error */
+		thread_args[i].ret = 1;
+
+		threads_need++;
+
+		/* Adjust startpoint to the next thread */
+		nextSegNoToRead++;
+		if (nextSegNoToRead > endSegNo)
 			break;
-		}
-		/* Check target time */
-		else if (target_time != 0 && timestamp_record &&
-				 timestamptz_to_time_t(last_time) >= target_time)
-		{
-			all_wal = true;
+		GetXLogRecPtr(nextSegNoToRead, 0, seg_size, startpoint);
+	}
+
+	wal_loader_start(archivedir, tli, seg_size, startSegNo, endSegNo, NULL);
+
+	/* Run threads */
+	for (i = 0; i < threads_need; i++)
+	{
+		elog(VERBOSE, "Start WAL reader thread: %d", i + 1);
+		pthread_create(&threads[i], NULL, doValidateWal, &thread_args[i]);
+	}
+
+	/* Wait for threads */
+	results = parray_new();
+	for (i = 0; i < threads_need; i++)
+	{
+		pthread_join(threads[i], NULL);
+		if (thread_args[i].ret == 1)
+			validate_isok = false;
+
+		parray_concat(results, thread_args[i].results);
+		parray_free(thread_args[i].results);
+
+		/* WAL is readable only up to the earliest failure */
+		if (thread_args[i].failed_private != NULL &&
+			(failed_arg == NULL ||
+			 thread_args[i].failed_segno < failed_arg->failed_segno))
+			failed_arg = &thread_args[i];
+	}
+
+	wal_loader_stop();
+
+	if (!validate_isok)
+		elog(ERROR, "WAL validation failed");
+
+	/* Walk through segments in order up to the target or the failure */
+	parray_qsort(results, compareValidateSegmentResult);
+	for (i = 0; i < parray_num(results); i++)
+	{
+		ValidateSegmentResult *result = parray_get(results, i);
+
+		if (failed_arg != NULL && result->segno > failed_arg->failed_segno)
 			break;
-		}
-		/* Check target lsn */
-		else if (XRecOffIsValid(target_lsn) && last_lsn >= target_lsn)
+
+		if (TransactionIdIsValid(result->last_xid))
+			last_xid = result->last_xid;
+		if (result->last_time != 0)
+			last_time = result->last_time;
+		last_lsn = result->last_lsn;
+
+		if (result->target_found)
 		{
 			all_wal = true;
 			break;
 		}
-		/* If there are no target xid, target time and target lsn */
-		else if (!TransactionIdIsValid(target_xid) && target_time == 0 &&
-				 !XRecOffIsValid(target_lsn))
-		{
-			all_wal = true;
-			/* We don't stop here. We want to get last_xid and last_time */
-		}
-
-		startpoint = InvalidXLogRecPtr; /* continue reading at next record */
 	}
 
 	if (last_time > 0)
@@ -656,7 +1964,14 @@ validate_wal(pgBackup *backup, const char *archivedir,
 	/* Some needed WAL records are absent */
 	else
 	{
-		PrintXLogCorruptionMsg(&private, WARNING);
+		if (failed_arg != NULL)
+		{
+			if (failed_arg->failed_errormsg)
+				elog(WARNING, "%s", failed_arg->failed_errormsg);
+			PrintXLogCorruptionMsg(failed_arg->failed_private, WARNING);
+		}
+		else
+			PrintXLogCorruptionMsg(&thread_args[0].private_data, WARNING);
 
 		elog(WARNING, "recovery can be done up to time %s, xid " XID_FMT " and LSN %X/%X",
 				last_timestamp, last_xid,
@@ -680,8 +1995,15 @@ validate_wal(pgBackup *backup, const char *archivedir,
 	}
 
 	/* clean */
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	parray_walk(results, pfree);
+	parray_free(results);
+	for (i = 0; i < threads_need; i++)
+	{
+		pg_free(thread_args[i].failed_errormsg);
+		pg_free(thread_args[i].failed_private);
+	}
+	pfree(threads);
+	pfree(thread_args);
 }
 
 /*
@@ -895,6 +2217,192 @@ get_last_wal_lsn(const char *archivedir, XLogRecPtr start_lsn,
 	return res;
 }
 
+#ifndef WIN32
+static void *
+wal_loader_thread(void *arg)
+{
+	WalLoader  *loader = (WalLoader *) arg;
+
+	pthread_lock(&wal_loader_mutex);
+	while (!loader->stopping)
+	{
+		XLogSegNo	segno = Max(loader->next_segno, loader->read_segno + 1);
+		WalSegmentBuffer *buf;
+		char		xlogfname[MAXFNAMELEN];
+		char		xlogpath[MAXPGPATH];
+
+		if (segno <= loader->end_segno && loader->skip_segments &&
+			loader->skip_segments[segno - loader->start_segno])
+		{
+			loader->next_segno = segno + 1;
+			continue;
+		}
+
+		buf = &loader->buffers[(segno - loader->start_segno) % loader->depth];
+
+		/*
+		 * Wait until readers request new segments or release the buffer of
+		 * the segment.
+		 */
+		if (segno > loader->end_segno ||
+			segno > loader->read_segno + loader->depth ||
+			buf->state == WAL_SEGMENT_LOADING || buf->refcount > 0)
+		{
+			pthread_cond_wait(&wal_loader_cond, &wal_loader_mutex);
+			continue;
+		}
+
+		loader->next_segno = segno + 1;
+		pg_free(buf->data);
+		buf->data = NULL;
+		buf->segno = segno;
+		buf->state = WAL_SEGMENT_LOADING;
+		pthread_mutex_unlock(&wal_loader_mutex);
+
+		GetXLogFileName(xlogfname, loader->tli, segno, loader->seg_size);
+		snprintf(xlogpath, MAXPGPATH, "%s/%s", loader->archivedir, xlogfname);
+		buf->data = load_wal_segment(xlogpath, buf->path, &buf->is_compressed,
+									 &buf->size);
+		if (buf->data)
+			elog(VERBOSE, "WAL segment \"%s\" is read ahead", buf->path);
+
+		pthread_lock(&wal_loader_mutex);
+		buf->state = buf->data ? WAL_SEGMENT_LOADED : WAL_SEGMENT_FAILED;
+		pthread_cond_broadcast(&wal_loader_cond);
+	}
+	pthread_mutex_unlock(&wal_loader_mutex);
+
+	return NULL;
+}
+#endif
+
+/*
+ * Start read-ahead of segments from start_segno to end_segno, if
+ * --wal-readahead is set. Segments marked in skip_segments array are not
+ * loaded.
+ */
+static void
+wal_loader_start(const char *archivedir, TimeLineID tli, uint32 seg_size,
+				 XLogSegNo start_segno, XLogSegNo end_segno,
+				 const bool *skip_segments)
+{
+#ifndef WIN32
+	WalLoader  *loader;
+	int			i;
+
+	if (wal_readahead_depth <= 0)
+		return;
+
+	loader = pgut_new(WalLoader);
+	loader->archivedir = archivedir;
+	loader->tli = tli;
+	loader->seg_size = seg_size;
+	loader->start_segno = start_segno;
+	loader->end_segno = end_segno;
+	loader->skip_segments = skip_segments;
+	loader->next_segno = start_segno;
+	loader->read_segno = start_segno - 1;
+	loader->depth = wal_readahead_depth;
+	loader->buffers = (WalSegmentBuffer *)
+		pgut_malloc(sizeof(WalSegmentBuffer) * loader->depth);
+	MemSet(loader->buffers, 0, sizeof(WalSegmentBuffer) * loader->depth);
+	loader->stopping = false;
+	/* Segments are decompressed in parallel by up to num_threads threads */
+	loader->nthreads = Min(loader->depth, Max(num_threads, 1));
+	loader->threads = (pthread_t *) palloc(sizeof(pthread_t) *
+										   loader->nthreads);
+
+	wal_loader = loader;
+	for (i = 0; i < loader->nthreads; i++)
+	{
+		elog(VERBOSE, "Start WAL read-ahead thread: %d", i + 1);
+		pthread_create(&loader->threads[i], NULL, wal_loader_thread, loader);
+	}
+#endif
+}
+
+/*
+ * Stop read-ahead threads and free loaded segments. Readers should be
+ * finished, readers failed with ERROR may leave their buffers referenced.
+ */
+static void
+wal_loader_stop(void)
+{
+#ifndef WIN32
+	WalLoader  *loader = wal_loader;
+	int			i;
+
+	if (loader == NULL)
+		return;
+
+	pthread_lock(&wal_loader_mutex);
+	loader->stopping = true;
+	pthread_cond_broadcast(&wal_loader_cond);
+	pthread_mutex_unlock(&wal_loader_mutex);
+
+	for (i = 0; i < loader->nthreads; i++)
+		pthread_join(loader->threads[i], NULL);
+
+	for (i = 0; i < loader->depth; i++)
+		pg_free(loader->buffers[i].data);
+
+	wal_loader = NULL;
+	pfree(loader->threads);
+	pfree(loader->buffers);
+	pfree(loader);
+#endif
+}
+
+/*
+ * Get segment segno loaded by read-ahead threads, wait for it if it is being
+ * loaded. Returns NULL if the segment is not loaded, then the reader has to
+ * read it by itself.
+ */
+static WalSegmentBuffer *
+wal_loader_get(XLogSegNo segno)
+{
+	WalSegmentBuffer *buf = NULL;
+
+#ifndef WIN32
+	WalLoader  *loader = wal_loader;
+
+	if (loader == NULL || segno < loader->start_segno ||
+		segno > loader->end_segno)
+		return NULL;
+
+	pthread_lock(&wal_loader_mutex);
+	if (segno > loader->read_segno)
+	{
+		/* Let loader threads move on */
+		loader->read_segno = segno;
+		pthread_cond_broadcast(&wal_loader_cond);
+	}
+
+	buf = &loader->buffers[(segno - loader->start_segno) % loader->depth];
+	while (buf->segno == segno && buf->state == WAL_SEGMENT_LOADING)
+		pthread_cond_wait(&wal_loader_cond, &wal_loader_mutex);
+
+	if (buf->segno == segno && buf->state == WAL_SEGMENT_LOADED)
+		buf->refcount++;
+	else
+		buf = NULL;
+	pthread_mutex_unlock(&wal_loader_mutex);
+#endif
+
+	return buf;
+}
+
+static void
+wal_loader_release(WalSegmentBuffer *buf)
+{
+#ifndef WIN32
+	pthread_lock(&wal_loader_mutex);
+	buf->refcount--;
+	pthread_cond_broadcast(&wal_loader_cond);
+	pthread_mutex_unlock(&wal_loader_mutex);
+#endif
+}
+
 #ifdef HAVE_LIBZ
 /*
  * Show error during work with compressed file
@@ -985,7 +2493,21 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 		snprintf(private_data->xlogpath, MAXPGPATH, "%s/%s",
 				 private_data->archivedir, xlogfname);
 
-		if (fileExists(private_data->xlogpath))
+		private_data->readahead_buf = wal_loader_get(private_data->xlogsegno);
+		if (private_data->readahead_buf != NULL)
+		{
+			WalSegmentBuffer *buf = private_data->readahead_buf;
+
+			elog(LOG, "Thread [%d]: Opening read ahead WAL segment \"%s\"",
+				 private_data->thread_num, buf->path);
+
+			if (buf->is_compressed)
+				strcpy(private_data->compressed_xlogpath, buf->path);
+			private_data->xlogexists = true;
+			private_data->xlogdata = buf->data;
+			private_data->xlogdata_size = buf->size;
+		}
+		else if (fileExists(private_data->xlogpath))
 		{
 			elog(LOG, "Thread [%d]: Opening WAL segment \"%s\"",
 				 private_data->thread_num,
@@ -1004,30 +2526,54 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 				return -1;
 			}
 		}
-#ifdef HAVE_LIBZ
 		/* Try to open compressed WAL segment */
 		else
 		{
-			snprintf(private_data->gz_xlogpath,
-					 sizeof(private_data->gz_xlogpath), "%s.gz",
-					 private_data->xlogpath);
-			if (fileExists(private_data->gz_xlogpath))
+			CompressAlg	calg;
+
+			calg = find_compressed_wal_file(private_data->xlogpath,
+											private_data->compressed_xlogpath);
+			if (calg != NONE_COMPRESS)
 			{
 				elog(LOG, "Thread [%d]: Opening compressed WAL segment \"%s\"",
-					 private_data->thread_num, private_data->gz_xlogpath);
+					 private_data->thread_num,
+					 private_data->compressed_xlogpath);
 
 				private_data->xlogexists = true;
-				private_data->gz_xlogfile = gzopen(private_data->gz_xlogpath,
+			}
+
+#ifdef HAVE_LIBZ
+			if (calg == ZLIB_COMPRESS)
+			{
+				private_data->gz_xlogfile = gzopen(private_data->compressed_xlogpath,
 												   "rb");
 				if (private_data->gz_xlogfile == NULL)
 				{
 					elog(WARNING, "Thread [%d]: Could not open compressed WAL segment \"%s\": %s",
-						 private_data->thread_num, private_data->gz_xlogpath, strerror(errno));
+						 private_data->thread_num,
+						 private_data->compressed_xlogpath, strerror(errno));
 					return -1;
 				}
 			}
-		}
+			else
 #endif
+			if (calg != NONE_COMPRESS)
+			{
+				const char *errormsg = NULL;
+
+				private_data->xlogdata =
+					decompress_wal_file(private_data->compressed_xlogpath,
+										calg, &private_data->xlogdata_size,
+										&errormsg);
+				if (private_data->xlogdata == NULL)
+				{
+					elog(WARNING, "Thread [%d]: Could not decompress WAL segment \"%s\": %s",
+						 private_data->thread_num,
+						 private_data->compressed_xlogpath, errormsg);
+					return -1;
+				}
+			}
+		}
 
 		/* Exit without error if WAL segment doesn't exist */
 		if (!private_data->xlogexists)
@@ -1067,6 +2613,22 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 			return -1;
 		}
 	}
+	else if (private_data->xlogdata != NULL)
+	{
+		if (targetPageOff + XLOG_BLCKSZ > private_data->xlogdata_size)
+		{
+			if (private_data->readahead_buf &&
+				!private_data->readahead_buf->is_compressed)
+				elog(WARNING, "Thread [%d]: Could not read from WAL segment \"%s\": unexpected end of file",
+					 private_data->thread_num, private_data->xlogpath);
+			else
+				elog(WARNING, "Thread [%d]: Could not read from compressed WAL segment \"%s\": unexpected end of file",
+					 private_data->thread_num, private_data->compressed_xlogpath);
+			return -1;
+		}
+
+		memcpy(readBuf, private_data->xlogdata + targetPageOff, XLOG_BLCKSZ);
+	}
 #ifdef HAVE_LIBZ
 	else
 	{
@@ -1074,7 +2636,7 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 		{
 			elog(WARNING, "Thread [%d]: Could not seek in compressed WAL segment \"%s\": %s",
 				private_data->thread_num,
-				private_data->gz_xlogpath,
+				private_data->compressed_xlogpath,
 				get_gz_error(private_data->gz_xlogfile));
 			return -1;
 		}
@@ -1083,7 +2645,7 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 		{
 			elog(WARNING, "Thread [%d]: Could not read from compressed WAL segment \"%s\": %s",
 				private_data->thread_num,
-				private_data->gz_xlogpath,
+				private_data->compressed_xlogpath,
 				get_gz_error(private_data->gz_xlogfile));
 			return -1;
 		}
@@ -1148,6 +2710,18 @@ CleanupXLogPageRead(XLogReaderState *xlogreader)
 		private_data->gz_xlogfile = NULL;
 	}
 #endif
+	if (private_data->readahead_buf != NULL)
+	{
+		/* The data belongs to read-ahead buffer */
+		wal_loader_release(private_data->readahead_buf);
+		private_data->readahead_buf = NULL;
+		private_data->xlogdata = NULL;
+	}
+	else if (private_data->xlogdata != NULL)
+	{
+		free(private_data->xlogdata);
+		private_data->xlogdata = NULL;
+	}
 	private_data->prev_page_off = 0;
 	private_data->xlogexists = false;
 }
@@ -1165,18 +2739,18 @@ PrintXLogCorruptionMsg(XLogPageReadPrivate *private_data, int elevel)
 			elog(elevel, "Thread [%d]: WAL segment \"%s\" is absent",
 				 private_data->thread_num,
 				 private_data->xlogpath);
-		else if (private_data->xlogfile != -1)
+		else if (private_data->xlogfile != -1 ||
+				 (private_data->readahead_buf != NULL &&
+				  !private_data->readahead_buf->is_compressed))
 			elog(elevel, "Thread [%d]: Possible WAL corruption. "
 						 "Error has occured during reading WAL segment \"%s\"",
 				 private_data->thread_num,
 				 private_data->xlogpath);
-#ifdef HAVE_LIBZ
-		else if (private_data->gz_xlogfile != NULL)
+		else
 			elog(elevel, "Thread [%d]: Possible WAL corruption. "
 						 "Error has occured during reading WAL segment \"%s\"",
 				 private_data->thread_num,
-				 private_data->gz_xlogpath);
-#endif
+				 private_data->compressed_xlogpath);
 	}
 	else
 	{
@@ -1190,7 +2764,7 @@ PrintXLogCorruptionMsg(XLogPageReadPrivate *private_data, int elevel)
  * Extract information about blocks modified in this record.
  */
 static void
-extractPageInfo(XLogReaderState *record)
+extractPageInfo(XLogReaderState *record, PageMapHash *pagemaps)
 {
 	uint8		block_id;
 	RmgrId		rmid = XLogRecGetRmid(record);
@@ -1254,7 +2828,9 @@ extractPageInfo(XLogReaderState *record)
 		if (forknum != MAIN_FORKNUM)
 			continue;
 
-		process_block_change(forknum, rnode, blkno);
+		datapagemap_add(&pagemap_hash_lookup(pagemaps, rnode,
+											 blkno / RELSEG_SIZE)->pagemap,
+						blkno % RELSEG_SIZE);
 	}
 }
 
@@ -19,7 +19,7 @@
 #include "utils/thread.h"
 #include <time.h>
 
-const char *PROGRAM_VERSION	= "2.0.27";
+const char *PROGRAM_VERSION	= "2.0.28";
 const char *PROGRAM_URL		= "https://github.com/postgrespro/pg_probackup";
 const char *PROGRAM_EMAIL	= "https://github.com/postgrespro/pg_probackup/issues";
 
@@ -31,6 +31,7 @@ typedef enum ProbackupSubcmd
 	DELETE_INSTANCE_CMD,
 	ARCHIVE_PUSH_CMD,
 	ARCHIVE_GET_CMD,
+	INDEX_WAL_CMD,
 	BACKUP_CMD,
 	RESTORE_CMD,
 	VALIDATE_CMD,
@@ -59,6 +60,7 @@ static char *backup_id_string = NULL;
 int			num_threads = 1;
 bool		stream_wal = false;
 bool		progress = false;
+int			wal_readahead_depth = 0;
 #if PG_VERSION_NUM >= 100000
 char	   *replication_slot = NULL;
 #endif
@@ -67,6 +69,8 @@ char	   *replication_slot = NULL;
 bool		backup_logs = false;
 bool		smooth_checkpoint;
 bool		is_remote_backup = false;
+int			num_compress_threads = 0;
+bool		write_wal_summary = false;
 
 /* restore options */
 static char		   *target_time = NULL;
@@ -82,8 +86,10 @@ static pgRecoveryTarget *recovery_target_options = NULL;
 
 bool restore_as_replica = false;
 bool restore_no_validate = false;
+bool restore_incremental = false;
 
 bool skip_block_validation = false;
+bool force_validation = false;
 
 /* delete options */
 bool		delete_wal = false;
@@ -100,6 +106,10 @@ char	   *instance_name;
 static char *wal_file_path;
 static char *wal_file_name;
 static bool	file_overwrite = false;
+static int	archive_batch_size = 1;
+static bool	archive_wal_index = false;
+/* archive-get options */
+static int	archive_prefetch_depth = 0;
 
 /* show options */
 ShowFormat show_format = SHOW_PLAIN;
@@ -128,6 +138,7 @@ static ConfigOption cmd_options[] =
 	{ 'b', 131, "stream",			&stream_wal,		SOURCE_CMD_STRICT },
 	{ 'b', 132, "progress",			&progress,			SOURCE_CMD_STRICT },
 	{ 's', 'i', "backup-id",		&backup_id_string,	SOURCE_CMD_STRICT },
+	{ 'u', 161, "wal-readahead",	&wal_readahead_depth,	SOURCE_CMD_STRICT },
 	/* backup options */
 	{ 'b', 133, "backup-pg-log",	&backup_logs,		SOURCE_CMD_STRICT },
 	{ 'f', 'b', "backup-mode",		opt_backup_mode,	SOURCE_CMD_STRICT },
@@ -135,6 +146,8 @@ static ConfigOption cmd_options[] =
 	{ 's', 'S', "slot",				&replication_slot,	SOURCE_CMD_STRICT },
 	{ 'b', 134, "delete-wal",		&delete_wal,		SOURCE_CMD_STRICT },
 	{ 'b', 135, "delete-expired",	&delete_expired,	SOURCE_CMD_STRICT },
+	{ 'u', 155, "compress-threads",	&num_compress_threads,	SOURCE_CMD_STRICT },
+	{ 'b', 160, "wal-summary",		&write_wal_summary,	SOURCE_CMD_STRICT },
 	/* TODO not completed feature. Make it unavailiable from user level
 	 { 'b', 18, "remote",				&is_remote_backup,	SOURCE_CMD_STRICT, }, */
 	/* restore options */
@@ -150,6 +163,8 @@ static ConfigOption cmd_options[] =
 	{ 'b', 143, "no-validate",		&restore_no_validate,	SOURCE_CMD_STRICT },
 	{ 's', 144, "lsn",				&target_lsn,		SOURCE_CMD_STRICT },
 	{ 'b', 154, "skip-block-validation", &skip_block_validation,	SOURCE_CMD_STRICT },
+	{ 'b', 158, "force-validation",	&force_validation,	SOURCE_CMD_STRICT },
+	{ 'b', 159, "incremental",		&restore_incremental,	SOURCE_CMD_STRICT },
 	/* delete options */
 	{ 'b', 145, "wal",				&delete_wal,		SOURCE_CMD_STRICT },
 	{ 'b', 146, "expired",			&delete_expired,	SOURCE_CMD_STRICT },
@@ -166,6 +181,10 @@ static ConfigOption cmd_options[] =
 	{ 's', 150, "wal-file-path",	&wal_file_path,		SOURCE_CMD_STRICT },
 	{ 's', 151, "wal-file-name",	&wal_file_name,		SOURCE_CMD_STRICT },
 	{ 'b', 152, "overwrite",		&file_overwrite,	SOURCE_CMD_STRICT },
+	{ 'u', 156, "batch-size",		&archive_batch_size,	SOURCE_CMD_STRICT },
+	{ 'b', 162, "wal-index",		&archive_wal_index,	SOURCE_CMD_STRICT },
+	/* archive-get options */
+	{ 'u', 157, "prefetch-depth",	&archive_prefetch_depth,	SOURCE_CMD_STRICT },
 	/* show options */
 	{ 'f', 153, "format",			opt_show_format,	SOURCE_CMD_STRICT },
 	{ 0 }
@@ -212,6 +231,8 @@ main(int argc, char *argv[])
 			backup_subcmd = ARCHIVE_PUSH_CMD;
 		else if (strcmp(argv[1], "archive-get") == 0)
 			backup_subcmd = ARCHIVE_GET_CMD;
+		else if (strcmp(argv[1], "index-wal") == 0)
+			backup_subcmd = INDEX_WAL_CMD;
 		else if (strcmp(argv[1], "add-instance") == 0)
 			backup_subcmd = ADD_INSTANCE_CMD;
 		else if (strcmp(argv[1], "del-instance") == 0)
@@ -462,9 +483,13 @@ main(int argc, char *argv[])
 	switch (backup_subcmd)
 	{
 		case ARCHIVE_PUSH_CMD:
-			return do_archive_push(wal_file_path, wal_file_name, file_overwrite);
+			return do_archive_push(wal_file_path, wal_file_name, file_overwrite,
+								   archive_batch_size, archive_wal_index);
 		case ARCHIVE_GET_CMD:
-			return do_archive_get(wal_file_path, wal_file_name);
+			return do_archive_get(wal_file_path, wal_file_name,
+								  archive_prefetch_depth);
+		case INDEX_WAL_CMD:
+			return do_index_wal();
 		case ADD_INSTANCE_CMD:
 			return do_add_instance();
 		case DELETE_INSTANCE_CMD:
@@ -586,9 +611,14 @@ compress_init(void)
 #ifndef HAVE_LIBZ
 		if (instance_config.compress_alg == ZLIB_COMPRESS)
 			elog(ERROR, "This build does not support zlib compression");
-		else
 #endif
-		if (instance_config.compress_alg == PGLZ_COMPRESS && num_threads > 1)
-			elog(ERROR, "Multithread backup does not support pglz compression");
+#ifndef HAVE_LIBZSTD
+		if (instance_config.compress_alg == ZSTD_COMPRESS)
+			elog(ERROR, "This build does not support zstd compression");
+#endif
+#ifndef HAVE_LIBLZ4
+		if (instance_config.compress_alg == LZ4_COMPRESS)
+			elog(ERROR, "This build does not support lz4 compression");
+#endif
 	}
 }
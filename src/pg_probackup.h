@@ -14,6 +14,7 @@
 #include "libpq-fe.h"
 
 #include "access/xlog_internal.h"
+#include "common/pg_lzcompress.h"
 #include "utils/pg_crc.h"
 
 #ifdef FRONTEND
@@ -47,6 +48,7 @@
 #define BACKUP_CATALOG_CONF_FILE	"pg_probackup.conf"
 #define BACKUP_CATALOG_PID		"backup.pid"
 #define DATABASE_FILE_LIST		"backup_content.control"
+#define BACKUP_VALIDATION_FILE	"validation.control"
 #define PG_BACKUP_LABEL_FILE	"backup_label"
 #define PG_BLACK_LIST			"black_list"
 #define PG_TABLESPACE_MAP_FILE "tablespace_map"
@@ -74,6 +76,8 @@ typedef enum CompressAlg
 	NONE_COMPRESS,
 	PGLZ_COMPRESS,
 	ZLIB_COMPRESS,
+	ZSTD_COMPRESS,
+	LZ4_COMPRESS,
 } CompressAlg;
 
 #define INIT_FILE_CRC32(use_crc32c, crc) \
@@ -98,6 +102,17 @@ do { \
 		FIN_TRADITIONAL_CRC32(crc); \
 } while (0)
 
+/*
+ * Backups taken by 2.0.22 - 2.0.24 have CRC-32 of non-data files, all other
+ * versions use CRC-32C, which is computed by CPU instructions where
+ * available.
+ */
+#define BACKUP_USES_CRC32C(backup_version) \
+	((backup_version) <= 20021 || (backup_version) >= 20025)
+
+/* Size of read buffer of pgFileGetCRC() */
+#define CRC_READ_BUFSIZE	(256 * 1024)
+
 
 /* Information about single file (or dir) in backup */
 typedef struct pgFile
@@ -131,6 +146,12 @@ typedef struct pgFile
 							   * i.e. datafiles without _ptrack */
 } pgFile;
 
+/*
+ * Backup content list opened for lookups by file_list_open(),
+ * see dir.c for the binary format.
+ */
+typedef struct FileList FileList;
+
 /* Special values of datapagemap_t bitmapsize */
 #define PageBitmapIsEmpty 0		/* Used to mark unchanged datafiles */
 
@@ -288,18 +309,24 @@ typedef struct pgRecoveryTarget
 	bool			restore_no_validate;
 } pgRecoveryTarget;
 
+/* Scratch space of pglz_compress_reentrant(), see pglz_reentrant.c */
+typedef struct PGLZ_State PGLZ_State;
+
 typedef struct
 {
 	const char *from_root;
 	const char *to_root;
 
 	parray	   *files_list;
-	parray	   *prev_filelist;
+	FileList   *prev_filelist;
 	XLogRecPtr	prev_start_lsn;
 
 	PGconn	   *backup_conn;
 	PGcancel   *cancel_conn;
 
+	/* Allocated on first use if files are compressed by pglz */
+	PGLZ_State *pglz_state;
+
 	/*
 	 * Return value from the thread.
 	 * 0 means there is no error, 1 - there is an error.
@@ -321,10 +348,28 @@ typedef struct
 #define XLogDataFromLSN(data, xlogid, xrecoff)		\
 	sscanf(data, "%X/%X", xlogid, xrecoff)
 
+/* Suffix of the file with CRC of archived WAL segment */
+#define WAL_CRC_SUFFIX ".crc"
+
+#define IsXLogChecksumFileName(fname) \
+	(strlen(fname) == XLOG_FNAME_LEN + strlen(WAL_CRC_SUFFIX) &&	\
+	 strspn(fname, "0123456789ABCDEF") == XLOG_FNAME_LEN &&		\
+	 strcmp((fname) + XLOG_FNAME_LEN, WAL_CRC_SUFFIX) == 0)
+
+/* Suffix of the file with summary of blocks changed by archived WAL segment */
+#define WAL_SUMMARY_SUFFIX ".summary"
+
+#define IsXLogSummaryFileName(fname) \
+	(strlen(fname) == XLOG_FNAME_LEN + strlen(WAL_SUMMARY_SUFFIX) &&	\
+	 strspn(fname, "0123456789ABCDEF") == XLOG_FNAME_LEN &&		\
+	 strcmp((fname) + XLOG_FNAME_LEN, WAL_SUMMARY_SUFFIX) == 0)
+
 #define IsCompressedXLogFileName(fname) \
-	(strlen(fname) == XLOG_FNAME_LEN + strlen(".gz") &&			\
+	(strlen(fname) > XLOG_FNAME_LEN &&							\
 	 strspn(fname, "0123456789ABCDEF") == XLOG_FNAME_LEN &&		\
-	 strcmp((fname) + XLOG_FNAME_LEN, ".gz") == 0)
+	 (strcmp((fname) + XLOG_FNAME_LEN, ".gz") == 0 ||			\
+	  strcmp((fname) + XLOG_FNAME_LEN, ".zst") == 0 ||			\
+	  strcmp((fname) + XLOG_FNAME_LEN, ".lz4") == 0))
 
 #if PG_VERSION_NUM >= 110000
 #define GetXLogSegNo(xlrp, logSegNo, wal_segsz_bytes) \
@@ -335,6 +380,8 @@ typedef struct
 	XLogFileName(fname, tli, logSegNo, wal_segsz_bytes)
 #define IsInXLogSeg(xlrp, logSegNo, wal_segsz_bytes) \
 	XLByteInSeg(xlrp, logSegNo, wal_segsz_bytes)
+#define GetXLogFromFileName(fname, tli, logSegNo, wal_segsz_bytes) \
+	XLogFromFileName(fname, tli, logSegNo, wal_segsz_bytes)
 #else
 #define GetXLogSegNo(xlrp, logSegNo, wal_segsz_bytes) \
 	XLByteToSeg(xlrp, logSegNo)
@@ -344,6 +391,8 @@ typedef struct
 	XLogFileName(fname, tli, logSegNo)
 #define IsInXLogSeg(xlrp, logSegNo, wal_segsz_bytes) \
 	XLByteInSeg(xlrp, logSegNo)
+#define GetXLogFromFileName(fname, tli, logSegNo, wal_segsz_bytes) \
+	XLogFromFileName(fname, tli, logSegNo)
 #endif
 
 /* directory options */
@@ -355,6 +404,7 @@ extern char		arclog_path[MAXPGPATH];
 extern int		num_threads;
 extern bool		stream_wal;
 extern bool		progress;
+extern int		wal_readahead_depth;
 #if PG_VERSION_NUM >= 100000
 /* In pre-10 'replication_slot' is defined in receivelog.h */
 extern char	   *replication_slot;
@@ -362,7 +412,9 @@ extern char	   *replication_slot;
 
 /* backup options */
 extern bool		smooth_checkpoint;
+extern int		num_compress_threads;
 extern bool		is_remote_backup;
+extern bool		write_wal_summary;
 
 extern bool is_ptrack_support;
 extern bool is_checksum_enabled;
@@ -371,6 +423,8 @@ extern bool exclusive_backup;
 /* restore options */
 extern bool restore_as_replica;
 extern bool skip_block_validation;
+extern bool force_validation;
+extern bool restore_incremental;
 
 /* delete options */
 extern bool		delete_wal;
@@ -397,8 +451,8 @@ extern const char *pgdata_exclude_dir[];
 extern int do_backup(time_t start_time);
 extern BackupMode parse_backup_mode(const char *value);
 extern const char *deparse_backup_mode(BackupMode mode);
-extern void process_block_change(ForkNumber forknum, RelFileNode rnode,
-								 BlockNumber blkno);
+extern void process_block_changes(ForkNumber forknum, RelFileNode rnode,
+								  BlockNumber segno, datapagemap_t *pagemap);
 
 extern char *pg_ptrack_get_block(backup_files_arg *arguments,
 								 Oid dbOid, Oid tblsOid, Oid relOid,
@@ -426,8 +480,10 @@ extern int do_add_instance(void);
 
 /* in archive.c */
 extern int do_archive_push(char *wal_file_path, char *wal_file_name,
-						   bool overwrite);
-extern int do_archive_get(char *wal_file_path, char *wal_file_name);
+						   bool overwrite, int batch_size, bool wal_index);
+extern int do_archive_get(char *wal_file_path, char *wal_file_name,
+						  int prefetch_depth);
+extern int do_index_wal(void);
 
 
 /* in configure.c */
@@ -458,11 +514,14 @@ extern void help_command(char *command);
 /* in validate.c */
 extern void pgBackupValidate(pgBackup* backup);
 extern int do_validate_all(void);
+extern void remove_backup_validation_state(pgBackup *backup);
 
 /* in catalog.c */
 extern pgBackup *read_backup(time_t timestamp);
 extern void write_backup(pgBackup *backup);
 extern void write_backup_status(pgBackup *backup, BackupStatus status);
+extern bool write_backup_status_file(const char *conf_path,
+									 BackupStatus status);
 extern bool lock_backup(pgBackup *backup);
 
 extern const char *pgBackupGetBackupMode(pgBackup *backup);
@@ -506,11 +565,19 @@ extern void create_data_directories(const char *data_dir,
 
 extern void read_tablespace_map(parray *files, const char *backup_dir);
 extern void opt_tablespace_map(ConfigOption *opt, const char *arg);
-extern void check_tablespace_mapping(pgBackup *backup);
+extern void check_tablespace_mapping(pgBackup *backup, bool incremental);
 
-extern void print_file_list(FILE *out, const parray *files, const char *root);
+extern void print_file_list_binary(FILE *out, const parray *files,
+								   const char *root);
 extern parray *dir_read_file_list(const char *root, const char *file_txt);
 
+extern FileList *file_list_open(const char *path);
+extern void file_list_close(FileList *list);
+extern int file_list_num(FileList *list);
+extern pgFile *file_list_get(FileList *list, int i, const char *root);
+extern pg_crc32 file_list_get_crc(FileList *list, int i);
+extern int file_list_find(FileList *list, const char *path);
+
 extern int dir_create_dir(const char *path, mode_t mode);
 extern bool dir_is_empty(const char *path);
 
@@ -529,6 +596,8 @@ extern int pgFileCompareLinked(const void *f1, const void *f2);
 extern int pgFileCompareSize(const void *f1, const void *f2);
 
 /* in data.c */
+extern void compress_pool_start(int nworkers);
+extern void compress_pool_stop(void);
 extern bool backup_data_file(backup_files_arg* arguments,
 							 const char *to_path, pgFile *file,
 							 XLogRecPtr prev_backup_start_lsn,
@@ -538,10 +607,25 @@ extern void restore_data_file(const char *to_path,
 							  pgFile *file, bool allow_truncate,
 							  bool write_header,
 							  uint32 backup_version);
+extern void restore_data_file_chain(const char *to_path, pgFile **files,
+									parray *chain, bool incremental);
+extern void merge_data_file(const char *to_path, pgFile *to_file,
+							pgFile *from_file, bool allow_truncate,
+							uint32 to_version, uint32 from_version,
+							CompressAlg calg, int clevel);
 extern bool copy_file(const char *from_root, const char *to_root, pgFile *file);
 extern void push_wal_file(const char *from_path, const char *to_path,
-						  bool is_compress, bool overwrite);
+						  bool is_compress, bool overwrite,
+						  int compress_threads);
 extern void get_wal_file(const char *from_path, const char *to_path);
+extern bool read_wal_crc_file(const char *to_path, pg_crc32 *crc);
+extern const char *wal_compress_suffix(CompressAlg alg);
+extern CompressAlg find_compressed_wal_file(const char *path,
+											char *compressed_path);
+extern char *decompress_wal_file(const char *path, CompressAlg alg,
+								 size_t *size, const char **errormsg);
+extern char *load_wal_segment(const char *path, char *loaded_path,
+							  bool *is_compressed, size_t *size);
 
 extern void calc_file_checksum(pgFile *file);
 
@@ -563,12 +647,21 @@ extern bool read_recovery_info(const char *archivedir, TimeLineID tli,
 							   XLogRecPtr start_lsn, XLogRecPtr stop_lsn,
 							   time_t *recovery_time,
 							   TransactionId *recovery_xid);
+extern int index_wal(const char *archivedir, TimeLineID tli, uint32 seg_size,
+					 XLogSegNo first_segno, XLogSegNo last_segno);
 extern bool wal_contains_lsn(const char *archivedir, XLogRecPtr target_lsn,
 							 TimeLineID target_tli, uint32 seg_size);
 extern XLogRecPtr get_last_wal_lsn(const char *archivedir, XLogRecPtr start_lsn,
 								   XLogRecPtr stop_lsn, TimeLineID tli,
 								   bool seek_prev_segment, uint32 seg_size);
 
+/* in pglz_reentrant.c */
+extern PGLZ_State *pglz_state_alloc(void);
+extern int32 pglz_compress_reentrant(const char *source, int32 slen,
+									 char *dest,
+									 const PGLZ_Strategy *strategy,
+									 PGLZ_State *state);
+
 /* in util.c */
 extern TimeLineID get_current_timeline(bool safe);
 extern XLogRecPtr get_checkpoint_location(PGconn *conn);
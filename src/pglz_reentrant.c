@@ -0,0 +1,349 @@
+/*-------------------------------------------------------------------------
+ *
+ * pglz_reentrant.c: reentrant pglz compression
+ *
+ * pglz_compress() from src/common/pg_lzcompress.c keeps its history tables in
+ * static variables, so it cannot be called by several threads at once. This
+ * is a copy of it with the history tables moved to PGLZ_State, which every
+ * thread allocates for itself. The output format is the same, pages are
+ * decompressed by pglz_decompress().
+ *
+ * Portions Copyright (c) 1999-2018, PostgreSQL Global Development Group
+ * Portions Copyright (c) 2018, Postgres Professional
+ *
+ *-------------------------------------------------------------------------
+ */
+
+#include "pg_probackup.h"
+
+#define PGLZ_MAX_HISTORY_LISTS	8192	/* must be power of 2 */
+#define PGLZ_HISTORY_SIZE		4096
+#define PGLZ_MAX_MATCH			273
+
+typedef struct PGLZ_HistEntry
+{
+	struct PGLZ_HistEntry *next;	/* links for my hash key's list */
+	struct PGLZ_HistEntry *prev;
+	int			hindex;			/* my current hash key */
+	const char *pos;			/* my input position */
+} PGLZ_HistEntry;
+
+struct PGLZ_State
+{
+	int16		hist_start[PGLZ_MAX_HISTORY_LISTS];
+	PGLZ_HistEntry hist_entries[PGLZ_HISTORY_SIZE + 1];
+};
+
+#define PGLZ_INVALID_ENTRY		0
+
+/* Computes the history table slot for the lookup by the next 4 characters */
+#define pglz_hist_idx(_s,_e,_mask) (									\
+			((((_e) - (_s)) < 4) ? (int) (_s)[0] :						\
+			 (((_s)[0] << 6) ^ ((_s)[1] << 4) ^							\
+			  ((_s)[2] << 2) ^ (_s)[3])) & (_mask)						\
+		)
+
+/* Adds a new entry to the history table */
+#define pglz_hist_add(_hs,_he,_hn,_recycle,_s,_e,_mask)					\
+do {																	\
+			int __hindex = pglz_hist_idx((_s),(_e),(_mask));			\
+			int16 *__myhsp = &(_hs)[__hindex];							\
+			PGLZ_HistEntry *__myhe = &(_he)[_hn];						\
+			if (_recycle) {												\
+				if (__myhe->prev == NULL)								\
+					(_hs)[__myhe->hindex] = __myhe->next - (_he);		\
+				else													\
+					__myhe->prev->next = __myhe->next;					\
+				if (__myhe->next != NULL)								\
+					__myhe->next->prev = __myhe->prev;					\
+			}															\
+			__myhe->next = &(_he)[*__myhsp];							\
+			__myhe->prev = NULL;										\
+			__myhe->hindex = __hindex;									\
+			__myhe->pos  = (_s);										\
+			/* The 0th entry is unused, so it can be scribbled on */	\
+			(_he)[(*__myhsp)].prev = __myhe;							\
+			*__myhsp = _hn;												\
+			if (++(_hn) >= PGLZ_HISTORY_SIZE + 1) {						\
+				(_hn) = 1;												\
+				(_recycle) = true;										\
+			}															\
+} while (0)
+
+/* Outputs the last and allocates a new control byte if needed */
+#define pglz_out_ctrl(__ctrlp,__ctrlb,__ctrl,__buf)						\
+do {																	\
+	if ((__ctrl & 0xff) == 0)											\
+	{																	\
+		*(__ctrlp) = __ctrlb;											\
+		__ctrlp = (__buf)++;											\
+		__ctrlb = 0;													\
+		__ctrl = 1;														\
+	}																	\
+} while (0)
+
+/* Outputs a literal byte to the destination buffer */
+#define pglz_out_literal(_ctrlp,_ctrlb,_ctrl,_buf,_byte)				\
+do {																	\
+	pglz_out_ctrl(_ctrlp,_ctrlb,_ctrl,_buf);							\
+	*(_buf)++ = (unsigned char)(_byte);									\
+	_ctrl <<= 1;														\
+} while (0)
+
+/* Outputs a backward reference tag of 2-4 bytes */
+#define pglz_out_tag(_ctrlp,_ctrlb,_ctrl,_buf,_len,_off)				\
+do {																	\
+	pglz_out_ctrl(_ctrlp,_ctrlb,_ctrl,_buf);							\
+	_ctrlb |= _ctrl;													\
+	_ctrl <<= 1;														\
+	if (_len > 17)														\
+	{																	\
+		(_buf)[0] = (unsigned char)((((_off) & 0xf00) >> 4) | 0x0f);	\
+		(_buf)[1] = (unsigned char)(((_off) & 0xff));					\
+		(_buf)[2] = (unsigned char)((_len) - 18);						\
+		(_buf) += 3;													\
+	} else {															\
+		(_buf)[0] = (unsigned char)((((_off) & 0xf00) >> 4) | ((_len) - 3)); \
+		(_buf)[1] = (unsigned char)((_off) & 0xff);						\
+		(_buf) += 2;													\
+	}																	\
+} while (0)
+
+/*
+ * Lookup the history table if the actual input stream matches another
+ * sequence of characters, starting somewhere earlier in the input buffer.
+ */
+static inline int
+pglz_find_match(PGLZ_State *state, const char *input, const char *end,
+				int *lenp, int *offp, int good_match, int good_drop, int mask)
+{
+	PGLZ_HistEntry *hent;
+	int16		hentno;
+	int32		len = 0;
+	int32		off = 0;
+
+	/* Traverse the linked history list until a good enough match is found */
+	hentno = state->hist_start[pglz_hist_idx(input, end, mask)];
+	hent = &state->hist_entries[hentno];
+	while (hent != &state->hist_entries[PGLZ_INVALID_ENTRY])
+	{
+		const char *ip = input;
+		const char *hp = hent->pos;
+		int32		thisoff;
+		int32		thislen;
+
+		/* Stop if the offset does not fit into our tag anymore */
+		thisoff = ip - hp;
+		if (thisoff >= 0x0fff)
+			break;
+
+		/* Determine length of match */
+		thislen = 0;
+		if (len >= 16)
+		{
+			if (memcmp(ip, hp, len) == 0)
+			{
+				thislen = len;
+				ip += len;
+				hp += len;
+				while (ip < end && *ip == *hp && thislen < PGLZ_MAX_MATCH)
+				{
+					thislen++;
+					ip++;
+					hp++;
+				}
+			}
+		}
+		else
+		{
+			while (ip < end && *ip == *hp && thislen < PGLZ_MAX_MATCH)
+			{
+				thislen++;
+				ip++;
+				hp++;
+			}
+		}
+
+		/* Remember this match as the best (if it is) */
+		if (thislen > len)
+		{
+			len = thislen;
+			off = thisoff;
+		}
+
+		/* Advance to the next history entry */
+		hent = hent->next;
+
+		/* Stop if good enough match, otherwise lower good_match */
+		if (hent != &state->hist_entries[PGLZ_INVALID_ENTRY])
+		{
+			if (len >= good_match)
+				break;
+			good_match -= (good_match * good_drop) / 100;
+		}
+	}
+
+	/*
+	 * Return match information only if it results at least in one byte
+	 * reduction.
+	 */
+	if (len > 2)
+	{
+		*lenp = len;
+		*offp = off;
+		return 1;
+	}
+
+	return 0;
+}
+
+/*
+ * Compresses source into dest using strategy, the same as pglz_compress().
+ * state is the scratch space of the calling thread, see pglz_state_alloc().
+ * Returns the number of bytes written in the destination buffer, or -1 if
+ * compression fails.
+ */
+int32
+pglz_compress_reentrant(const char *source, int32 slen, char *dest,
+						const PGLZ_Strategy *strategy, PGLZ_State *state)
+{
+	unsigned char *bp = (unsigned char *) dest;
+	unsigned char *bstart = bp;
+	int			hist_next = 1;
+	bool		hist_recycle = false;
+	const char *dp = source;
+	const char *dend = source + slen;
+	unsigned char ctrl_dummy = 0;
+	unsigned char *ctrlp = &ctrl_dummy;
+	unsigned char ctrlb = 0;
+	unsigned char ctrl = 0;
+	bool		found_match = false;
+	int32		match_len;
+	int32		match_off;
+	int32		good_match;
+	int32		good_drop;
+	int32		result_size;
+	int32		result_max;
+	int32		need_rate;
+	int			hashsz;
+	int			mask;
+
+	/* Our fallback strategy is the default */
+	if (strategy == NULL)
+		strategy = PGLZ_strategy_default;
+
+	/*
+	 * If the strategy forbids compression (at all or if source chunk size
+	 * out of range), fail.
+	 */
+	if (strategy->match_size_good <= 0 ||
+		slen < strategy->min_input_size ||
+		slen > strategy->max_input_size)
+		return -1;
+
+	/* Limit the match parameters to the supported range */
+	good_match = strategy->match_size_good;
+	if (good_match > PGLZ_MAX_MATCH)
+		good_match = PGLZ_MAX_MATCH;
+	else if (good_match < 17)
+		good_match = 17;
+
+	good_drop = strategy->match_size_drop;
+	if (good_drop < 0)
+		good_drop = 0;
+	else if (good_drop > 100)
+		good_drop = 100;
+
+	need_rate = strategy->min_comp_rate;
+	if (need_rate < 0)
+		need_rate = 0;
+	else if (need_rate > 99)
+		need_rate = 99;
+
+	/* Compute the maximum result size allowed by the strategy */
+	if (slen > (INT_MAX / 100))
+		result_max = (slen / 100) * (100 - need_rate);
+	else
+		result_max = (slen * (100 - need_rate)) / 100;
+
+	/* Experiments suggest that these hash sizes work pretty well */
+	if (slen < 128)
+		hashsz = 512;
+	else if (slen < 256)
+		hashsz = 1024;
+	else if (slen < 512)
+		hashsz = 2048;
+	else if (slen < 1024)
+		hashsz = 4096;
+	else
+		hashsz = 8192;
+	mask = hashsz - 1;
+
+	/* Initialize the history lists to empty */
+	memset(state->hist_start, 0, hashsz * sizeof(int16));
+
+	/* Compress the source directly into the output buffer */
+	while (dp < dend)
+	{
+		/* If we already exceeded the maximum result size, fail */
+		if (bp - bstart >= result_max)
+			return -1;
+
+		/*
+		 * If we've emitted more than first_success_by bytes without finding
+		 * anything compressible at all, fail.
+		 */
+		if (!found_match && bp - bstart >= strategy->first_success_by)
+			return -1;
+
+		/* Try to find a match in the history */
+		if (pglz_find_match(state, dp, dend, &match_len,
+							&match_off, good_match, good_drop, mask))
+		{
+			/*
+			 * Create the tag and add history entries for all matched
+			 * characters.
+			 */
+			pglz_out_tag(ctrlp, ctrlb, ctrl, bp, match_len, match_off);
+			while (match_len--)
+			{
+				pglz_hist_add(state->hist_start, state->hist_entries,
+							  hist_next, hist_recycle,
+							  dp, dend, mask);
+				dp++;			/* Do not do this ++ in the line above! */
+			}
+			found_match = true;
+		}
+		else
+		{
+			/* No match found. Copy one literal byte */
+			pglz_out_literal(ctrlp, ctrlb, ctrl, bp, *dp);
+			pglz_hist_add(state->hist_start, state->hist_entries,
+						  hist_next, hist_recycle,
+						  dp, dend, mask);
+			dp++;				/* Do not do this ++ in the line above! */
+		}
+	}
+
+	/*
+	 * Write out the last control byte and check that we haven't overrun the
+	 * output size allowed by the strategy.
+	 */
+	*ctrlp = ctrlb;
+	result_size = bp - bstart;
+	if (result_size >= result_max)
+		return -1;
+
+	/* success */
+	return result_size;
+}
+
+/*
+ * Allocate scratch space for pglz_compress_reentrant(). It is about 150kB,
+ * so it is not put on the stack of the thread.
+ */
+PGLZ_State *
+pglz_state_alloc(void)
+{
+	return pgut_new(PGLZ_State);
+}
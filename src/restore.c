@@ -29,12 +29,30 @@ typedef struct
 	int			ret;
 } restore_files_arg;
 
+typedef struct
+{
+	parray	   *files;			/* files of the destination backup */
+	parray	   *chain;			/* backups from FULL to the destination one */
+	parray	  **chain_files;	/* files of every backup of the chain */
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} restore_chain_arg;
+
+static void check_backup_restorable(pgBackup *backup);
 static void restore_backup(pgBackup *backup);
+static void restore_chain(parray *chain);
 static void create_recovery_conf(time_t backup_id,
 								 pgRecoveryTarget *rt,
 								 pgBackup *backup);
 static parray *read_timeline_history(TimeLineID targetTLI);
 static void *restore_files(void *arg);
+static void *restore_chain_files(void *arg);
+static bool file_is_unchanged(const char *rel_path, pgFile *file,
+							  pgBackup *backup);
 static void remove_deleted_files(pgBackup *backup);
 
 
@@ -64,8 +82,20 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 		if (instance_config.pgdata == NULL)
 			elog(ERROR,
 				"required parameter not specified: PGDATA (-D, --pgdata)");
+		if (restore_incremental)
+		{
+			char		pid_file[MAXPGPATH];
+
+			/* Existing files are going to be overwritten */
+			join_path_components(pid_file, instance_config.pgdata,
+								 "postmaster.pid");
+			if (fileExists(pid_file))
+				elog(ERROR, "postmaster.pid is found in restore destination \"%s\", "
+					 "the server must be stopped for incremental restore",
+					 instance_config.pgdata);
+		}
 		/* Check if restore destination empty */
-		if (!dir_is_empty(instance_config.pgdata))
+		else if (!dir_is_empty(instance_config.pgdata))
 			elog(ERROR, "restore destination is not empty: \"%s\"",
 				 instance_config.pgdata);
 	}
@@ -281,7 +311,7 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 	 * i.e. empty or not exist.
 	 */
 	if (is_restore)
-		check_tablespace_mapping(dest_backup);
+		check_tablespace_mapping(dest_backup, restore_incremental);
 
 	/* At this point we are sure that parent chain is whole
 	 * so we can build separate array, containing all needed backups,
@@ -426,15 +456,23 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 			 */
 			if (rt->restore_no_validate && !lock_backup(backup))
 				elog(ERROR, "Cannot lock backup directory");
-
-			restore_backup(backup);
 		}
 
+		/*
+		 * Incremental backup is restored from the whole chain at once, so
+		 * every file is written only once. Incremental restore compares
+		 * existing files with the chain in the same way.
+		 */
+		if (parray_num(parent_chain) > 1 || restore_incremental)
+			restore_chain(parent_chain);
+		else
+			restore_backup(dest_backup);
+
 		/*
 		 * Delete files which are not in dest backup file list. Files which were
 		 * deleted between previous and current backup are not in the list.
 		 */
-		if (dest_backup->backup_mode != BACKUP_MODE_FULL)
+		if (dest_backup->backup_mode != BACKUP_MODE_FULL || restore_incremental)
 			remove_deleted_files(dest_backup);
 
 		/* Create recovery.conf with given recovery target parameters */
@@ -451,6 +489,27 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 	return 0;
 }
 
+/*
+ * Check that the backup is valid and compatible with the binary.
+ */
+static void
+check_backup_restorable(pgBackup *backup)
+{
+	if (backup->status != BACKUP_STATUS_OK)
+		elog(ERROR, "Backup %s cannot be restored because it is not valid",
+			 base36enc(backup->start_time));
+
+	/* confirm block size compatibility */
+	if (backup->block_size != BLCKSZ)
+		elog(ERROR,
+			"BLCKSZ(%d) is not compatible(%d expected)",
+			backup->block_size, BLCKSZ);
+	if (backup->wal_block_size != XLOG_BLCKSZ)
+		elog(ERROR,
+			"XLOG_BLCKSZ(%d) is not compatible(%d expected)",
+			backup->wal_block_size, XLOG_BLCKSZ);
+}
+
 /*
  * Restore one backup.
  */
@@ -468,19 +527,7 @@ restore_backup(pgBackup *backup)
 	restore_files_arg *threads_args;
 	bool		restore_isok = true;
 
-	if (backup->status != BACKUP_STATUS_OK)
-		elog(ERROR, "Backup %s cannot be restored because it is not valid",
-			 base36enc(backup->start_time));
-
-	/* confirm block size compatibility */
-	if (backup->block_size != BLCKSZ)
-		elog(ERROR,
-			"BLCKSZ(%d) is not compatible(%d expected)",
-			backup->block_size, BLCKSZ);
-	if (backup->wal_block_size != XLOG_BLCKSZ)
-		elog(ERROR,
-			"XLOG_BLCKSZ(%d) is not compatible(%d expected)",
-			backup->wal_block_size, XLOG_BLCKSZ);
+	check_backup_restorable(backup);
 
 	time2iso(timestamp, lengthof(timestamp), backup->start_time);
 	elog(LOG, "restoring database from backup %s", timestamp);
@@ -548,6 +595,112 @@ restore_backup(pgBackup *backup)
 		elog(LOG, "restore %s backup completed", base36enc(backup->start_time));
 }
 
+/*
+ * Restore the chain of backups from FULL backup to the destination one.
+ *
+ * File lists of all backups are read at first. Then every file of the
+ * destination backup is restored once: data files block by block from the
+ * backups holding the newest copy of each block, other files from the newest
+ * backup, which contains them.
+ *
+ * In case of incremental restore files of $PGDATA are compared with the chain
+ * and only differing files and blocks are rewritten.
+ */
+static void
+restore_chain(parray *chain)
+{
+	pgBackup   *dest_backup = (pgBackup *) parray_get(chain, parray_num(chain) - 1);
+	char		timestamp[100];
+	char		this_backup_path[MAXPGPATH];
+	parray	  **chain_files;
+	parray	   *files;
+	int			i;
+	/* arrays with meta info for multi threaded backup */
+	pthread_t  *threads;
+	restore_chain_arg *threads_args;
+	bool		restore_isok = true;
+
+	chain_files = (parray **) palloc(sizeof(parray *) * parray_num(chain));
+
+	for (i = 0; i < parray_num(chain); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(chain, i);
+		char		database_path[MAXPGPATH];
+		char		list_path[MAXPGPATH];
+
+		check_backup_restorable(backup);
+
+		pgBackupGetPath(backup, database_path, lengthof(database_path), DATABASE_DIR);
+		pgBackupGetPath(backup, list_path, lengthof(list_path), DATABASE_FILE_LIST);
+		chain_files[i] = dir_read_file_list(database_path, list_path);
+		/* Sort to find files of the destination backup by path */
+		parray_qsort(chain_files[i], pgFileComparePath);
+	}
+
+	time2iso(timestamp, lengthof(timestamp), dest_backup->start_time);
+	elog(LOG, "restoring database from backup %s and its %lu parents",
+		 timestamp, (unsigned long) parray_num(chain) - 1);
+
+	/*
+	 * Restore backup directories.
+	 * this_backup_path = $BACKUP_PATH/backups/instance_name/backup_id
+	 */
+	pgBackupGetPath(dest_backup, this_backup_path, lengthof(this_backup_path), NULL);
+	create_data_directories(instance_config.pgdata, this_backup_path, true);
+
+	files = chain_files[parray_num(chain) - 1];
+
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
+	threads_args = (restore_chain_arg *) palloc(sizeof(restore_chain_arg)*num_threads);
+
+	/* setup threads */
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+
+		pg_atomic_clear_flag(&file->lock);
+	}
+
+	/* Restore files into target directory */
+	for (i = 0; i < num_threads; i++)
+	{
+		restore_chain_arg *arg = &(threads_args[i]);
+
+		arg->files = files;
+		arg->chain = chain;
+		arg->chain_files = chain_files;
+		/* By default there are some error */
+		threads_args[i].ret = 1;
+
+		pthread_create(&threads[i], NULL, restore_chain_files, arg);
+	}
+
+	/* Wait theads */
+	for (i = 0; i < num_threads; i++)
+	{
+		pthread_join(threads[i], NULL);
+		if (threads_args[i].ret == 1)
+			restore_isok = false;
+	}
+	if (!restore_isok)
+		elog(ERROR, "Data files restoring failed");
+
+	pfree(threads);
+	pfree(threads_args);
+
+	/* cleanup */
+	for (i = 0; i < parray_num(chain); i++)
+	{
+		parray_walk(chain_files[i], pgFileFree);
+		parray_free(chain_files[i]);
+	}
+	pfree(chain_files);
+
+	if (logger_config.log_level_console <= LOG ||
+		logger_config.log_level_file <= LOG)
+		elog(LOG, "restore %s backup completed", base36enc(dest_backup->start_time));
+}
+
 /*
  * Delete files which are not in backup's file list from target pgdata.
  * It is necessary to restore incremental backup correctly.
@@ -567,9 +720,14 @@ remove_deleted_files(pgBackup *backup)
 	files = dir_read_file_list(instance_config.pgdata, filelist_path);
 	parray_qsort(files, pgFileComparePathDesc);
 
-	/* Get list of files actually existing in target database */
+	/*
+	 * Get list of files actually existing in target database. After
+	 * incremental restore excluded files like WAL segments of the old cluster
+	 * have to be deleted too.
+	 */
 	files_restored = parray_new();
-	dir_list_file(files_restored, instance_config.pgdata, true, true, false);
+	dir_list_file(files_restored, instance_config.pgdata, !restore_incremental,
+				  true, false);
 	/* To delete from leaf, sort in reversed order */
 	parray_qsort(files_restored, pgFileComparePathDesc);
 
@@ -690,6 +848,163 @@ restore_files(void *arg)
 	return NULL;
 }
 
+/*
+ * Check that the file in $PGDATA has the same size and CRC as its copy in
+ * the backup, so incremental restore can leave it alone.
+ */
+static bool
+file_is_unchanged(const char *rel_path, pgFile *file, pgBackup *backup)
+{
+	char		to_path[MAXPGPATH];
+	struct stat	st;
+	uint32		backup_version = parse_program_version(backup->program_version);
+
+	join_path_components(to_path, instance_config.pgdata, rel_path);
+	if (stat(to_path, &st) == -1 || !S_ISREG(st.st_mode) ||
+		st.st_size != file->write_size)
+		return false;
+
+	if (pgFileGetCRC(to_path, BACKUP_USES_CRC32C(backup_version), false,
+					 NULL) != file->crc)
+		return false;
+
+	if (chmod(to_path, file->mode) == -1)
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno));
+
+	return true;
+}
+
+/*
+ * Restore files of the destination backup of the chain into $PGDATA.
+ */
+static void *
+restore_chain_files(void *arg)
+{
+	int			i;
+	restore_chain_arg *arguments = (restore_chain_arg *) arg;
+	int			nbackups = parray_num(arguments->chain);
+	pgBackup   *dest_backup = (pgBackup *) parray_get(arguments->chain,
+													  nbackups - 1);
+	char		dest_root[MAXPGPATH];
+	pgFile	  **files;
+
+	pgBackupGetPath(dest_backup, dest_root, lengthof(dest_root), DATABASE_DIR);
+	files = (pgFile **) palloc(sizeof(pgFile *) * nbackups);
+
+	for (i = 0; i < parray_num(arguments->files); i++)
+	{
+		char	   *rel_path;
+		pgFile	   *file = (pgFile *) parray_get(arguments->files, i);
+		int			j;
+
+		if (!pg_atomic_test_set_flag(&file->lock))
+			continue;
+
+		/* check for interrupt */
+		if (interrupted)
+			elog(ERROR, "interrupted during restore database");
+
+		rel_path = GetRelativePath(file->path, dest_root);
+
+		if (progress)
+			elog(INFO, "Progress: (%d/%lu). Process file %s ",
+				 i + 1, (unsigned long) parray_num(arguments->files), rel_path);
+
+		/* Directories were created before */
+		if (S_ISDIR(file->mode))
+		{
+			elog(VERBOSE, "directory, skip");
+			continue;
+		}
+
+		/* Do not restore tablespace_map file */
+		if (path_is_prefix_of_path(PG_TABLESPACE_MAP_FILE, rel_path))
+		{
+			elog(VERBOSE, "skip tablespace_map");
+			continue;
+		}
+
+		/* Find the file in every backup of the chain */
+		for (j = 0; j < nbackups - 1; j++)
+		{
+			pgBackup   *backup = (pgBackup *) parray_get(arguments->chain, j);
+			char		from_root[MAXPGPATH];
+			char		path[MAXPGPATH];
+			pgFile		key;
+			pgFile	  **found;
+
+			pgBackupGetPath(backup, from_root, lengthof(from_root), DATABASE_DIR);
+			join_path_components(path, from_root, rel_path);
+			key.path = path;
+			found = (pgFile **) parray_bsearch(arguments->chain_files[j], &key,
+											   pgFileComparePath);
+			files[j] = found ? *found : NULL;
+		}
+		files[nbackups - 1] = file;
+
+		elog(VERBOSE, "Restoring file %s, is_datafile %i, is_cfs %i",
+			 file->path, file->is_datafile?1:0, file->is_cfs?1:0);
+		if (file->is_datafile && !file->is_cfs)
+		{
+			char		to_path[MAXPGPATH];
+
+			join_path_components(to_path, instance_config.pgdata, rel_path);
+			restore_data_file_chain(to_path, files, arguments->chain,
+									restore_incremental);
+		}
+		else
+		{
+			char		from_root[MAXPGPATH];
+
+			/*
+			 * Other files are copied as a whole, take the newest copy.
+			 * Unchanged files were not backed up.
+			 */
+			for (j = nbackups - 1; j >= 0; j--)
+			{
+				if (files[j] != NULL &&
+					files[j]->write_size != BYTES_INVALID &&
+					files[j]->write_size != FILE_NOT_FOUND)
+					break;
+			}
+			if (j < 0)
+			{
+				elog(VERBOSE, "The file is not found in backups. Skip restore: %s",
+					 file->path);
+				continue;
+			}
+
+			pgBackupGetPath((pgBackup *) parray_get(arguments->chain, j),
+							from_root, lengthof(from_root), DATABASE_DIR);
+			if (restore_incremental &&
+				strcmp(file->name, "pg_control") != 0 &&
+				file_is_unchanged(rel_path, files[j],
+								  (pgBackup *) parray_get(arguments->chain, j)))
+			{
+				elog(VERBOSE, "The file is the same. Skip restore: %s",
+					 file->path);
+				continue;
+			}
+
+			if (strcmp(file->name, "pg_control") == 0)
+				copy_pgcontrol_file(from_root, instance_config.pgdata, files[j]);
+			else
+				copy_file(from_root, instance_config.pgdata, files[j]);
+
+			elog(VERBOSE, "Restored file %s : " INT64_FORMAT " bytes",
+				 files[j]->path, files[j]->write_size);
+		}
+	}
+
+	pfree(files);
+
+	/* Data files restoring is successful */
+	arguments->ret = 0;
+
+	return NULL;
+}
+
 /* Create recovery.conf with given recovery target parameters */
 static void
 create_recovery_conf(time_t backup_id,
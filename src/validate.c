@@ -15,21 +15,44 @@
 
 #include "utils/thread.h"
 
-static void *pgBackupValidateFiles(void *arg);
-static void do_validate_instance(void);
-
-static bool corrupted_backup_found = false;
-static bool skipped_due_to_lock = false;
-
+/* Files of a single backup in the validation queue */
 typedef struct
 {
-	const char *base_path;
+	pgBackup   *backup;
+	char		base_path[MAXPGPATH];
+	char		control_path[MAXPGPATH];
+	char		state_path[MAXPGPATH];
 	parray	   *files;
-	bool		corrupted;
 	XLogRecPtr	stop_lsn;
 	uint32		checksum_version;
 	uint32		backup_version;
 
+	/* Fingerprint of backup files, see backup_files_fingerprint() */
+	bool		fingerprint_isok;
+	pg_crc32	fingerprint;
+	/* Files are not changed since the last validation, nothing to check */
+	bool		unchanged;
+
+	/* Protected by validate_mutex */
+	int			files_left;
+	bool		corrupted;
+
+	/* Status written by validate_backup_files() */
+	BackupStatus status;
+} validate_backup_job;
+
+/* Entry of the validation queue */
+typedef struct
+{
+	pgFile	   *file;
+	validate_backup_job *job;
+} validate_queue_item;
+
+typedef struct
+{
+	/* validate_queue_item, largest files first */
+	parray	   *queue;
+
 	/*
 	 * Return value from the thread.
 	 * 0 means there is no error, 1 - there is an error.
@@ -37,21 +60,62 @@ typedef struct
 	int			ret;
 } validate_files_arg;
 
+/* Instance of the catalog and its backups, see do_validate_all() */
+typedef struct
+{
+	char	   *name;
+	parray	   *backups;
+} validate_instance_arg;
+
+static validate_backup_job *validate_backup_start(pgBackup *backup);
+static void validate_backup_files(parray *jobs);
+static bool validate_backup_finish(validate_backup_job *job);
+static void *pgBackupValidateFiles(void *arg);
+static bool pgBackupValidateFile(pgFile *file, validate_backup_job *job);
+static bool backup_files_fingerprint(validate_backup_job *job,
+									 pg_crc32 *fingerprint, time_t *max_mtime);
+static bool validation_state_matches(validate_backup_job *job, time_t max_mtime);
+static void write_validation_state(validate_backup_job *job);
+static void init_validate_instance(const char *name);
+static void prevalidate_instance(parray *backups, parray *jobs);
+static bool lock_and_validate(pgBackup *backup, parray *jobs);
+static void do_validate_instance(parray *backups, parray *jobs);
+
+static bool corrupted_backup_found = false;
+static bool skipped_due_to_lock = false;
+
+static pthread_mutex_t validate_mutex = PTHREAD_MUTEX_INITIALIZER;
+
 /*
  * Validate backup files.
  */
 void
 pgBackupValidate(pgBackup *backup)
 {
-	char		base_path[MAXPGPATH];
-	char		path[MAXPGPATH];
-	parray	   *files;
-	bool		corrupted = false;
-	bool		validation_isok = true;
-	/* arrays with meta info for multi threaded validate */
-	pthread_t  *threads;
-	validate_files_arg *threads_args;
-	int			i;
+	validate_backup_job *job;
+	parray	   *jobs;
+
+	job = validate_backup_start(backup);
+	if (job == NULL)
+		return;
+
+	jobs = parray_new();
+	parray_append(jobs, job);
+	validate_backup_files(jobs);
+	backup->status = job->status;
+
+	pfree(job);
+	parray_free(jobs);
+}
+
+/*
+ * Check that the backup can be validated and read its file list.
+ * Returns NULL if the backup is skipped.
+ */
+static validate_backup_job *
+validate_backup_start(pgBackup *backup)
+{
+	validate_backup_job *job;
 
 	/* Check backup version */
 	if (parse_program_version(backup->program_version) > parse_program_version(PROGRAM_VERSION))
@@ -66,7 +130,7 @@ pgBackupValidate(pgBackup *backup)
 			 base36enc(backup->start_time), status2str(backup->status));
 		write_backup_status(backup, BACKUP_STATUS_ERROR);
 		corrupted_backup_found = true;
-		return;
+		return NULL;
 	}
 
 	/* Revalidation is attempted for DONE, ORPHAN and CORRUPT backups */
@@ -78,7 +142,7 @@ pgBackupValidate(pgBackup *backup)
 		elog(WARNING, "Backup %s has status %s. Skip validation.",
 					base36enc(backup->start_time), status2str(backup->status));
 		corrupted_backup_found = true;
-		return;
+		return NULL;
 	}
 
 	if (backup->status == BACKUP_STATUS_OK || backup->status == BACKUP_STATUS_DONE)
@@ -98,18 +162,285 @@ pgBackupValidate(pgBackup *backup)
 		backup->backup_mode != BACKUP_MODE_DIFF_DELTA)
 		elog(WARNING, "Invalid backup_mode of backup %s", base36enc(backup->start_time));
 
-	pgBackupGetPath(backup, base_path, lengthof(base_path), DATABASE_DIR);
-	pgBackupGetPath(backup, path, lengthof(path), DATABASE_FILE_LIST);
-	files = dir_read_file_list(base_path, path);
+	job = pgut_new(validate_backup_job);
+	job->backup = backup;
+	pgBackupGetPath(backup, job->base_path, lengthof(job->base_path),
+					DATABASE_DIR);
+	pgBackupGetPath(backup, job->control_path, lengthof(job->control_path),
+					BACKUP_CONTROL_FILE);
+	pgBackupGetPath(backup, job->state_path, lengthof(job->state_path),
+					BACKUP_VALIDATION_FILE);
+	job->stop_lsn = backup->stop_lsn;
+	job->checksum_version = backup->checksum_version;
+	job->backup_version = parse_program_version(backup->program_version);
+	job->files_left = 0;
+	job->corrupted = false;
+	job->status = backup->status;
+
+	{
+		char		path[MAXPGPATH];
+		time_t		max_mtime;
+
+		pgBackupGetPath(backup, path, lengthof(path), DATABASE_FILE_LIST);
+		job->files = dir_read_file_list(job->base_path, path);
+
+		job->fingerprint_isok = backup_files_fingerprint(job,
+														 &job->fingerprint,
+														 &max_mtime);
+		job->unchanged = !force_validation &&
+			backup->status == BACKUP_STATUS_OK &&
+			job->fingerprint_isok &&
+			validation_state_matches(job, max_mtime);
+	}
+
+	return job;
+}
+
+/*
+ * Compute fingerprint of the backup files: CRC of sizes, modification times
+ * and inode numbers of the file list and of all regular files in it. Also
+ * return the latest modification time. Returns false if some file cannot be
+ * stat'ed, validation will complain about it.
+ */
+static bool
+backup_files_fingerprint(validate_backup_job *job, pg_crc32 *fingerprint,
+						 time_t *max_mtime)
+{
+	char		list_path[MAXPGPATH];
+	int			i;
+
+	INIT_CRC32C(*fingerprint);
+	*max_mtime = 0;
 
-	/* setup threads */
-	for (i = 0; i < parray_num(files); i++)
+	pgBackupGetPath(job->backup, list_path, lengthof(list_path),
+					DATABASE_FILE_LIST);
+
+	/* The file list goes first, then files from it */
+	for (i = -1; i < (int) parray_num(job->files); i++)
 	{
-		pgFile	   *file = (pgFile *) parray_get(files, i);
-		pg_atomic_clear_flag(&file->lock);
+		const char *path = list_path;
+		struct stat	st;
+
+		if (i >= 0)
+		{
+			pgFile	   *file = (pgFile *) parray_get(job->files, i);
+
+			if (!S_ISREG(file->mode) || file->write_size == BYTES_INVALID)
+				continue;
+			path = file->path;
+		}
+
+		if (stat(path, &st) == -1)
+			return false;
+
+		COMP_CRC32C(*fingerprint, &st.st_size, sizeof(st.st_size));
+		COMP_CRC32C(*fingerprint, &st.st_mtime, sizeof(st.st_mtime));
+		COMP_CRC32C(*fingerprint, &st.st_ino, sizeof(st.st_ino));
+		*max_mtime = Max(*max_mtime, st.st_mtime);
 	}
 
-	/* init thread args with own file lists */
+	FIN_CRC32C(*fingerprint);
+	return true;
+}
+
+/*
+ * Check that the backup was successfully validated before and its files
+ * are not changed since then.
+ */
+static bool
+validation_state_matches(validate_backup_job *job, time_t max_mtime)
+{
+	time_t		validation_time = 0;
+	char	   *program_version = NULL;
+	bool		block_validation = false;
+	uint32		file_count = 0;
+	uint32		fingerprint = 0;
+	bool		result;
+
+	ConfigOption options[] =
+	{
+		{'t', 0, "validation-time",		&validation_time, SOURCE_FILE_STRICT},
+		{'s', 0, "program-version",		&program_version, SOURCE_FILE_STRICT},
+		{'b', 0, "block-validation",	&block_validation, SOURCE_FILE_STRICT},
+		{'u', 0, "file-count",			&file_count, SOURCE_FILE_STRICT},
+		{'u', 0, "fingerprint",			&fingerprint, SOURCE_FILE_STRICT},
+		{0}
+	};
+
+	if (config_read_opt(job->state_path, options, WARNING, true) == 0)
+		return false;
+
+	/*
+	 * Modification time has a granularity of one second, a file modified
+	 * within the same second as validation might be changed after it.
+	 */
+	result = program_version != NULL &&
+		strcmp(program_version, PROGRAM_VERSION) == 0 &&
+		(block_validation || skip_block_validation) &&
+		file_count == parray_num(job->files) &&
+		fingerprint == job->fingerprint &&
+		max_mtime < validation_time;
+
+	if (result)
+	{
+		char		timestamp[100];
+
+		time2iso(timestamp, lengthof(timestamp), validation_time);
+		elog(INFO, "Backup %s data files are valid, not changed since validation at %s",
+			 base36enc(job->backup->start_time), timestamp);
+	}
+
+	free(program_version);
+	return result;
+}
+
+/*
+ * Remember successful validation of the backup files, so that next commands
+ * do not check them again until they are changed. Called with
+ * validate_mutex held, errors are not fatal.
+ */
+static void
+write_validation_state(validate_backup_job *job)
+{
+	char		path_temp[MAXPGPATH];
+	char		timestamp[100];
+	FILE	   *fp;
+
+	snprintf(path_temp, sizeof(path_temp), "%s.partial", job->state_path);
+
+	fp = fopen(path_temp, "wt");
+	if (fp == NULL)
+	{
+		elog(WARNING, "Cannot open validation state file \"%s\": %s",
+			 path_temp, strerror(errno));
+		return;
+	}
+
+	time2iso(timestamp, lengthof(timestamp), time(NULL));
+	fprintf(fp, "#Validation\n");
+	fprintf(fp, "validation-time = '%s'\n", timestamp);
+	fprintf(fp, "program-version = %s\n", PROGRAM_VERSION);
+	fprintf(fp, "block-validation = %s\n",
+			skip_block_validation ? "false" : "true");
+	fprintf(fp, "file-count = %lu\n", (unsigned long) parray_num(job->files));
+	fprintf(fp, "fingerprint = %u\n", (uint32) job->fingerprint);
+
+	if (fflush(fp) != 0 ||
+		fsync(fileno(fp)) != 0 ||
+		fclose(fp))
+	{
+		elog(WARNING, "Cannot write validation state file \"%s\": %s",
+			 path_temp, strerror(errno));
+		unlink(path_temp);
+		return;
+	}
+
+	if (rename(path_temp, job->state_path) < 0)
+	{
+		elog(WARNING, "Cannot rename validation state file \"%s\" to \"%s\": %s",
+			 path_temp, job->state_path, strerror(errno));
+		unlink(path_temp);
+	}
+}
+
+/*
+ * Forget the result of the last validation of the backup, its files are
+ * going to be changed.
+ */
+void
+remove_backup_validation_state(pgBackup *backup)
+{
+	char		path[MAXPGPATH];
+
+	pgBackupGetPath(backup, path, lengthof(path), BACKUP_VALIDATION_FILE);
+	if (unlink(path) != 0 && errno != ENOENT)
+		elog(ERROR, "Cannot remove validation state file \"%s\": %s",
+			 path, strerror(errno));
+}
+
+static int
+validate_queue_compare_size_desc(const void *a, const void *b)
+{
+	validate_queue_item *item1 = *(validate_queue_item **) a;
+	validate_queue_item *item2 = *(validate_queue_item **) b;
+
+	if (item1->file->write_size > item2->file->write_size)
+		return -1;
+	else if (item1->file->write_size < item2->file->write_size)
+		return 1;
+	return 0;
+}
+
+/*
+ * Validate files of the backups in "jobs" by num_threads threads.
+ *
+ * Files of all backups are put into one queue, largest files first, so that
+ * threads are busy until the very end instead of waiting for the last file of
+ * every backup. Status of a backup is written as soon as all its files are
+ * checked and is saved in job->status, backups in memory are not changed.
+ * File lists of the jobs are freed.
+ */
+static void
+validate_backup_files(parray *jobs)
+{
+	parray	   *queue = parray_new();
+	/* arrays with meta info for multi threaded validate */
+	pthread_t  *threads;
+	validate_files_arg *threads_args;
+	bool		validation_isok = true;
+	int			i;
+	int			j;
+
+	for (i = 0; i < parray_num(jobs); i++)
+	{
+		validate_backup_job *job = (validate_backup_job *) parray_get(jobs, i);
+
+		if (job->unchanged)
+		{
+			job->status = BACKUP_STATUS_OK;
+			continue;
+		}
+
+		for (j = 0; j < parray_num(job->files); j++)
+		{
+			pgFile	   *file = (pgFile *) parray_get(job->files, j);
+			validate_queue_item *item;
+
+			/* Validate only regular files */
+			if (!S_ISREG(file->mode))
+				continue;
+			/*
+			 * Skip files which has no data, because they
+			 * haven't changed between backups.
+			 */
+			if (file->write_size == BYTES_INVALID)
+				continue;
+
+			/*
+			 * Currently we don't compute checksums for
+			 * cfs_compressed data files, so skip them.
+			 */
+			if (file->is_cfs)
+				continue;
+
+			pg_atomic_clear_flag(&file->lock);
+
+			item = pgut_new(validate_queue_item);
+			item->file = file;
+			item->job = job;
+			parray_append(queue, item);
+			job->files_left++;
+		}
+
+		/* Nothing to check in this backup, threads will not see it */
+		if (job->files_left == 0 && !validate_backup_finish(job))
+			elog(ERROR, "Cannot update status of backup %s",
+				 base36enc(job->backup->start_time));
+	}
+
+	parray_qsort(queue, validate_queue_compare_size_desc);
+
+	/* init thread args with the shared queue */
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	threads_args = (validate_files_arg *)
 		palloc(sizeof(validate_files_arg) * num_threads);
@@ -119,12 +450,7 @@ pgBackupValidate(pgBackup *backup)
 	{
 		validate_files_arg *arg = &(threads_args[i]);
 
-		arg->base_path = base_path;
-		arg->files = files;
-		arg->corrupted = false;
-		arg->stop_lsn = backup->stop_lsn;
-		arg->checksum_version = backup->checksum_version;
-		arg->backup_version = parse_program_version(backup->program_version);
+		arg->queue = queue;
 		/* By default there are some error */
 		threads_args[i].ret = 1;
 
@@ -137,8 +463,6 @@ pgBackupValidate(pgBackup *backup)
 		validate_files_arg *arg = &(threads_args[i]);
 
 		pthread_join(threads[i], NULL);
-		if (arg->corrupted)
-			corrupted = true;
 		if (arg->ret == 1)
 			validation_isok = false;
 	}
@@ -149,23 +473,54 @@ pgBackupValidate(pgBackup *backup)
 	pfree(threads_args);
 
 	/* cleanup */
-	parray_walk(files, pgFileFree);
-	parray_free(files);
+	parray_walk(queue, pfree);
+	parray_free(queue);
+	for (i = 0; i < parray_num(jobs); i++)
+	{
+		validate_backup_job *job = (validate_backup_job *) parray_get(jobs, i);
+
+		parray_walk(job->files, pgFileFree);
+		parray_free(job->files);
+		job->files = NULL;
+	}
+}
+
+/*
+ * All files of the backup are checked, update its status.
+ * Called by the thread which has checked the last file, with validate_mutex
+ * held, so it must not throw ERROR.
+ */
+static bool
+validate_backup_finish(validate_backup_job *job)
+{
+	BackupStatus status = job->corrupted ? BACKUP_STATUS_CORRUPT :
+										   BACKUP_STATUS_OK;
 
-	/* Update backup status */
-	write_backup_status(backup, corrupted ? BACKUP_STATUS_CORRUPT :
-											BACKUP_STATUS_OK);
+	if (!write_backup_status_file(job->control_path, status))
+		return false;
+	job->status = status;
 
-	if (corrupted)
-		elog(WARNING, "Backup %s data files are corrupted", base36enc(backup->start_time));
+	if (job->corrupted)
+	{
+		if (unlink(job->state_path) != 0 && errno != ENOENT)
+			elog(WARNING, "Cannot remove validation state file \"%s\": %s",
+				 job->state_path, strerror(errno));
+	}
+	else if (job->fingerprint_isok)
+		write_validation_state(job);
+
+	if (job->corrupted)
+		elog(WARNING, "Backup %s data files are corrupted", base36enc(job->backup->start_time));
 	else
-		elog(INFO, "Backup %s data files are valid", base36enc(backup->start_time));
+		elog(INFO, "Backup %s data files are valid", base36enc(job->backup->start_time));
+
+	return true;
 }
 
 /*
- * Validate files in the backup.
+ * Validate files from the queue.
  * NOTE: If file is not valid, do not use ERROR log message,
- * rather throw a WARNING and set arguments->corrupted = true.
+ * rather throw a WARNING and set job->corrupted = true.
  * This is necessary to update backup status.
  */
 static void *
@@ -173,121 +528,142 @@ pgBackupValidateFiles(void *arg)
 {
 	int			i;
 	validate_files_arg *arguments = (validate_files_arg *)arg;
-	int			num_files = parray_num(arguments->files);
-	pg_crc32	crc;
+	int			num_files = parray_num(arguments->queue);
 
 	for (i = 0; i < num_files; i++)
 	{
-		struct stat st;
-		pgFile	   *file = (pgFile *) parray_get(arguments->files, i);
+		validate_queue_item *item =
+			(validate_queue_item *) parray_get(arguments->queue, i);
+		validate_backup_job *job = item->job;
+		bool		corrupted;
+		bool		status_isok = true;
 
-		if (!pg_atomic_test_set_flag(&file->lock))
+		if (!pg_atomic_test_set_flag(&item->file->lock))
 			continue;
 
 		if (interrupted)
 			elog(ERROR, "Interrupted during validate");
 
-		/* Validate only regular files */
-		if (!S_ISREG(file->mode))
-			continue;
-		/*
-		 * Skip files which has no data, because they
-		 * haven't changed between backups.
-		 */
-		if (file->write_size == BYTES_INVALID)
-			continue;
-
-		/*
-		 * Currently we don't compute checksums for
-		 * cfs_compressed data files, so skip them.
-		 */
-		if (file->is_cfs)
-			continue;
-
 		if (progress)
 			elog(INFO, "Progress: (%d/%d). Process file \"%s\"",
-				 i + 1, num_files, file->path);
+				 i + 1, num_files, item->file->path);
+
+		pthread_lock(&validate_mutex);
+		corrupted = job->corrupted;
+		pthread_mutex_unlock(&validate_mutex);
+
+		/* The rest of files of corrupted backup are not worth checking */
+		if (!corrupted)
+			corrupted = !pgBackupValidateFile(item->file, job);
+
+		pthread_lock(&validate_mutex);
+		if (corrupted)
+			job->corrupted = true;
+		if (--job->files_left == 0)
+			status_isok = validate_backup_finish(job);
+		pthread_mutex_unlock(&validate_mutex);
+
+		if (!status_isok)
+			elog(ERROR, "Cannot update status of backup %s",
+				 base36enc(job->backup->start_time));
+	}
 
-		if (stat(file->path, &st) == -1)
-		{
-			if (errno == ENOENT)
-				elog(WARNING, "Backup file \"%s\" is not found", file->path);
-			else
-				elog(WARNING, "Cannot stat backup file \"%s\": %s",
-					file->path, strerror(errno));
-			arguments->corrupted = true;
-			break;
-		}
+	/* Data files validation is successful */
+	arguments->ret = 0;
 
-		if (file->write_size != st.st_size)
-		{
-			elog(WARNING, "Invalid size of backup file \"%s\" : " INT64_FORMAT ". Expected %lu",
-				 file->path, file->write_size, (unsigned long) st.st_size);
-			arguments->corrupted = true;
-			break;
-		}
+	return NULL;
+}
 
+/*
+ * Validate single file of the backup. Returns false if it is corrupted.
+ */
+static bool
+pgBackupValidateFile(pgFile *file, validate_backup_job *job)
+{
+	struct stat st;
+	pg_crc32	crc;
+
+	if (stat(file->path, &st) == -1)
+	{
+		if (errno == ENOENT)
+			elog(WARNING, "Backup file \"%s\" is not found", file->path);
+		else
+			elog(WARNING, "Cannot stat backup file \"%s\": %s",
+				file->path, strerror(errno));
+		return false;
+	}
+
+	if (file->write_size != st.st_size)
+	{
+		elog(WARNING, "Invalid size of backup file \"%s\" : " INT64_FORMAT ". Expected %lu",
+			 file->path, file->write_size, (unsigned long) st.st_size);
+		return false;
+	}
+
+	/*
+	 * If option skip-block-validation is set, compute only file-level CRC for
+	 * datafiles, otherwise check them block by block.
+	 */
+	if (!file->is_datafile || skip_block_validation)
+	{
 		/*
-		 * If option skip-block-validation is set, compute only file-level CRC for
-		 * datafiles, otherwise check them block by block.
+		 * Pre 2.0.22 we use CRC-32C, but in newer version of pg_probackup we
+		 * use CRC-32.
+		 *
+		 * pg_control stores its content and checksum of the content, calculated
+		 * using CRC-32C. If we calculate checksum of the whole pg_control using
+		 * CRC-32C we get same checksum constantly. It might be because of the
+		 * CRC-32C algorithm.
+		 * To avoid this problem we need to use different algorithm, CRC-32 in
+		 * this case.
+		 *
+		 * Starting from 2.0.25 we calculate crc of pg_control differently.
 		 */
-		if (!file->is_datafile || skip_block_validation)
-		{
-			/*
-			 * Pre 2.0.22 we use CRC-32C, but in newer version of pg_probackup we
-			 * use CRC-32.
-			 *
-			 * pg_control stores its content and checksum of the content, calculated
-			 * using CRC-32C. If we calculate checksum of the whole pg_control using
-			 * CRC-32C we get same checksum constantly. It might be because of the
-			 * CRC-32C algorithm.
-			 * To avoid this problem we need to use different algorithm, CRC-32 in
-			 * this case.
-			 *
-			 * Starting from 2.0.25 we calculate crc of pg_control differently.
-			 */
-			if (arguments->backup_version >= 20025 &&
-				strcmp(file->name, "pg_control") == 0)
-				crc = get_pgcontrol_checksum(arguments->base_path);
-			else
-				crc = pgFileGetCRC(file->path,
-								   arguments->backup_version <= 20021 ||
-								   arguments->backup_version >= 20025,
-								   true, NULL);
-			if (crc != file->crc)
-			{
-				elog(WARNING, "Invalid CRC of backup file \"%s\" : %X. Expected %X",
-						file->path, file->crc, crc);
-				arguments->corrupted = true;
-			}
-		}
+		if (job->backup_version >= 20025 &&
+			strcmp(file->name, "pg_control") == 0)
+			crc = get_pgcontrol_checksum(job->base_path);
 		else
+			crc = pgFileGetCRC(file->path,
+							   BACKUP_USES_CRC32C(job->backup_version),
+							   true, NULL);
+		if (crc != file->crc)
 		{
-			/*
-			 * validate relation block by block
-			 * check page headers, checksums (if enabled)
-			 * and compute checksum of the file
-			 */
-			if (!check_file_pages(file, arguments->stop_lsn,
-								  arguments->checksum_version,
-								  arguments->backup_version))
-				arguments->corrupted = true;
+			elog(WARNING, "Invalid CRC of backup file \"%s\" : %X. Expected %X",
+					file->path, file->crc, crc);
+			return false;
 		}
 	}
+	else
+	{
+		/*
+		 * validate relation block by block
+		 * check page headers, checksums (if enabled)
+		 * and compute checksum of the file
+		 */
+		if (!check_file_pages(file, job->stop_lsn,
+							  job->checksum_version,
+							  job->backup_version))
+			return false;
+	}
 
-	/* Data files validation is successful */
-	arguments->ret = 0;
-
-	return NULL;
+	return true;
 }
 
 /*
  * Validate all backups in the backup catalog.
  * If --instance option was provided, validate only backups of this instance.
+ *
+ * Files of all backups which are going to be validated are checked at first
+ * in one pass by validate_backup_files(), then every instance is processed
+ * by do_validate_instance(), which validates WAL and handles parent chains.
  */
 int
 do_validate_all(void)
 {
+	parray	   *instances = parray_new();
+	parray	   *jobs = parray_new();
+	int			i;
+
 	corrupted_backup_found = false;
 	skipped_due_to_lock = false;
 
@@ -307,9 +683,9 @@ do_validate_all(void)
 		errno = 0;
 		while ((dent = readdir(dir)))
 		{
-			char		conf_path[MAXPGPATH];
 			char		child[MAXPGPATH];
 			struct stat	st;
+			validate_instance_arg *instance;
 
 			/* skip entries point current dir or parent dir */
 			if (strcmp(dent->d_name, ".") == 0 ||
@@ -324,25 +700,59 @@ do_validate_all(void)
 			if (!S_ISDIR(st.st_mode))
 				continue;
 
-			/*
-			 * Initialize instance configuration.
-			 */
-			instance_name = dent->d_name;
-			sprintf(backup_instance_path, "%s/%s/%s",
-					backup_path, BACKUPS_DIR, instance_name);
-			sprintf(arclog_path, "%s/%s/%s", backup_path, "wal", instance_name);
-			join_path_components(conf_path, backup_instance_path,
-								 BACKUP_CATALOG_CONF_FILE);
-			config_read_opt(conf_path, instance_options, ERROR, false);
-
-			do_validate_instance();
+			instance = pgut_new(validate_instance_arg);
+			instance->name = pgut_strdup(dent->d_name);
+			parray_append(instances, instance);
 		}
+		closedir(dir);
 	}
 	else
 	{
-		do_validate_instance();
+		validate_instance_arg *instance = pgut_new(validate_instance_arg);
+
+		instance->name = NULL;
+		parray_append(instances, instance);
+	}
+
+	/* Collect backups of all instances whose files should be validated */
+	for (i = 0; i < parray_num(instances); i++)
+	{
+		validate_instance_arg *instance =
+			(validate_instance_arg *) parray_get(instances, i);
+
+		if (instance->name)
+			init_validate_instance(instance->name);
+
+		elog(INFO, "Validate backups of the instance '%s'", instance_name);
+
+		/* Get list of all backups sorted in order of descending start time */
+		instance->backups = catalog_get_backup_list(INVALID_BACKUP_ID);
+		prevalidate_instance(instance->backups, jobs);
+	}
+
+	validate_backup_files(jobs);
+
+	/* Now validate WAL and parent chains instance by instance */
+	for (i = 0; i < parray_num(instances); i++)
+	{
+		validate_instance_arg *instance =
+			(validate_instance_arg *) parray_get(instances, i);
+
+		if (instance->name)
+			init_validate_instance(instance->name);
+
+		do_validate_instance(instance->backups, jobs);
+
+		/* cleanup */
+		parray_walk(instance->backups, pgBackupFree);
+		parray_free(instance->backups);
 	}
 
+	parray_walk(jobs, pfree);
+	parray_free(jobs);
+	parray_walk(instances, pfree);
+	parray_free(instances);
+
 	/* TODO: Probably we should have different exit code for every condition
 	 * and they combination:
 	 *  0 - all backups are valid
@@ -366,23 +776,115 @@ do_validate_all(void)
 	return 0;
 }
 
+/*
+ * Initialize instance configuration.
+ */
+static void
+init_validate_instance(const char *name)
+{
+	char		conf_path[MAXPGPATH];
+
+	instance_name = (char *) name;
+	sprintf(backup_instance_path, "%s/%s/%s",
+			backup_path, BACKUPS_DIR, instance_name);
+	sprintf(arclog_path, "%s/%s/%s", backup_path, "wal", instance_name);
+	join_path_components(conf_path, backup_instance_path,
+						 BACKUP_CATALOG_CONF_FILE);
+	config_read_opt(conf_path, instance_options, ERROR, false);
+}
+
+/*
+ * Lock backups of the instance, which do_validate_instance() is going to
+ * validate anyway, and add them to "jobs": FULL backups, backups with whole
+ * and valid parent chain and the oldest invalid backup of a chain, which has
+ * a chance for revalidation. Descendants of invalid backups are left to
+ * do_validate_instance(), their fate depends on the result of validation of
+ * parents.
+ */
+static void
+prevalidate_instance(parray *backups, parray *jobs)
+{
+	int			i;
+
+	for (i = 0; i < parray_num(backups); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backups, i);
+		validate_backup_job *job;
+
+		if (backup->status != BACKUP_STATUS_OK &&
+			backup->status != BACKUP_STATUS_DONE &&
+			backup->status != BACKUP_STATUS_ORPHAN &&
+			backup->status != BACKUP_STATUS_CORRUPT)
+			continue;
+
+		if (backup->backup_mode != BACKUP_MODE_FULL)
+		{
+			pgBackup   *tmp_backup = NULL;
+			int			result;
+
+			result = scan_parent_chain(backup, &tmp_backup);
+			if (result == 0 ||
+				(result == 1 && tmp_backup->start_time != backup->start_time))
+				continue;
+		}
+
+		/* do_validate_instance() will try again and complain */
+		if (!lock_backup(backup))
+			continue;
+
+		job = validate_backup_start(backup);
+		if (job)
+			parray_append(jobs, job);
+	}
+}
+
+/*
+ * Lock and validate files of the backup, unless it is already done by
+ * validate_backup_files() for one of "jobs", then just take the result.
+ * Returns false if the backup cannot be locked.
+ */
+static bool
+lock_and_validate(pgBackup *backup, parray *jobs)
+{
+	int			i;
+
+	for (i = 0; i < parray_num(jobs); i++)
+	{
+		validate_backup_job *job = (validate_backup_job *) parray_get(jobs, i);
+
+		if (job->backup == backup)
+		{
+			backup->status = job->status;
+			return true;
+		}
+	}
+
+	/* Do not interrupt, validate the next backup */
+	if (!lock_backup(backup))
+	{
+		elog(WARNING, "Cannot lock backup %s directory, skip validation",
+			 base36enc(backup->start_time));
+		skipped_due_to_lock = true;
+		return false;
+	}
+	/* Valiate backup files*/
+	pgBackupValidate(backup);
+
+	return true;
+}
+
 /*
  * Validate all backups in the given instance of the backup catalog.
+ * Files of backups from "jobs" are already checked.
  */
 static void
-do_validate_instance(void)
+do_validate_instance(parray *backups, parray *jobs)
 {
 	char	   *current_backup_id;
 	int			i;
 	int			j;
-	parray	   *backups;
 	pgBackup   *current_backup = NULL;
 
-	elog(INFO, "Validate backups of the instance '%s'", instance_name);
-
-	/* Get list of all backups sorted in order of descending start time */
-	backups = catalog_get_backup_list(INVALID_BACKUP_ID);
-
 	/* Examine backups one by one and validate them */
 	for (i = 0; i < parray_num(backups); i++)
 	{
@@ -458,16 +960,8 @@ do_validate_instance(void)
 		else
 			base_full_backup = current_backup;
 
-		/* Do not interrupt, validate the next backup */
-		if (!lock_backup(current_backup))
-		{
-			elog(WARNING, "Cannot lock backup %s directory, skip validation",
-				 base36enc(current_backup->start_time));
-			skipped_due_to_lock = true;
+		if (!lock_and_validate(current_backup, jobs))
 			continue;
-		}
-		/* Valiate backup files*/
-		pgBackupValidate(current_backup);
 
 		/* Validate corresponding WAL files */
 		if (current_backup->status == BACKUP_STATUS_OK)
@@ -551,16 +1045,9 @@ do_validate_instance(void)
 
 						if (backup->status == BACKUP_STATUS_ORPHAN)
 						{
-							/* Do not interrupt, validate the next backup */
-							if (!lock_backup(backup))
-							{
-								elog(WARNING, "Cannot lock backup %s directory, skip validation",
-									 base36enc(backup->start_time));
-								skipped_due_to_lock = true;
-								continue;
-							}
 							/* Revaliate backup files*/
-							pgBackupValidate(backup);
+							if (!lock_and_validate(backup, jobs))
+								continue;
 
 							if (backup->status == BACKUP_STATUS_OK)
 							{
@@ -582,8 +1069,4 @@ do_validate_instance(void)
 			}
 		}
 	}
-
-	/* cleanup */
-	parray_walk(backups, pgBackupFree);
-	parray_free(backups);
 }
@@ -408,6 +408,212 @@ class ArchiveTest(ProbackupTest, unittest.TestCase):
         self.del_test_dir(module_name, fname)
 
     # @unittest.expectedFailure
+    # @unittest.skip("skip")
+    def test_archive_push_batch(self):
+        """
+        Let several WAL segments wait for archiving, then archive them
+        with --batch-size and check that they are pushed ahead and
+        the backup taken after that is valid
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+
+        # Do not archive anything until there are several .ready files
+        node.append_conf(
+            'postgresql.auto.conf', "archive_command = 'exit 1'")
+        node.slow_start()
+
+        for i in range(5):
+            node.safe_psql(
+                "postgres",
+                "create table t_heap_{0} as select i as id, "
+                "md5(i::text) as text from generate_series(0,10000) i".format(i))
+            self.switch_wal_segment(node)
+
+        if self.get_version(node) >= self.version_to_num('10.0'):
+            status_dir = os.path.join(node.data_dir, 'pg_wal', 'archive_status')
+        else:
+            status_dir = os.path.join(node.data_dir, 'pg_xlog', 'archive_status')
+        ready = sorted(
+            f[:-len('.ready')] for f in os.listdir(status_dir)
+            if f.endswith('.ready'))
+        self.assertGreaterEqual(len(ready), 5)
+
+        self.set_archiving(
+            backup_dir, 'node', node,
+            archive_options=['-j', '2', '--batch-size=4'])
+        node.reload()
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        for i in range(60):
+            archived = [
+                f for f in os.listdir(wals_dir) if not f.endswith('.partial')]
+            if all(
+                    segment in archived or segment + '.gz' in archived
+                    for segment in ready):
+                break
+            sleep(1)
+        else:
+            self.fail('WAL segments {0} are not archived: {1}'.format(
+                ready, archived))
+
+        log_file = os.path.join(node.logs_dir, 'postgresql.log')
+        with open(log_file, 'r') as f:
+            log_content = f.read()
+        self.assertIn('INFO: Pushing 3 WAL segments ahead', log_content)
+
+        # The server has finished archiving of pushed ahead segments
+        for i in range(60):
+            if not any(f.endswith('.ready') for f in os.listdir(status_dir)):
+                break
+            sleep(1)
+        else:
+            self.fail('WAL segments are not marked as archived')
+
+        backup_id = self.backup_node(backup_dir, 'node', node)
+        self.validate_pb(backup_dir, 'node', backup_id)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_archive_push_checksum_file(self):
+        """
+        Check that archived WAL segments get checksum files, that
+        pushing already archived segment again succeeds and that
+        delete --wal removes checksum files together with segments
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text from generate_series(0,10000) i")
+        self.switch_wal_segment(node)
+        self.backup_node(backup_dir, 'node', node)
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        segments = sorted(
+            f for f in os.listdir(wals_dir)
+            if len(f) == 24 or (len(f) == 27 and f.endswith('.gz')))
+        self.assertTrue(segments)
+        for segment in segments:
+            crc_file = os.path.join(wals_dir, segment[:24] + '.crc')
+            self.assertTrue(
+                os.path.isfile(crc_file),
+                'Checksum file of WAL segment {0} is missing'.format(segment))
+            with open(crc_file, 'r') as f:
+                int(f.read())
+
+        # Push the last archived segment again, it is already there
+        if self.get_version(node) >= self.version_to_num('10.0'):
+            wal_dir = 'pg_wal'
+        else:
+            wal_dir = 'pg_xlog'
+        segment = [
+            s[:24] for s in segments
+            if os.path.isfile(os.path.join(node.data_dir, wal_dir, s[:24]))][-1]
+        subprocess.check_output(
+            [self.probackup_path, 'archive-push', '-B', backup_dir,
+                '--instance=node',
+                '--wal-file-path={0}'.format(os.path.join(wal_dir, segment)),
+                '--wal-file-name={0}'.format(segment)],
+            cwd=node.data_dir, env=self.test_env, stderr=subprocess.STDOUT)
+
+        # Delete first backup and WAL needed only by it
+        backup_id = self.show_pb(backup_dir, 'node')[0]['id']
+        self.delete_pb(backup_dir, 'node', backup_id, options=['--wal'])
+        remaining = [
+            f[:24] for f in os.listdir(wals_dir)
+            if len(f) == 24 or (len(f) == 27 and f.endswith('.gz'))]
+        for f in os.listdir(wals_dir):
+            if f.endswith('.crc'):
+                self.assertIn(f[:24], remaining)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_archive_get_prefetch(self):
+        """
+        Restore backup with archive-get prefetching WAL segments
+        and check that replay takes segments from prefetch directory
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+
+        for i in range(6):
+            node.safe_psql(
+                "postgres",
+                "create table t_heap_{0} as select i as id, "
+                "md5(i::text) as text from generate_series(0,10000) i".format(i))
+            self.switch_wal_segment(node)
+
+        result = node.safe_psql("postgres", "SELECT count(*) FROM t_heap_5")
+        sleep(5)
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node)
+
+        node.append_conf(
+            'recovery.conf',
+            "restore_command = '\"{0}\" archive-get -B {1} --instance node "
+            "--prefetch-depth=3 "
+            "--wal-file-path %p --wal-file-name %f'".format(
+                self.probackup_path, backup_dir))
+        node.slow_start()
+
+        self.assertEqual(
+            result, node.safe_psql("postgres", "SELECT count(*) FROM t_heap_5"))
+
+        log_file = os.path.join(node.logs_dir, 'postgresql.log')
+        with open(log_file, 'r') as f:
+            log_content = f.read()
+        self.assertIn(
+            'pg_probackup archive-get took prefetched WAL segment',
+            log_content)
+
+        # Prefetched segments do not stay after the end of recovery
+        if self.get_version(node) >= self.version_to_num('10.0'):
+            prefetch_dir = os.path.join(node.data_dir, 'pg_wal', 'pbk_prefetch')
+        else:
+            prefetch_dir = os.path.join(node.data_dir, 'pg_xlog', 'pbk_prefetch')
+        self.assertFalse(
+            os.path.exists(prefetch_dir),
+            'WAL prefetch directory is not removed: {0}'.format(
+                os.listdir(prefetch_dir) if os.path.exists(prefetch_dir)
+                else ''))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_replica_archive(self):
         """
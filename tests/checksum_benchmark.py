@@ -0,0 +1,79 @@
+import os
+import unittest
+import time
+from .helpers.ptrack_helpers import ProbackupTest
+
+
+module_name = 'checksum_benchmark'
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+class ChecksumBenchmark(ProbackupTest, unittest.TestCase):
+    """
+    Not a part of regular suite, run it with
+     python -m unittest -v tests.checksum_benchmark
+    Size of database is set by PG_PROBACKUP_BENCHMARK_SCALE (pgbench scale),
+    with PGPROBACKUPBIN_OLD throughput of previous binary is shown too.
+    """
+
+    def timed(self, func, *args, **kwargs):
+        start = time.time()
+        func(*args, **kwargs)
+        return time.time() - start
+
+    def validate_throughput(self, backup_dir, node, old_binary=False):
+        """ Take FULL backup and return MB/s of its file level validation """
+        self.init_pb(backup_dir, old_binary=old_binary)
+        self.add_instance(backup_dir, 'node', node, old_binary=old_binary)
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, options=['--stream', '-j', '4'],
+            old_binary=old_binary)
+
+        size = dir_size(
+            os.path.join(backup_dir, 'backups', 'node', backup_id))
+        # Warm up page cache, we measure checksum calculation, not disks
+        self.validate_pb(
+            backup_dir, 'node', backup_id,
+            options=['--skip-block-validation'], old_binary=old_binary)
+        validate_time = self.timed(
+            self.validate_pb, backup_dir, 'node', backup_id,
+            options=['--skip-block-validation'], old_binary=old_binary)
+
+        return size / validate_time / 1024 / 1024
+
+    # @unittest.skip("skip")
+    def test_checksum_throughput(self):
+        """
+        Measure throughput of file CRC calculation
+        during validate --skip-block-validation
+        """
+        fname = self.id().split('.')[3]
+        scale = int(self.test_env.get('PG_PROBACKUP_BENCHMARK_SCALE', 100))
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+        node.slow_start()
+        node.pgbench_init(scale=scale)
+
+        throughput = self.validate_throughput(backup_dir, node)
+        print('\npgbench scale {0}: validate {1:.1f} MB/s'.format(
+            scale, throughput))
+
+        if self.probackup_old_path:
+            old_throughput = self.validate_throughput(
+                backup_dir + '_old', node, old_binary=True)
+            print('Old binary: validate {0:.1f} MB/s'.format(old_throughput))
+
+            self.assertGreater(throughput, old_throughput)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -545,3 +545,185 @@ class CompressionTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_compression_threads_zlib(self):
+        """
+        make node, take full and page backups with separate reader
+        and compression threads, restore and check data correctness
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=5)
+
+        self.backup_node(
+            backup_dir, 'node', node,
+            options=[
+                '-j', '2', '--compress-threads=4',
+                '--compress-algorithm=zlib'])
+
+        pgbench = node.pgbench(options=['-T', '10', '-c', '2'])
+        pgbench.wait()
+
+        self.backup_node(
+            backup_dir, 'node', node,
+            backup_type='page',
+            options=[
+                '-j', '2', '--compress-threads=4',
+                '--compress-algorithm=zlib'])
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, options=['-j', '4'])
+
+        # Physical comparison
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    def check_archive_compression(self, fname, alg, suffix):
+        """
+        make archive node with WAL compressed by alg, take full and page
+        backups compressed by alg, restore them and check data correctness
+        """
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_config(
+            backup_dir, 'node',
+            options=['--compress-algorithm={0}'.format(alg)])
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        try:
+            self.backup_node(backup_dir, 'node', node)
+        except ProbackupException as e:
+            if 'does not support {0} compression'.format(alg) in e.message:
+                self.del_test_dir(module_name, fname)
+                self.skipTest('{0} compression is not supported'.format(alg))
+            raise
+
+        node.pgbench_init(scale=2)
+
+        page_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page')
+
+        wal_files = os.listdir(os.path.join(backup_dir, 'wal', 'node'))
+        self.assertTrue(
+            any(f.endswith(suffix) for f in wal_files),
+            'No WAL segments compressed by {0}: {1}'.format(alg, wal_files))
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        node.cleanup()
+
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=page_id,
+            options=['-j', '4', '--immediate',
+                     '--recovery-target-action=promote'])
+
+        # Physical comparison
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_compression_archive_zstd(self):
+        """zstd compression of data files and WAL"""
+        self.check_archive_compression(
+            self.id().split('.')[3], 'zstd', '.zst')
+
+    # @unittest.skip("skip")
+    def test_compression_archive_lz4(self):
+        """lz4 compression of data files and WAL"""
+        self.check_archive_compression(
+            self.id().split('.')[3], 'lz4', '.lz4')
+
+    # @unittest.skip("skip")
+    def test_compression_pglz_multithread(self):
+        """
+        make node, take full and delta backups compressed by pglz
+        in several threads, restore and check that data is identical
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=5)
+
+        self.backup_node(
+            backup_dir, 'node', node,
+            options=[
+                '--stream', '-j', '4', '--compress-threads=4',
+                '--compress-algorithm=pglz'])
+
+        pgbench = node.pgbench(options=['-T', '10', '-c', '2'])
+        pgbench.wait()
+
+        self.backup_node(
+            backup_dir, 'node', node,
+            backup_type='delta',
+            options=[
+                '--stream', '-j', '4', '--compress-algorithm=pglz'])
+
+        pgdata = self.pgdata_content(node.data_dir)
+        result = node.execute(
+            "postgres", "SELECT * FROM pgbench_accounts ORDER BY aid")
+
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+        node_restored.cleanup()
+
+        self.restore_node(
+            backup_dir, 'node', node_restored, options=['-j', '4'])
+
+        # Physical comparison, pages compressed by concurrent threads
+        # must be restored exactly
+        pgdata_restored = self.pgdata_content(node_restored.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node_restored.append_conf(
+            "postgresql.auto.conf", "port = {0}".format(node_restored.port))
+        node_restored.slow_start()
+
+        self.assertEqual(
+            result,
+            node_restored.execute(
+                "postgres", "SELECT * FROM pgbench_accounts ORDER BY aid"))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -38,7 +38,8 @@ class FalsePositive(ProbackupTest, unittest.TestCase):
         # delete last wal segment
         wals_dir = os.path.join(backup_dir, "wal", 'node')
         wals = [f for f in os.listdir(wals_dir) if os.path.isfile(
-            os.path.join(wals_dir, f)) and not f.endswith('.backup')]
+            os.path.join(wals_dir, f)) and not f.endswith('.backup')
+            and not f.endswith(('.crc', '.summary', '.walindex'))]
         wals = map(int, wals)
         os.remove(os.path.join(wals_dir, '0000000' + str(max(wals))))
 
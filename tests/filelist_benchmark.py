@@ -0,0 +1,160 @@
+import os
+import unittest
+import shutil
+import struct
+import time
+from .helpers.ptrack_helpers import ProbackupTest
+
+
+module_name = 'filelist_benchmark'
+
+# Layout of binary backup_content.control, see dir.c
+FILE_LIST_MAGIC = b'PGPBFL\n\0'
+FILE_LIST_HEADER = struct.Struct('<8sIIII')
+FILE_LIST_ENTRY = struct.Struct('<qIIIIiiBBB5x')
+COMPRESS_ALG = {
+    0: 'none', 1: 'none', 2: 'pglz', 3: 'zlib', 4: 'zstd', 5: 'lz4'}
+
+
+def convert_filelist_to_text(path, nfake):
+    """
+    Rewrite backup_content.control in text format used by older
+    versions and add nfake unchanged files, which validate and merge
+    have to load but not to read
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    lines = []
+    if data.startswith(FILE_LIST_MAGIC):
+        magic, version, nfiles, strtab_size, crc = \
+            FILE_LIST_HEADER.unpack_from(data, 0)
+        strtab_start = FILE_LIST_HEADER.size + FILE_LIST_ENTRY.size * nfiles
+
+        def string(offset):
+            end = data.index(b'\0', strtab_start + offset)
+            return data[strtab_start + offset:end].decode('utf-8')
+
+        for i in range(nfiles):
+            (write_size, path_off, linked_off, mode, file_crc, segno,
+                n_blocks, is_datafile, is_cfs, compress_alg) = \
+                FILE_LIST_ENTRY.unpack_from(
+                    data, FILE_LIST_HEADER.size + FILE_LIST_ENTRY.size * i)
+
+            line = (
+                '{{"path":"{0}", "size":"{1}", "mode":"{2}", '
+                '"is_datafile":"{3}", "is_cfs":"{4}", "crc":"{5}", '
+                '"compress_alg":"{6}"').format(
+                    string(path_off), write_size, mode, is_datafile,
+                    is_cfs, file_crc, COMPRESS_ALG[compress_alg])
+            if is_datafile:
+                line += ',"segno":"{0}"'.format(segno)
+            if linked_off:
+                line += ',"linked":"{0}"'.format(string(linked_off))
+            if n_blocks != -1:
+                line += ',"n_blocks":"{0}"'.format(n_blocks)
+            lines.append(line + '}\n')
+    else:
+        lines = data.decode('utf-8').splitlines(True)
+
+    for i in range(nfake):
+        lines.append(
+            '{{"path":"base/1/{0}", "size":"-1", "mode":"33152", '
+            '"is_datafile":"1", "is_cfs":"0", "crc":"0", '
+            '"compress_alg":"none","segno":"0"}}\n'.format(1000000 + i))
+
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def set_program_version(backup_dir, version):
+    """
+    Stamp backups of the catalog with program version of the old binary,
+    which refuses to validate backups made by newer versions
+    """
+    backups_dir = os.path.join(backup_dir, 'backups', 'node')
+    for backup_id in os.listdir(backups_dir):
+        control = os.path.join(backups_dir, backup_id, 'backup.control')
+        with open(control, 'r') as f:
+            lines = f.readlines()
+        with open(control, 'w') as f:
+            for line in lines:
+                if line.startswith('program-version'):
+                    line = 'program-version = {0}\n'.format(version)
+                f.write(line)
+
+
+class FileListBenchmark(ProbackupTest, unittest.TestCase):
+    """
+    Not a part of regular suite, run it with
+     python -m unittest -v tests.filelist_benchmark
+    Number of synthetic entries is set by PG_PROBACKUP_BENCHMARK_FILES,
+    with PGPROBACKUPBIN_OLD timings of previous binary are shown too.
+    """
+
+    def timed(self, func, *args, **kwargs):
+        start = time.time()
+        func(*args, **kwargs)
+        return time.time() - start
+
+    # @unittest.skip("skip")
+    def test_text_filelist_validate_merge(self):
+        """
+        Load text backup_content.control with 1M entries
+        during validate and merge
+        """
+        fname = self.id().split('.')[3]
+        nfake = int(self.test_env.get(
+            'PG_PROBACKUP_BENCHMARK_FILES', 1000000))
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+        node.pgbench_init(scale=1)
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        backups = self.show_pb(backup_dir, 'node')
+        for backup in backups:
+            convert_filelist_to_text(
+                os.path.join(
+                    backup_dir, 'backups', 'node', backup['id'],
+                    'backup_content.control'),
+                nfake)
+
+        old_backup_dir = backup_dir + '_old'
+        shutil.rmtree(old_backup_dir, ignore_errors=True)
+        shutil.copytree(backup_dir, old_backup_dir)
+
+        validate_time = self.timed(
+            self.validate_pb, backup_dir, 'node', backups[0]['id'])
+        merge_time = self.timed(
+            self.merge_backup, backup_dir, 'node', backups[1]['id'])
+        print('\n{0} synthetic entries: validate {1:.2f}s, merge {2:.2f}s'.format(
+            nfake, validate_time, merge_time))
+
+        if self.probackup_old_path:
+            set_program_version(
+                old_backup_dir,
+                self.run_pb(['--version'], old_binary=True).split()[1])
+
+            old_validate_time = self.timed(
+                self.validate_pb, old_backup_dir, 'node', backups[0]['id'],
+                old_binary=True)
+            old_merge_time = self.timed(
+                self.merge_backup, old_backup_dir, 'node', backups[1]['id'],
+                old_binary=True)
+            print('Old binary: validate {0:.2f}s, merge {1:.2f}s'.format(
+                old_validate_time, old_merge_time))
+
+            self.assertLess(validate_time, old_validate_time)
+            self.assertLess(merge_time, old_merge_time)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
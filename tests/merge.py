@@ -1333,6 +1333,76 @@ class MergeTest(ProbackupTest, unittest.TestCase):
 
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_merge_compressed_page_truncate(self):
+        """
+        make node, take compressed full backup, change and truncate
+        relations, take compressed page and delta backups, merge them
+        one by one, restore and compare pgdata
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'wal_level': 'replica', 'autovacuum': 'off'})
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+
+        # FULL backup
+        self.backup_node(
+            backup_dir, 'node', node, options=['--compress-algorithm=zlib'])
+
+        pgbench = node.pgbench(options=['-T', '10', '-c', '2', '--no-vacuum'])
+        pgbench.wait()
+
+        # PAGE backup, same algorithm, pages are copied compressed
+        page_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['--compress-algorithm=zlib'])
+
+        node.safe_psql(
+            "postgres",
+            "delete from pgbench_accounts where aid > 150000; "
+            "vacuum pgbench_accounts")
+
+        # DELTA backup, other algorithm, pages are compressed again
+        delta_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=['--compress-algorithm=pglz'])
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        self.merge_backup(backup_dir, "node", page_id)
+        self.merge_backup(backup_dir, "node", delta_id)
+
+        show_backups = self.show_pb(backup_dir, "node")
+        self.assertEqual(len(show_backups), 1)
+        self.assertEqual(show_backups[0]["backup-mode"], "FULL")
+
+        self.validate_pb(backup_dir)
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node)
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            node.safe_psql(
+                "postgres", "select count(*) from pgbench_accounts").rstrip(),
+            b'150000')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
 # 1. always use parent link when merging (intermediates may be from different chain)
 # 2. page backup we are merging with may disappear after failed merge,
 # it should not be possible to continue merge after that
@@ -662,6 +662,122 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
         node.cleanup()
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_page_wal_summary(self):
+        """
+        make PAGE backup with --wal-summary, which writes block summaries
+        of parsed WAL segments, delete it and make PAGE backup again,
+        which should take changed blocks from the summaries
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+
+        # Make several WAL segments
+        node.pgbench_init(scale=5)
+        pgbench = node.pgbench(options=['-T', '10', '-c', '2'])
+        pgbench.wait()
+
+        page_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['-j', '4', '--wal-summary'])
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        summaries = [
+            f for f in os.listdir(wals_dir) if f.endswith('.summary')]
+        self.assertTrue(summaries, 'No block summaries are written')
+
+        self.delete_pb(backup_dir, 'node', page_id)
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['-j', '4', '--log-level-console=LOG'])
+        self.assertIn(
+            'Block summaries are used for', self.output,
+            '\n Unexpected Output: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        node_restored.cleanup()
+        self.restore_node(backup_dir, 'node', node_restored)
+
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node_restored.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_page_wal_readahead(self):
+        """
+        make PAGE backup and validate to xid reading compressed
+        WAL segments ahead with --wal-readahead
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node, compress=True)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+
+        # Make several WAL segments
+        node.pgbench_init(scale=5)
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['-j', '2', '--wal-readahead=4'])
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        node_restored.cleanup()
+        self.restore_node(backup_dir, 'node', node_restored)
+
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node_restored.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.pgbench_init(scale=5)
+        with node.connect("postgres") as con:
+            res = con.execute("SELECT txid_current()")
+            con.commit()
+            target_xid = res[0][0]
+        self.switch_wal_segment(node)
+
+        self.assertIn(
+            "INFO: backup validation completed successfully",
+            self.validate_pb(
+                backup_dir, 'node',
+                options=[
+                    "--xid={0}".format(target_xid), '--wal-readahead=2']),
+            '\n Unexpected Output: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_page_backup_with_lost_wal_segment(self):
         """
@@ -691,7 +807,8 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
         # delete last wal segment
         wals_dir = os.path.join(backup_dir, 'wal', 'node')
         wals = [f for f in os.listdir(wals_dir) if os.path.isfile(os.path.join(
-            wals_dir, f)) and not f.endswith('.backup') and not f.endswith('.partial')]
+            wals_dir, f)) and not f.endswith('.backup') and not f.endswith('.partial')
+            and not f.endswith(('.crc', '.summary', '.walindex'))]
         wals = map(str, wals)
         file = os.path.join(wals_dir, max(wals))
         os.remove(file)
@@ -780,7 +897,8 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
         # delete last wal segment
         wals_dir = os.path.join(backup_dir, 'wal', 'node')
         wals = [f for f in os.listdir(wals_dir) if os.path.isfile(os.path.join(
-            wals_dir, f)) and not f.endswith('.backup')]
+            wals_dir, f)) and not f.endswith('.backup')
+            and not f.endswith(('.crc', '.summary', '.walindex'))]
         wals = map(str, wals)
  #       file = os.path.join(wals_dir, max(wals))
 
@@ -927,7 +1045,8 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
         # copy lastest wal segment
         wals_dir = os.path.join(backup_dir, 'wal', 'alien_node')
         wals = [f for f in os.listdir(wals_dir) if os.path.isfile(os.path.join(
-            wals_dir, f)) and not f.endswith('.backup')]
+            wals_dir, f)) and not f.endswith('.backup')
+            and not f.endswith(('.crc', '.summary', '.walindex'))]
         wals = map(str, wals)
         filename = max(wals)
         file = os.path.join(wals_dir, filename)
@@ -1724,3 +1724,149 @@ class RestoreTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_long_chain(self):
+        """
+        make node, take full backup and a chain of page and delta
+        backups, some of them compressed, truncate and extend tables
+        between backups, restore the chain, compare pgdata
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+
+        # Take FULL
+        self.backup_node(backup_dir, 'node', node)
+
+        for i in range(6):
+            pgbench = node.pgbench(options=['-T', '5', '-c', '2', '--no-vacuum'])
+            pgbench.wait()
+
+            if i == 2:
+                # Truncate tables, next backups must shrink files
+                node.safe_psql(
+                    'postgres',
+                    'delete from pgbench_accounts where aid > 100000; '
+                    'vacuum pgbench_accounts')
+            if i == 4:
+                # Extend tables again
+                node.safe_psql(
+                    'postgres',
+                    'insert into pgbench_accounts '
+                    'select i, 1, 0, \'\' from generate_series(100001, 150000) i')
+
+            options = []
+            if i % 2:
+                options = ['--compress-algorithm=zlib']
+            self.backup_node(
+                backup_dir, 'node', node,
+                backup_type='page' if i % 3 else 'delta', options=options)
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node, options=['-j', '4'])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            node.safe_psql(
+                'postgres', 'select count(*) from pgbench_accounts').rstrip(),
+            b'150000')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_incremental(self):
+        """
+        make node, take full and page backups, change data,
+        restore page backup into existing data directory with
+        --incremental, compare pgdata
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+        self.backup_node(backup_dir, 'node', node)
+
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2', '--no-vacuum'])
+        pgbench.wait()
+
+        page_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page')
+        pgdata = self.pgdata_content(node.data_dir)
+
+        # Diverge from the backup
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2', '--no-vacuum'])
+        pgbench.wait()
+        node.safe_psql(
+            'postgres',
+            'create table t_heap as select i from generate_series(0,10000) i; '
+            'delete from pgbench_accounts where aid > 100000; '
+            'vacuum pgbench_accounts; checkpoint')
+
+        # Running server must not be overwritten
+        try:
+            self.restore_node(
+                backup_dir, 'node', node, backup_id=page_id,
+                options=['--incremental'])
+            # we should die here because exception is what we expect to happen
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because server is running.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'the server must be stopped for incremental restore',
+                e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        node.stop()
+
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=page_id,
+            options=['--incremental', '-j', '4'])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            node.safe_psql(
+                'postgres', 'select count(*) from pgbench_accounts').rstrip(),
+            b'200000')
+        self.assertEqual(
+            node.safe_psql(
+                'postgres',
+                "select count(*) from pg_class where relname = 't_heap'").rstrip(),
+            b'0')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -59,7 +59,7 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
             self.assertTrue(False, "max_wal is not set")
 
         for wal_name in os.listdir(os.path.join(backup_dir, 'wal', 'node')):
-            if not wal_name.endswith(".backup"):
+            if not wal_name.endswith((".backup", ".walindex")):
                 # wal_name_b = wal_name.encode('ascii')
                 self.assertEqual(wal_name[8:] > min_wal[8:], True)
                 self.assertEqual(wal_name[8:] > max_wal[8:], True)
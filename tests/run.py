@@ -0,0 +1,162 @@
+"""
+Run test suite in parallel.
+
+Usage:
+ python -m tests.run [--jobs N] [tests.specific_module[.class.test] ...]
+
+Every worker process gets its own tmp directory and its own range of
+ports, so tests never step on each other's nodes. Durations of tests are
+saved in tests/tmp_dirs/durations.json, the next run starts the longest
+tests first.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import unittest
+import traceback
+import multiprocessing
+
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+durations_path = os.path.join(dir_path, 'tmp_dirs', 'durations.json')
+
+# Every worker gets PORTS_PER_WORKER ports starting from FIRST_PORT
+FIRST_PORT = 20000
+PORTS_PER_WORKER = 100
+
+
+def flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in flatten(test):
+                yield t
+        else:
+            yield test
+
+
+def collect_tests(names):
+    loader = unittest.TestLoader()
+    if names:
+        suite = loader.loadTestsFromNames(names)
+    else:
+        suite = loader.loadTestsFromName('tests')
+    return [test.id() for test in flatten(suite)]
+
+
+def init_worker(counter):
+    """ Assign worker number, tmp directory and port range """
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+
+    os.environ['PG_PROBACKUP_TMP_DIR'] = os.path.join(
+        dir_path, 'tmp_dirs', 'worker_{0}'.format(worker_id))
+    first_port = FIRST_PORT + worker_id * PORTS_PER_WORKER
+    os.environ['PG_PROBACKUP_PORT_RANGE'] = '{0}-{1}'.format(
+        first_port, first_port + PORTS_PER_WORKER - 1)
+
+
+def run_test(test_id):
+    """ Run single test in worker, return its outcome """
+    start = time.time()
+    result = unittest.TestResult()
+    try:
+        test = unittest.TestLoader().loadTestsFromName(test_id)
+        test.run(result)
+    except Exception:
+        result.errors.append((test_id, traceback.format_exc()))
+
+    if result.errors:
+        status, details = 'ERROR', result.errors[0][1]
+    elif result.failures:
+        status, details = 'FAIL', result.failures[0][1]
+    elif result.unexpectedSuccesses:
+        status, details = 'UNEXPECTED SUCCESS', ''
+    elif result.skipped:
+        status, details = 'SKIP', result.skipped[0][1]
+    elif result.expectedFailures:
+        status, details = 'EXPECTED FAILURE', ''
+    else:
+        status, details = 'OK', ''
+
+    return test_id, status, details, time.time() - start
+
+
+def load_durations():
+    try:
+        with open(durations_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_durations(durations):
+    try:
+        os.makedirs(os.path.dirname(durations_path))
+    except OSError:
+        pass
+    with open(durations_path, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run pg_probackup tests in parallel')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes')
+    parser.add_argument(
+        'tests', nargs='*',
+        help='tests to run, by default whole suite from tests/__init__.py')
+    args = parser.parse_args()
+
+    durations = load_durations()
+    test_ids = collect_tests(args.tests)
+
+    # Longest first. Tests without recorded duration are scheduled
+    # first, nobody knows how long they will take.
+    unknown = max(durations.values()) if durations else 0
+    test_ids.sort(key=lambda t: durations.get(t, unknown + 1), reverse=True)
+
+    print('Running {0} tests in {1} workers'.format(
+        len(test_ids), args.jobs))
+
+    counter = multiprocessing.Value('i', 0)
+    pool = multiprocessing.Pool(
+        args.jobs, initializer=init_worker, initargs=(counter,),
+        maxtasksperchild=None)
+
+    start = time.time()
+    failed = []
+    try:
+        for i, (test_id, status, details, duration) in enumerate(
+                pool.imap_unordered(run_test, test_ids, chunksize=1)):
+            print('[{0}/{1}] {2} ... {3} ({4:.1f}s)'.format(
+                i + 1, len(test_ids), test_id, status, duration))
+            sys.stdout.flush()
+
+            if status != 'SKIP':
+                durations[test_id] = duration
+            if status in ('ERROR', 'FAIL', 'UNEXPECTED SUCCESS'):
+                failed.append((test_id, status, details))
+    finally:
+        pool.terminate()
+        pool.join()
+        save_durations(durations)
+
+    for test_id, status, details in failed:
+        print('=' * 70)
+        print('{0}: {1}'.format(status, test_id))
+        print('-' * 70)
+        print(details)
+
+    print('Ran {0} tests in {1:.1f}s, {2} failed'.format(
+        len(test_ids), time.time() - start, len(failed)))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
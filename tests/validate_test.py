@@ -203,6 +203,222 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
         # Clean after yourself
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_validate_wal_threads_to_target(self):
+        """
+        make node with archiving, make archive backup,
+        generate WAL before and after target xid,
+        validate to target xid in several threads,
+        WAL after target is not needed, WAL before target is
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+
+        def current_walfile():
+            if self.get_version(node) < self.version_to_num('10.0'):
+                walfile = node.safe_psql(
+                    'postgres',
+                    'select pg_xlogfile_name(pg_current_xlog_location())')
+            else:
+                walfile = node.safe_psql(
+                    'postgres',
+                    'select pg_walfile_name(pg_current_wal_lsn())')
+            walfile = walfile.decode('utf-8').rstrip()
+            if self.archive_compress:
+                walfile = walfile + '.gz'
+            return walfile
+
+        node.pgbench_init(scale=3)
+        walfile_before = current_walfile()
+
+        with node.connect("postgres") as con:
+            con.execute("CREATE TABLE tbl0005 (a text)")
+            res = con.execute(
+                "INSERT INTO tbl0005 VALUES ('inserted') RETURNING (xmin)")
+            con.commit()
+            target_xid = res[0][0]
+
+        node.pgbench_init(scale=3)
+        walfile_after = current_walfile()
+        self.switch_wal_segment(node)
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        while not os.path.exists(os.path.join(wals_dir, walfile_after)):
+            time.sleep(1)
+
+        self.assertIn(
+            "INFO: backup validation completed successfully",
+            self.validate_pb(
+                backup_dir, 'node',
+                options=["--xid={0}".format(target_xid), '-j', '4']),
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Segment after the target is not needed
+        os.remove(os.path.join(wals_dir, walfile_after))
+        self.assertIn(
+            "INFO: backup validation completed successfully",
+            self.validate_pb(
+                backup_dir, 'node',
+                options=["--xid={0}".format(target_xid), '-j', '4']),
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Segment before the target is
+        os.remove(os.path.join(wals_dir, walfile_before))
+        try:
+            self.validate_pb(
+                backup_dir, 'node',
+                options=["--xid={0}".format(target_xid), '-j', '4'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of absent WAL segment.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                'is absent' in e.message and
+                'WARNING: recovery can be done up to time' in e.message and
+                "ERROR: not enough WAL records to xid {0}\n".format(
+                    target_xid) in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_validate_wal_index(self):
+        """
+        make node with archiving and WAL index, make archive backup,
+        generate WAL before target xid, index all WAL by index-wal,
+        validate to target xid skipping indexed segments,
+        entries of overwritten segments are not used,
+        lost segment before target is still detected
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(
+            backup_dir, 'node', node, archive_options=['--wal-index'])
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+
+        node.pgbench_init(scale=3)
+        if self.get_version(node) < self.version_to_num('10.0'):
+            walfile_before = node.safe_psql(
+                'postgres',
+                'select pg_xlogfile_name(pg_current_xlog_location())')
+        else:
+            walfile_before = node.safe_psql(
+                'postgres',
+                'select pg_walfile_name(pg_current_wal_lsn())')
+        walfile_before = walfile_before.decode('utf-8').rstrip()
+        if self.archive_compress:
+            walfile_before = walfile_before + '.gz'
+
+        with node.connect("postgres") as con:
+            con.execute("CREATE TABLE tbl0005 (a text)")
+            res = con.execute(
+                "INSERT INTO tbl0005 VALUES ('inserted') RETURNING (xmin)")
+            con.commit()
+            target_xid = res[0][0]
+        self.switch_wal_segment(node)
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        self.assertTrue(
+            os.path.exists(os.path.join(wals_dir, '00000001.walindex')),
+            'WAL index is not written by archive-push')
+
+        self.assertIn(
+            'WAL segments are indexed',
+            self.run_pb([
+                'index-wal', '-B', backup_dir, '--instance=node',
+                '-j', '2']))
+
+        output = self.validate_pb(
+            backup_dir, 'node',
+            options=[
+                "--xid={0}".format(target_xid), '-j', '4',
+                '--log-level-console=LOG'])
+        self.assertIn(
+            "WAL index allows to skip", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+        self.assertIn(
+            "INFO: backup validation completed successfully", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Entries of overwritten segments are not used
+        for f in os.listdir(wals_dir):
+            if f.endswith('.crc'):
+                with open(os.path.join(wals_dir, f), 'w') as crc_file:
+                    crc_file.write('0\n')
+
+        output = self.validate_pb(
+            backup_dir, 'node',
+            options=[
+                "--xid={0}".format(target_xid), '-j', '4',
+                '--log-level-console=LOG'])
+        self.assertNotIn(
+            "WAL index allows to skip", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+        self.assertIn(
+            "INFO: backup validation completed successfully", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # index-wal adds new entries for them
+        self.run_pb([
+            'index-wal', '-B', backup_dir, '--instance=node', '-j', '2'])
+        output = self.validate_pb(
+            backup_dir, 'node',
+            options=[
+                "--xid={0}".format(target_xid), '-j', '4',
+                '--log-level-console=LOG'])
+        self.assertIn(
+            "WAL index allows to skip", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Skipped segments are still required
+        os.remove(os.path.join(wals_dir, walfile_before))
+        try:
+            self.validate_pb(
+                backup_dir, 'node',
+                options=["--xid={0}".format(target_xid), '-j', '4'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of absent WAL segment.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertTrue(
+                'is absent' in e.message and
+                "ERROR: not enough WAL records to xid {0}\n".format(
+                    target_xid) in e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_validate_corrupted_intermediate_backup(self):
         """
@@ -1335,7 +1551,10 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
 
         # Corrupt WAL
         wals_dir = os.path.join(backup_dir, 'wal', 'node')
-        wals = [f for f in os.listdir(wals_dir) if os.path.isfile(os.path.join(wals_dir, f)) and not f.endswith('.backup')]
+        wals = [
+            f for f in os.listdir(wals_dir)
+            if os.path.isfile(os.path.join(wals_dir, f)) and
+            not f.endswith(('.backup', '.crc', '.summary', '.walindex'))]
         wals.sort()
         for wal in wals:
             with open(os.path.join(wals_dir, wal), "rb+", 0) as f:
@@ -1401,7 +1620,10 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
 
         # Corrupt WAL
         wals_dir = os.path.join(backup_dir, 'wal', 'node')
-        wals = [f for f in os.listdir(wals_dir) if os.path.isfile(os.path.join(wals_dir, f)) and not f.endswith('.backup')]
+        wals = [
+            f for f in os.listdir(wals_dir)
+            if os.path.isfile(os.path.join(wals_dir, f)) and
+            not f.endswith(('.backup', '.crc', '.summary', '.walindex'))]
         wals.sort()
         for wal in wals:
             with open(os.path.join(wals_dir, wal), "rb+", 0) as f:
@@ -1465,7 +1687,10 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
 
         # Delete wal segment
         wals_dir = os.path.join(backup_dir, 'wal', 'node')
-        wals = [f for f in os.listdir(wals_dir) if os.path.isfile(os.path.join(wals_dir, f)) and not f.endswith('.backup')]
+        wals = [
+            f for f in os.listdir(wals_dir)
+            if os.path.isfile(os.path.join(wals_dir, f)) and
+            not f.endswith(('.backup', '.crc', '.summary', '.walindex'))]
         wals.sort()
         file = os.path.join(backup_dir, 'wal', 'node', wals[-1])
         os.remove(file)
@@ -3339,6 +3564,163 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
         # Clean after yourself
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_validate_all_instances_multithread(self):
+        """
+        Take FULL and PAGE backups of two instances, corrupt file
+        in PAGE of the second instance and validate whole catalog
+        with several threads: files of all backups are validated
+        in one pass, statuses must be the same as before
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+
+        backup_ids = {}
+        for instance in ['node1', 'node2']:
+            node = self.make_simple_node(
+                base_dir=os.path.join(module_name, fname, instance),
+                initdb_params=['--data-checksums'])
+            self.add_instance(backup_dir, instance, node)
+            self.set_archiving(backup_dir, instance, node)
+            node.slow_start()
+
+            node.safe_psql(
+                "postgres",
+                "create table t_heap as select i as id, "
+                "md5(i::text) as text from generate_series(0,10000) i")
+            full_id = self.backup_node(backup_dir, instance, node)
+
+            node.safe_psql(
+                "postgres",
+                "insert into t_heap select i as id, "
+                "md5(i::text) as text from generate_series(0,10000) i")
+            page_id = self.backup_node(
+                backup_dir, instance, node, backup_type='page')
+
+            backup_ids[instance] = (full_id, page_id)
+            file_path_t_heap = node.safe_psql(
+                "postgres",
+                "select pg_relation_filepath('t_heap')").rstrip()
+            node.stop()
+
+        # Corrupt file in PAGE backup of the second instance
+        file = os.path.join(
+            backup_dir, 'backups', 'node2', backup_ids['node2'][1],
+            'database', file_path_t_heap)
+        with open(file, "rb+", 0) as f:
+            f.seek(42)
+            f.write(b"blah")
+            f.flush()
+            f.close
+
+        try:
+            self.validate_pb(backup_dir, options=['-j', '4'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of data files corruption.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'WARNING: Backup {0} data files are corrupted'.format(
+                    backup_ids['node2'][1]),
+                e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+            self.assertIn(
+                'WARNING: Some backups are not valid', e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+            for instance in ['node1', 'node2']:
+                self.assertIn(
+                    "INFO: Validate backups of the instance '{0}'".format(
+                        instance),
+                    e.message)
+
+        for instance in ['node1', 'node2']:
+            full_id, page_id = backup_ids[instance]
+            self.assertEqual(
+                'OK', self.show_pb(backup_dir, instance, full_id)['status'])
+            self.assertEqual(
+                'CORRUPT' if instance == 'node2' else 'OK',
+                self.show_pb(backup_dir, instance, page_id)['status'])
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_validate_unchanged_backup(self):
+        """
+        Validate backup twice and check that second validation
+        does not check unchanged files, unless --force-validation
+        is given, then corrupt file and check that it is noticed
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text from generate_series(0,10000) i")
+        file_path_t_heap = node.safe_psql(
+            "postgres",
+            "select pg_relation_filepath('t_heap')").rstrip()
+        backup_id = self.backup_node(backup_dir, 'node', node)
+
+        # Modification time of files must be older than validation
+        time.sleep(1)
+        output = self.validate_pb(
+            backup_dir, 'node', backup_id, options=['--force-validation'])
+        self.assertNotIn('not changed since validation', output)
+        self.assertIn(
+            'INFO: Backup {0} data files are valid'.format(backup_id),
+            output)
+
+        output = self.validate_pb(backup_dir, 'node', backup_id)
+        self.assertIn(
+            'INFO: Backup {0} data files are valid, '
+            'not changed since validation'.format(backup_id),
+            output)
+
+        # Corrupt file, its size remains the same
+        file = os.path.join(
+            backup_dir, 'backups', 'node', backup_id,
+            'database', file_path_t_heap)
+        with open(file, "r+b", 0) as f:
+            f.seek(42)
+            f.write(b"blah")
+            f.flush()
+            f.close
+
+        try:
+            self.validate_pb(backup_dir, 'node', backup_id)
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of data files corruption.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'WARNING: Backup {0} data files are corrupted'.format(
+                    backup_id),
+                e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        self.assertEqual(
+            'CORRUPT', self.show_pb(backup_dir, 'node', backup_id)['status'])
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
 # validate empty backup list
 # page from future during validate
 # page from future during backup